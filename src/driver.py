@@ -1,21 +1,26 @@
 import argparse
 from json import load
 import logging
-from lib.backuppool import BackupPool
+from lib.backuppool import BackupPool, LOAD_METRICS
 from lib.zookeeper_client import ZookeeperClient
 from lib.publisher import Publisher
 from lib.subscriber import Subscriber
 from lib.broker import Broker
+from lib.edge_broker import EdgeBroker
+from lib.placement import PLACEMENT_STRATEGIES
 
 def create_publisher_with_zookeeper(publisher):
     """ Method to handle creation of publisher using zookeeper coordination"""
     publisher.connect_zk()
     publisher.start_session()
     publisher.assign_to_zone()
+    publisher.resolve_partitions()
     publisher.update_broker_info(
         znode_value=publisher.get_znode_value(znode_name=publisher.broker_leader_znode)
         )
+    publisher.watch_topic_demand()
     publisher.watch_znode_data_change()
+    publisher.watch_migration()
     publisher.publish()
     # Will call if not running indefinitely
     publisher.disconnect()
@@ -29,7 +34,10 @@ def create_publisher_without_zookeeper(publisher):
 
 def create_publishers(count=1, topics=[], broker_address='127.0.0.1',
     sleep_period=1, bind_port=5556, indefinite=False, max_event_count=15,
-    zookeeper_hosts=['127.0.0.1:2181'],verbose=False, offered=1):
+    zookeeper_hosts=['127.0.0.1:2181'],verbose=False, offered=1, batch_size=1, batch_latency=1000,
+    compression=None, compression_level=6, compression_threshold=512,
+    shared_memory=False, shm_slots=256, shm_slot_size=16384, placement='random', partitions=1,
+    repair_buffer=1024, name=None):
     """ Method to create a set of publishers.
     In order to run multiple subscribers simultaneously,
     need to use multiprocessing library, because Publisher.publish() will block for i in range(count)
@@ -51,7 +59,19 @@ def create_publishers(count=1, topics=[], broker_address='127.0.0.1',
             max_event_count=max_event_count,
             zookeeper_hosts=zookeeper_hosts,
             verbose=verbose,
-            offered=offered
+            offered=offered,
+            batch_size=batch_size,
+            batch_latency=batch_latency,
+            compression=compression,
+            compression_level=compression_level,
+            compression_threshold=compression_threshold,
+            shared_memory=shared_memory,
+            shm_slots=shm_slots,
+            shm_slot_size=shm_slot_size,
+            placement=placement,
+            partitions=partitions,
+            repair_buffer=repair_buffer,
+            name=name
         )
         try:
             create_publisher_with_zookeeper(pubs[i])
@@ -66,11 +86,16 @@ def create_subscriber_with_zookeeper(subscriber):
     """ Method to handle creation of a subscriber using ZooKeeper coordination """
     subscriber.connect_zk()
     subscriber.start_session()
-    subscriber.assign_to_zone()
+    if subscriber.edge:
+        subscriber.assign_to_edge()
+    else:
+        subscriber.assign_to_zone()
+    subscriber.resolve_partitions()
     subscriber.update_broker_info(
         znode_value=subscriber.get_znode_value(znode_name=subscriber.broker_leader_znode)
     )
     subscriber.watch_znode_data_change()
+    subscriber.watch_migration()
     subscriber.notify()
     subscriber.write_stored_messages()
     # Will call if not running indefinitely
@@ -85,7 +110,9 @@ def create_subscriber_without_zookeeper(subscriber):
 
 def create_subscribers(count=1, filename=None, broker_address='127.0.0.1',
      centralized=False, topics=[], indefinite=False, max_event_count=15,
-     zookeeper_hosts=['127.0.0.1:2181'],verbose=False,requested=1):
+     zookeeper_hosts=['127.0.0.1:2181'],verbose=False,requested=1,codecs=None,placement='random',
+     edge=None,adaptive=False,partitions=1,group=None,group_credits=10,replay_seconds=None,
+     repair_window=1000,repair_timeout=500,repair_retries=3,name=None):
     """ Method to create a set of subscribers. In order to run multiple subscribers simultaneously,
     need to use multiprocessing library, because Subscriber.listen() will block for i in range(count)
     if run sequentially. E.g. subscriber 2 on the same host will not ever get to listen for updates
@@ -101,7 +128,19 @@ def create_subscribers(count=1, filename=None, broker_address='127.0.0.1',
             max_event_count=max_event_count,
             zookeeper_hosts=zookeeper_hosts,
             verbose=verbose,
-            requested=requested
+            requested=requested,
+            codecs=codecs,
+            placement=placement,
+            edge=edge,
+            adaptive=adaptive,
+            partitions=partitions,
+            group=group,
+            group_credits=group_credits,
+            replay_seconds=replay_seconds,
+            repair_window=repair_window,
+            repair_timeout=repair_timeout,
+            repair_retries=repair_retries,
+            name=name
         )
         try:
             create_subscriber_with_zookeeper(subs[i])
@@ -126,8 +165,6 @@ def create_broker_with_zookeeper(broker):
     broker.setup_fault_tolerance_znode()
     broker.setup_shared_state_znode()
     broker.setup_load_balancing_znode()
-    broker.watch_shared_state_publishers()
-    broker.watch_shared_state_subscribers()
     broker.zk_run_election()
 
 def create_broker_without_zookeeper(broker):
@@ -137,9 +174,25 @@ def create_broker_without_zookeeper(broker):
     # Will call if broker event loop not indefinite
     broker.disconnect()
 
+def parse_load_weights(value):
+    """ argparse type for --load_weights: 'clients=1,cpu=5' -> {'clients': 1.0, 'cpu': 5.0} """
+    weights = {}
+    for pair in value.split(','):
+        metric, _, weight = pair.partition('=')
+        if metric not in LOAD_METRICS:
+            raise argparse.ArgumentTypeError(f'unknown load metric {metric}; choose from {LOAD_METRICS}')
+        try:
+            weights[metric] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f'invalid weight for {metric}: {weight}')
+    return weights
+
 def create_brokers(indefinite=False, centralized=False, pub_reg_port=5555,
     sub_reg_port=5556, autokill=None, max_event_count=15, zookeeper_hosts=['127.0.0.1:2181'],
-    verbose=False,primary=False,zone=1):
+    verbose=False,primary=False,zone=1,registry_buckets=0,load_interval=1000,
+    adaptive=False,mode_threshold=200,mode_hysteresis=0.5,mode_cooldown=10,group_backlog=1000,
+    last_value=False,log_dir=None,log_segment_bytes=64*1024*1024,log_retention_bytes=None,log_retention_seconds=None,
+    replay_batch=1000,shared_memory=False,shm_slots=256,shm_slot_size=16384):
 
     broker = Broker(
         centralized=centralized,
@@ -151,7 +204,23 @@ def create_brokers(indefinite=False, centralized=False, pub_reg_port=5555,
         zookeeper_hosts=zookeeper_hosts,
         verbose=verbose,
         primary=primary,
-        zone=zone
+        zone=zone,
+        registry_buckets=registry_buckets,
+        load_interval=load_interval,
+        adaptive=adaptive,
+        mode_threshold=mode_threshold,
+        mode_hysteresis=mode_hysteresis,
+        mode_cooldown=mode_cooldown,
+        group_backlog=group_backlog,
+        last_value=last_value,
+        log_dir=log_dir,
+        log_segment_bytes=log_segment_bytes,
+        log_retention_bytes=log_retention_bytes,
+        log_retention_seconds=log_retention_seconds,
+        replay_batch=replay_batch,
+        shared_memory=shared_memory,
+        shm_slots=shm_slots,
+        shm_slot_size=shm_slot_size
     )
     try:
         create_broker_with_zookeeper(broker)
@@ -160,6 +229,33 @@ def create_brokers(indefinite=False, centralized=False, pub_reg_port=5555,
         # If you interrupt/cancel a broker, be sure to disconnect/clean all sockets
         broker.disconnect()
 
+def create_edge_broker(name, parent=None, indefinite=False, sub_reg_port=5556, autokill=None,
+    max_event_count=15, zookeeper_hosts=['127.0.0.1:2181'], verbose=False, registry_buckets=0,
+    last_value=False,log_dir=None,log_segment_bytes=64*1024*1024,log_retention_bytes=None,log_retention_seconds=None,
+    replay_batch=1000):
+    """ Method to create an edge broker (see lib/edge_broker.py) """
+    broker = EdgeBroker(
+        name=name,
+        parent=parent,
+        indefinite=indefinite,
+        sub_reg_port=sub_reg_port,
+        max_event_count=max_event_count,
+        autokill=autokill,
+        zookeeper_hosts=zookeeper_hosts,
+        verbose=verbose,
+        registry_buckets=registry_buckets,
+        last_value=last_value,
+        log_dir=log_dir,
+        log_segment_bytes=log_segment_bytes,
+        log_retention_bytes=log_retention_bytes,
+        log_retention_seconds=log_retention_seconds,
+        replay_batch=replay_batch
+    )
+    try:
+        create_broker_with_zookeeper(broker)
+    except KeyboardInterrupt:
+        broker.disconnect()
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description='Pass arguments to create publishers, subscribers, or an intermediate message broker')
@@ -189,6 +285,50 @@ if __name__ == "__main__":
         'whether to use centralized message dissemination (broker anonymizes pub and sub); '
         'if not passed, will use direct message dissemination (subscriber connects directly to publisher)'
     ))
+    parser.add_argument('-ad', '--adaptive', action='store_true', help=(
+        'use with --centralized, with --broker (or --backup) and --subscriber. The broker chooses per topic '
+        'whether to send it itself or let subscribers connect directly to the publishers, from '
+        'the topic\'s fanout and message rate, and switches its subscribers when that changes'
+    ))
+    parser.add_argument('--mode_threshold', type=float, default=200,
+        help=(
+            'Use with --broker and --adaptive. A topic is sent through the broker once each of its '
+            'publishers would have to send more than this many messages per second to its '
+            'subscribers directly (rate * subscribers / publishers). Default 200.'))
+    parser.add_argument('--mode_hysteresis', type=float, default=0.5,
+        help=(
+            'Use with --broker and --adaptive. A topic sent through the broker only goes back to '
+            'direct once below --mode_threshold * (1 - hysteresis). Default 0.5.'))
+    parser.add_argument('--mode_cooldown', type=float, default=10,
+        help='Use with --broker and --adaptive. Minimum seconds between two switches of a topic. Default 10.')
+    parser.add_argument('-g', '--group', type=str, help=(
+        'Optional with --subscriber and --centralized. Join this consumer group: each message of '
+        'the subscriber\'s topics goes to one subscriber of the group instead of all of them'))
+    parser.add_argument('--group_credits', type=int, default=10,
+        help='Use with --group. Max messages per topic the broker sends ahead of processing. Default 10.')
+    parser.add_argument('--group_backlog', type=int, default=1000,
+        help=(
+            'Use with --broker and --centralized. Max messages per consumer group waiting for a '
+            'member with credits; the oldest are dropped beyond that. Default 1000.'))
+    parser.add_argument('-lv', '--last_value', action='store_true', help=(
+        'Use with --broker and --centralized (zone or edge brokers). Keep the newest message of '
+        'each topic and send it to new subscribers with their registration reply, so they have '
+        'data without waiting for the next publish'))
+    parser.add_argument('-ld', '--log_dir', type=str, help=(
+        'Use with --broker and --centralized (zone or edge brokers). Append every message to a '
+        'memory-mapped log per topic under this directory, which subscribers can replay'))
+    parser.add_argument('--log_segment_bytes', type=int, default=64 * 1024 * 1024,
+        help='Use with --log_dir. Size of each log segment file. Default 64 MiB.')
+    parser.add_argument('--log_retention_bytes', type=int,
+        help='Use with --log_dir. Drop the oldest segments of a topic\'s log beyond this size.')
+    parser.add_argument('--log_retention_seconds', type=float,
+        help='Use with --log_dir. Drop log segments whose newest message is older than this.')
+    parser.add_argument('--replay_batch', type=int, default=1000,
+        help='Use with --log_dir. Max number of logged messages per replay reply. Default 1000.')
+    parser.add_argument('-rp', '--replay', type=float, help=(
+        'Optional with --subscriber and --centralized. After registering, replay the messages of '
+        'the last REPLAY seconds from the broker\'s topic logs (brokers started with --log_dir)'))
+
     # Required with --publisher and --subscriber
     parser.add_argument('-t', '--topics', action='append',
         help=('if creating a pub or sub, provide list of topics to either publish or subscribe to.'
@@ -221,6 +361,63 @@ if __name__ == "__main__":
         help='(for use with -pub port on which to publish. If not provided with --pub, port 5556 used.')
     parser.add_argument('-s', '--sleep', type=float,
         help='Number of seconds to sleep between publish events. If not provided, 1 second used.')
+    parser.add_argument('-bs', '--batch_size', type=int, default=1,
+        help=(
+            'Optional with --publisher. Pack up to N events per topic into one message. '
+            'Default 1 (no batching).'))
+    parser.add_argument('-bl', '--batch_latency', type=int, default=1000,
+        help=(
+            'Optional with --publisher and --batch_size. Max number of microseconds an event '
+            'may wait in a batch before the batch is sent. Default 1000.'))
+    parser.add_argument('-comp', '--compression', choices=['zlib', 'lzma'],
+        help=(
+            'Optional with --publisher. Compress published history with this codec for every '
+            'topic whose subscribers all accept it.'))
+    parser.add_argument('-cl', '--compression_level', type=int, default=6,
+        help='Optional with --compression. zlib level / lzma preset (0-9). Default 6.')
+    parser.add_argument('-ct', '--compression_threshold', type=int, default=512,
+        help='Optional with --compression. Only compress messages of at least N bytes. Default 512.')
+    parser.add_argument('-shm', '--shared_memory', action='store_true',
+        help=(
+            'Optional with --publisher, or --broker and --centralized. Also write each topic to a '
+            'shared memory ring buffer; subscribers on the same host read from it instead of a socket.'))
+    parser.add_argument('--shm_slots', type=int, default=256,
+        help='Optional with --shared_memory. Number of messages each ring holds. Default 256.')
+    parser.add_argument('--shm_slot_size', type=int, default=16384,
+        help='Optional with --shared_memory. Max bytes per ring message. Default 16384.')
+    parser.add_argument('-codec', '--codecs', action='append', choices=['zlib', 'lzma', 'none'],
+        help=(
+            'Optional with --subscriber. Compression codec this subscriber accepts; repeat for '
+            'several. Pass --codecs none to refuse compression. Default: all codecs.'))
+    parser.add_argument('-pl', '--placement', choices=PLACEMENT_STRATEGIES, default='random',
+        help=(
+            'Optional with --publisher and --subscriber. How the client chooses its zone: random, '
+            'p2c (less loaded of two random zones), least_rtt (zone whose broker is fastest to '
+            'reach), rendezvous (hash of --client_name, or of the client\'s address and topics; '
+            'sticky across restarts) or topic_affine (zone owning most of the client\'s topics on '
+            'the topic ring). Default: random.'))
+    parser.add_argument('--client_name', type=str,
+        help=(
+            'Optional with --publisher and --subscriber. Name identifying this client across '
+            'restarts, used by --placement rendezvous. Default: the client\'s address and topics.'))
+    parser.add_argument('-pa', '--partitions', type=int, default=1,
+        help=(
+            'Optional with --publisher and --subscriber. Split each topic into this many partitions '
+            '(<topic>#0 .. <topic>#N-1) so several publishers can share it, each owning some of '
+            'the partitions. The first publisher of a topic fixes its count; later clients adopt it. '
+            'Default 1 (not partitioned).'))
+    parser.add_argument('--repair_buffer', type=int, default=1024,
+        help=(
+            'Optional with --publisher. Number of recent events per topic kept to resend to '
+            'subscribers that missed them. 0 disables repairs. Default 1024.'))
+    parser.add_argument('--repair_window', type=int, default=1000,
+        help=(
+            'Optional with --subscriber. Max number of missed events (the newest) requested from '
+            'their publisher per detected gap. 0 only counts losses. Default 1000.'))
+    parser.add_argument('--repair_timeout', type=int, default=500,
+        help='Optional with --subscriber. Milliseconds to wait for a repair reply before retrying. Default 500.')
+    parser.add_argument('--repair_retries', type=int, default=3,
+        help='Optional with --subscriber. Max repair requests per detected gap. Default 3.')
 
     #################################################################
     # Required with --broker
@@ -240,17 +437,34 @@ if __name__ == "__main__":
 
     # Optional with --broker (for ZooKeeper testing; auto kill a broker after
     # N seconds to trigger new leader election)
+    parser.add_argument('-e', '--edge', type=str,
+        help=(
+            'Optional with --broker (requires --centralized): run an edge broker of this name '
+            'instead of a zone broker, e.g. one per switch of a tree topology. Optional with '
+            '--subscriber (requires --centralized): register with the edge broker of this name '
+            'instead of a zone broker.'))
+    parser.add_argument('-ep', '--edge_parent', type=str,
+        help=(
+            'Optional with --broker and --edge. Name of the parent edge broker; if not passed, '
+            'the edge connects directly to the zone brokers.'))
+
     parser.add_argument('-ak', '--autokill', type=int, required=False,
         help=(
             'Optional with --broker. Auto kill a broker after N (--autokill N) seconds '
             '(to test leader election with multiple brokers)'))
 
+    parser.add_argument('-rb', '--registry_buckets', type=int, default=0,
+        help=(
+            'Use with --broker and --backup. If > 0, store the publishers/subscribers of each '
+            'topic in this many bucket znodes instead of one znode per client (for very large '
+            'numbers of clients). All brokers must use the same value.'))
+
     parser.add_argument('-clearzk', '--clear_zookeeper', action='store_true', required=False,
         help='utility to empty out the zookeeper znodes')
 
 
     # Load balancing
-    parser.add_argument('-thresh', '--load_threshold', type=int, default=3,
+    parser.add_argument('-thresh', '--load_threshold', type=float, default=3,
         help=(
             'threshold at which to promote one of the "extra" backup broker '
             'replicas to a primary, which is the same thing as auto-spinning '
@@ -261,6 +475,53 @@ if __name__ == "__main__":
             'pool of extra brokers with --backup'
         ))
 
+    parser.add_argument('-lw', '--load_weights', type=parse_load_weights, default=None,
+        help=(
+            'Use with --backup. Weighted policy for the system load compared to --load_threshold, '
+            'as comma separated metric=weight pairs over the metrics each zone reports: '
+            f'{", ".join(LOAD_METRICS)}. The load is the weighted sum over all zones divided by '
+            'the number of zones. Default: clients=1 (clients per zone). '
+            'Ex: clients=1,msgs_per_sec=0.01,cpu=5'))
+
+    # Autoscaling controller (see lib/autoscaler.py)
+    parser.add_argument('--scale_alpha', type=float, default=0.5,
+        help='Use with --backup. EWMA smoothing factor of the system load (0-1, higher reacts faster)')
+    parser.add_argument('--scale_horizon', type=float, default=10,
+        help='Use with --backup. Seconds ahead the load trend is extrapolated when deciding to add a zone')
+    parser.add_argument('--scale_cooldown', type=float, default=30,
+        help='Use with --backup. Minimum seconds between adding two zones')
+    parser.add_argument('--scale_hysteresis', type=float, default=0.2,
+        help=(
+            'Use with --backup. Once over --load_threshold, the system counts as overloaded until '
+            'the forecast load drops below threshold * (1 - hysteresis)'))
+    parser.add_argument('--max_new_zones', type=int, default=1,
+        help='Use with --backup. Maximum number of zones added per --scale_interval')
+    parser.add_argument('--scale_interval', type=float, default=60,
+        help='Use with --backup. Window in seconds for --max_new_zones')
+    parser.add_argument('--dry_run', action='store_true',
+        help='Use with --backup. Only log the scaling and rebalancing decisions, do not act on them')
+    parser.add_argument('--scale_in', action='store_true',
+        help=(
+            'Use with --backup. Retire the least loaded zone (migrating its clients to the other '
+            'zones) when the forecast load would stay below threshold * (1 - hysteresis) without it'))
+    parser.add_argument('--min_zones', type=int, default=1,
+        help='Use with --backup and --scale_in. Never retire zones below this number')
+    parser.add_argument('--rebalance_tolerance', type=int, default=2,
+        help=(
+            'Use with --backup. Migrate clients from the busiest to the idlest zone until zones '
+            'differ by at most this many clients. 0 disables rebalancing'))
+    parser.add_argument('--topic_affinity', action='store_true',
+        help=(
+            'Use with --backup. Rebalance by moving clients to the zone owning most of their topics '
+            'on the topic ring (see --placement topic_affine) instead of by client count'))
+    parser.add_argument('--rebalance_interval', type=float, default=10,
+        help='Use with --backup. Minimum seconds between two rebalancing rounds')
+
+    parser.add_argument('-li', '--load_interval', type=int, default=1000,
+        help=(
+            'Use with --broker and --backup. Minimum time in milliseconds between two writes '
+            'of a zone\'s load to ZooKeeper; registrations in between are coalesced.'))
+
     parser.add_argument('-ba', '--backup', action='store_true',
         help=(
             'create a BackupPool process that auto-creates new zones for load balancing '
@@ -316,6 +577,18 @@ if __name__ == "__main__":
             zookeeper_hosts=args.zookeeper_hosts,
             verbose=args.verbose,
             offered=args.history,
+            batch_size=args.batch_size,
+            batch_latency=args.batch_latency,
+            compression=args.compression,
+            compression_level=args.compression_level,
+            compression_threshold=args.compression_threshold,
+            shared_memory=args.shared_memory,
+            shm_slots=args.shm_slots,
+            shm_slot_size=args.shm_slot_size,
+            placement=args.placement,
+            partitions=args.partitions,
+            repair_buffer=args.repair_buffer,
+            name=args.client_name
             )
 
     elif args.subscriber:
@@ -334,6 +607,12 @@ if __name__ == "__main__":
                 'Cannot write to file (--filename) if using indefinite loop; file write only '
                 'happens at end of finite loop'
                 )
+        if (args.edge or args.adaptive or args.group) and not args.centralized:
+            raise argparse.ArgumentTypeError('--edge, --adaptive and --group require --centralized')
+        if args.replay and not args.centralized:
+            raise argparse.ArgumentTypeError('--replay requires --centralized')
+        if args.group and args.edge:
+            raise argparse.ArgumentTypeError('--group cannot be used with --edge')
         subscribers = create_subscribers(
             count=args.subscriber,
             filename=args.filename if args.filename else None,
@@ -344,31 +623,82 @@ if __name__ == "__main__":
             max_event_count=args.max_event_count if args.max_event_count else 15,
             zookeeper_hosts=args.zookeeper_hosts,
             verbose=args.verbose,
-            requested=args.history
+            requested=args.history,
+            codecs=[c for c in args.codecs if c != 'none'] if args.codecs else None,
+            placement=args.placement,
+            edge=args.edge,
+            adaptive=args.adaptive,
+            partitions=args.partitions,
+            group=args.group,
+            group_credits=args.group_credits,
+            replay_seconds=args.replay,
+            repair_window=args.repair_window,
+            repair_timeout=args.repair_timeout,
+            repair_retries=args.repair_retries,
+            name=args.client_name
             )
     if args.broker:
         if args.filename:
             raise argparse.ArgumentTypeError(
                 '--filename not a valid argument with --publisher type. only works with --subscriber'
                 )
-        if not args.zone:
-            raise Exception("the --zone/-zo argument is required with --broker")
         autokill = None
         if args.autokill:
             autokill = args.autokill
             logger.debug(f"Will autokill broker after {autokill} seconds", extra=driver_logging_prefix)
-        create_brokers(
-            centralized=args.centralized,
-            pub_reg_port=args.pub_reg_port,
-            sub_reg_port=args.sub_reg_port,
-            indefinite=args.indefinite,
-            max_event_count=args.max_event_count if args.max_event_count else 15,
-            autokill=autokill,
-            zookeeper_hosts=args.zookeeper_hosts,
-            verbose=args.verbose,
-            primary=args.primary,
-            zone=args.zone
-        )
+        if args.edge:
+            if not args.centralized:
+                raise argparse.ArgumentTypeError('--edge requires --centralized')
+            create_edge_broker(
+                name=args.edge,
+                parent=args.edge_parent,
+                indefinite=args.indefinite,
+                sub_reg_port=args.sub_reg_port,
+                max_event_count=args.max_event_count if args.max_event_count else 15,
+                autokill=autokill,
+                zookeeper_hosts=args.zookeeper_hosts,
+                verbose=args.verbose,
+                registry_buckets=args.registry_buckets,
+                last_value=args.last_value,
+                log_dir=args.log_dir,
+                log_segment_bytes=args.log_segment_bytes,
+                log_retention_bytes=args.log_retention_bytes,
+                log_retention_seconds=args.log_retention_seconds,
+                replay_batch=args.replay_batch
+            )
+        elif not args.zone:
+            raise Exception("the --zone/-zo argument is required with --broker")
+        elif (args.adaptive or args.last_value or args.log_dir) and not args.centralized:
+            raise argparse.ArgumentTypeError('--adaptive, --last_value and --log_dir require --centralized')
+        else:
+            create_brokers(
+                centralized=args.centralized,
+                pub_reg_port=args.pub_reg_port,
+                sub_reg_port=args.sub_reg_port,
+                indefinite=args.indefinite,
+                max_event_count=args.max_event_count if args.max_event_count else 15,
+                autokill=autokill,
+                zookeeper_hosts=args.zookeeper_hosts,
+                verbose=args.verbose,
+                primary=args.primary,
+                zone=args.zone,
+                registry_buckets=args.registry_buckets,
+                load_interval=args.load_interval,
+                adaptive=args.adaptive,
+                mode_threshold=args.mode_threshold,
+                mode_hysteresis=args.mode_hysteresis,
+                mode_cooldown=args.mode_cooldown,
+                group_backlog=args.group_backlog,
+                last_value=args.last_value,
+                log_dir=args.log_dir,
+                log_segment_bytes=args.log_segment_bytes,
+                log_retention_bytes=args.log_retention_bytes,
+                log_retention_seconds=args.log_retention_seconds,
+                replay_batch=args.replay_batch,
+                shared_memory=args.shared_memory,
+                shm_slots=args.shm_slots,
+                shm_slot_size=args.shm_slot_size
+            )
 
     if args.clear_zookeeper:
         if len(args.zookeeper_hosts) == 0:
@@ -389,6 +719,37 @@ if __name__ == "__main__":
             max_event_count=args.max_event_count if args.max_event_count else 15,
             verbose=args.verbose,
             threshold=args.load_threshold,
+            registry_buckets=args.registry_buckets,
+            load_interval=args.load_interval,
+            load_weights=args.load_weights,
+            autoscaling={
+                'alpha': args.scale_alpha,
+                'horizon': args.scale_horizon,
+                'cooldown': args.scale_cooldown,
+                'hysteresis': args.scale_hysteresis,
+                'max_new_zones': args.max_new_zones,
+                'interval': args.scale_interval
+            },
+            dry_run=args.dry_run,
+            rebalance_tolerance=args.rebalance_tolerance,
+            rebalance_interval=args.rebalance_interval,
+            scale_in=args.scale_in,
+            min_zones=args.min_zones,
+            topic_affinity=args.topic_affinity,
+            adaptive=args.adaptive,
+            mode_threshold=args.mode_threshold,
+            mode_hysteresis=args.mode_hysteresis,
+            mode_cooldown=args.mode_cooldown,
+            group_backlog=args.group_backlog,
+            last_value=args.last_value,
+            log_dir=args.log_dir,
+            log_segment_bytes=args.log_segment_bytes,
+            log_retention_bytes=args.log_retention_bytes,
+            log_retention_seconds=args.log_retention_seconds,
+            replay_batch=args.replay_batch,
+            shared_memory=args.shared_memory,
+            shm_slots=args.shm_slots,
+            shm_slot_size=args.shm_slot_size
         )
         backup_pool.watch_system_load()
         backup_pool.wait_for_trigger()
\ No newline at end of file
@@ -0,0 +1,117 @@
+""" Autoscaling controller used by the BackupPool to decide when to add or retire zones.
+
+The system load is smoothed with Holt's linear (double exponential) smoothing: an EWMA of
+the load level plus an EWMA of its trend (load change per second). Decisions are taken on
+the load forecast `horizon` seconds ahead, so new zones come up before the threshold is
+actually crossed (a falling trend is not extrapolated). Flapping is prevented by:
+- hysteresis: overload starts when the forecast exceeds `threshold` and only ends once it
+  falls below threshold * (1 - hysteresis); in between, the previous state is kept
+- a cooldown of `cooldown` seconds after each scale out
+- a cap of `max_new_zones` new zones per `interval` seconds
+
+A zone is only retired (scale in) if the forecast would stay below the hysteresis band even
+with one zone less, i.e. forecast * zones / (zones - 1) < threshold * (1 - hysteresis), so a
+retirement never causes a scale out by itself. The cooldown applies to both directions, and
+also after the first observation so zones are not retired before clients had time to join.
+
+The controller is pure (times are passed in) so it can be tested without ZooKeeper.
+"""
+
+
+class AutoscalingController:
+    def __init__(self, threshold, alpha=0.5, beta=0.3, horizon=10, cooldown=30,
+        hysteresis=0.2, max_new_zones=1, interval=60):
+        """
+        Args:
+        - threshold (float) - load (see BackupPool.get_current_load) above which to scale out
+        - alpha (float) - smoothing factor of the load level (0-1, higher reacts faster)
+        - beta (float) - smoothing factor of the load trend (0-1)
+        - horizon (float) - how many seconds ahead to forecast the load
+        - cooldown (float) - min seconds between two scale outs
+        - hysteresis (float) - fraction below threshold the forecast must drop to end overload
+        - max_new_zones (int) - max scale outs per interval
+        - interval (float) - seconds over which max_new_zones applies
+        """
+        self.threshold = threshold
+        self.alpha = alpha
+        self.beta = beta
+        self.horizon = horizon
+        self.cooldown = cooldown
+        self.hysteresis = hysteresis
+        self.max_new_zones = max_new_zones
+        self.interval = interval
+        self.level = None
+        self.trend = 0
+        self.observed = None
+        self.overloaded = False
+        self.first_observed = None
+        # Times of past scale outs and of the last scale in
+        self.scale_outs = []
+        self.scaled_in = None
+
+    def observe(self, load, now):
+        """ Feed a new load sample taken at time now (seconds); returns the forecast """
+        if self.level is None:
+            self.level = load
+            self.first_observed = now
+        else:
+            elapsed = max(now - self.observed, 1e-3)
+            previous = self.level
+            self.level = self.alpha * load + (1 - self.alpha) * (previous + self.trend * elapsed)
+            self.trend = self.beta * (self.level - previous) / elapsed + (1 - self.beta) * self.trend
+        self.observed = now
+        forecast = self.forecast()
+        if forecast > self.threshold:
+            self.overloaded = True
+        elif forecast < self.threshold * (1 - self.hysteresis):
+            self.overloaded = False
+        return forecast
+
+    def forecast(self):
+        if self.level is None:
+            return 0
+        return self.level + max(self.trend, 0) * self.horizon
+
+    def decide(self, now):
+        """ Whether to add a zone now
+        Returns: (bool, str reason) """
+        forecast = self.forecast()
+        if not self.overloaded:
+            return False, f'forecast load {forecast:.2f} within threshold {self.threshold}'
+        if self.cooling_down(now):
+            return False, f'forecast load {forecast:.2f} over threshold, but cooling down'
+        recent = [t for t in self.scale_outs if now - t < self.interval]
+        if len(recent) >= self.max_new_zones:
+            return False, (
+                f'forecast load {forecast:.2f} over threshold, but {len(recent)} zones '
+                f'already added in the last {self.interval}s')
+        return True, f'forecast load {forecast:.2f} over threshold {self.threshold}'
+
+    def decide_scale_in(self, now, num_zones, min_zones=1):
+        """ Whether to retire one of num_zones zones now
+        Returns: (bool, str reason) """
+        if num_zones <= min_zones:
+            return False, f'{num_zones} zones, not retiring below {min_zones}'
+        if self.level is None:
+            return False, 'no load observed yet'
+        forecast = self.forecast()
+        remaining = forecast * num_zones / (num_zones - 1)
+        low = self.threshold * (1 - self.hysteresis)
+        if self.overloaded or remaining >= low:
+            return False, (
+                f'forecast load {forecast:.2f} would be {remaining:.2f} with one zone less, '
+                f'not under {low:.2f}')
+        if self.cooling_down(now) or now - self.first_observed < self.cooldown:
+            return False, f'forecast load {forecast:.2f} under {low:.2f}, but cooling down'
+        return True, f'forecast load {forecast:.2f} would be {remaining:.2f} with one zone less'
+
+    def cooling_down(self, now):
+        """ Whether the last scale out or scale in was less than cooldown seconds ago """
+        events = self.scale_outs[-1:] + ([self.scaled_in] if self.scaled_in is not None else [])
+        return bool(events) and now - max(events) < self.cooldown
+
+    def record_scale_out(self, now):
+        self.scale_outs = [t for t in self.scale_outs if now - t < self.interval] + [now]
+
+    def record_scale_in(self, now):
+        self.scaled_in = now
@@ -1,11 +1,26 @@
 """
 Create this first. Backup pool of dormant brokers that automatically promote themselves to
 leaders of new zones when load threshold (--load_threshold) is exceeded by current
-system load read from a Zookeeper Znode (shared by all brokers for current load status updates
-via watch mechanism). Backup pool brokers are not initially assigned a zone.
+system load, aggregated from the per-zone load znodes (/shared_state/load/zone_<n>) each
+primary broker writes (via watch mechanism). Backup pool brokers are not initially assigned a zone.
+
+The pool also keeps zones balanced: clients are moved from busy to idle zones by writing
+/migrations/<client id> = {'zone': <target zone>, ...}, which clients watch (see
+Publisher.migrate_to_zone). With scale_in, the least loaded zone is retired when the load
+allows it: /retirements/zone_<n> is created, its clients are migrated away, and its broker
+leaves once the zone is drained (see Broker.retire).
+
+With topic_affinity, clients are instead moved to the zone owning most of their topics on the
+topic ring (see placement.py), which keeps each topic on one broker as zones come and go.
 """
 from .broker import Broker
 from .zookeeper_client import ZookeeperClient
+from .autoscaler import AutoscalingController
+from .placement import (
+    plan_rebalance, plan_drain, plan_affinity, select_idle_zone, ConsistentHashRing,
+    TOPIC_ZONES_ZNODE, remove_ring_zone)
+from kazoo.exceptions import NoNodeError
+import threading
 import zmq
 import json
 import random
@@ -14,9 +29,35 @@ import pickle
 import netifaces
 import sys
 import time
+# Metrics each zone reports in /shared_state/load/zone_<n> (see Broker.get_zone_load)
+LOAD_METRICS = ['clients', 'msgs_per_sec', 'bytes_per_sec', 'cpu', 'backlog']
+
+
+def weighted_load(zone_loads, weights, num_zones):
+    """ System load under a weighted policy: sum over all zones of the weighted metrics,
+    divided by the number of zones. With the default weights {'clients': 1} this is the
+    number of clients per zone.
+    Args:
+    - zone_loads (dict) - {zone: {metric: value}}
+    - weights (dict) - {metric: weight}
+    - num_zones (int) """
+    if not num_zones:
+        return 0
+    total = 0
+    for load in zone_loads.values():
+        total += sum(weight * load.get(metric, 0) for metric, weight in weights.items())
+    return total / num_zones
+
+
 class BackupPool(ZookeeperClient):
     def __init__(self, zookeeper_hosts=['127.0.0.1:2181'], centralized=False, indefinite=False,
-        max_event_count=15, verbose=False, threshold=3):
+        max_event_count=15, verbose=False, threshold=3, registry_buckets=0,
+        load_interval=1000, load_weights=None, autoscaling=None, dry_run=False,
+        rebalance_tolerance=2, rebalance_interval=10, scale_in=False, min_zones=1,
+        topic_affinity=False, adaptive=False, mode_threshold=200, mode_hysteresis=0.5,
+        mode_cooldown=10, group_backlog=1000, last_value=False, log_dir=None, log_segment_bytes=64 * 1024 * 1024,
+        log_retention_bytes=None, log_retention_seconds=None, replay_batch=1000,
+        shared_memory=False, shm_slots=256, shm_slot_size=16384):
         super().__init__(zookeeper_hosts=zookeeper_hosts, verbose=verbose)
         self.verbose = verbose
         self.zookeeper_hosts_arg = zookeeper_hosts
@@ -25,6 +66,49 @@ class BackupPool(ZookeeperClient):
         self.max_event_count = max_event_count
         self.centralized = centralized
         self.indefinite = indefinite
+        self.registry_buckets = registry_buckets
+        self.load_interval = load_interval
+        # Adaptive dissemination, consumer groups, last value cache and topic logs of the
+        # brokers (see Broker)
+        self.adaptive = adaptive
+        self.mode_threshold = mode_threshold
+        self.mode_hysteresis = mode_hysteresis
+        self.mode_cooldown = mode_cooldown
+        self.group_backlog = group_backlog
+        self.last_value = last_value
+        self.log_dir = log_dir
+        self.log_segment_bytes = log_segment_bytes
+        self.log_retention_bytes = log_retention_bytes
+        self.log_retention_seconds = log_retention_seconds
+        self.replay_batch = replay_batch
+        # Shared memory rings of the brokers' topics (see Broker)
+        self.shared_memory = shared_memory
+        self.shm_slots = shm_slots
+        self.shm_slot_size = shm_slot_size
+        # Weight of each zone metric (LOAD_METRICS) in the system load compared to --load_threshold
+        self.load_weights = load_weights or {'clients': 1}
+        # Decides when to add zones from the load forecast. autoscaling holds optional
+        # AutoscalingController settings (alpha, beta, horizon, cooldown, hysteresis, ...)
+        self.autoscaler = AutoscalingController(threshold=threshold, **(autoscaling or {}))
+        self.autoscale_lock = threading.Lock()
+        # Only log scaling decisions, don't act on them
+        self.dry_run = dry_run
+        # Clients are migrated once zones differ by more than this many clients (0: never)
+        self.rebalance_tolerance = rebalance_tolerance
+        # Min seconds between two rebalancing rounds; migrations pending for longer are dropped
+        self.rebalance_interval = rebalance_interval
+        self.rebalanced = 0
+        # Place clients by topic (topic ring) rather than by client count
+        self.topic_affinity = topic_affinity
+        # Retire the least loaded zone when the others can take its load, keeping min_zones
+        self.scale_in = scale_in
+        self.min_zones = min_zones
+        # Zone numbers of brokers spun up whose zone has not reported its load yet
+        self.pending_zones = set()
+        # Latest load of each zone: {zone_<n>: {'clients': int, 'msgs_per_sec': float, ...}}
+        self.zone_loads = {}
+        # Functions stopping the watch on each zone's load znode
+        self.zone_load_watches = {}
         self.set_logger()
         self.connect_zk()
         self.start_session()
@@ -32,65 +116,282 @@ class BackupPool(ZookeeperClient):
 
     def setup_current_load_znode(self):
         ## Assume this service is created FIRST.
-        self.zk.ensure_path('/shared_state/')
         self.current_load_znode = "/shared_state/current_load/"
-        if not self.znode_exists(self.current_load_znode):
-            self.create_znode(
-                znode_name=self.current_load_znode,
-                znode_value=0
-            )
+        self.create_znodes([
+            ("/shared_state", "container of shared state among primary brokers"),
+            ("/shared_state/load", "shared state container of the load of each zone"),
+            (self.current_load_znode, 0),
+            ("/migrations", "container of pending client migrations between zones"),
+            ("/retirements", "container of zones retired by the backup pool")
+        ])
 
     def wait_for_trigger(self):
         while True:
             time.sleep(0.5)
+            # Decisions held back by the cooldown are taken even if no zone writes its load
+            self.evaluate_capacity()
+            self.rebalance()
+
+    def get_current_load(self):
+        """ Current system load: weighted metrics of all zones / number of zones. Zones
+        being spun up already count, so a burst of load writes doesn't add duplicate zones. """
+        zones = set(self.get_znode_children("/primaries"))
+        zones |= {f'zone_{zone}' for zone in self.pending_zones}
+        return weighted_load(self.zone_loads, self.load_weights, len(zones))
+
+    def evaluate_capacity(self):
+        """ Feed the current load to the autoscaling controller and add a zone if it decides so """
+        with self.autoscale_lock:
+            now = time.time()
+            current_load = self.get_current_load()
+            forecast = self.autoscaler.observe(current_load, now)
+            scale_out, reason = self.autoscaler.decide(now)
+            self.debug(f'Load {current_load:.2f}, forecast {forecast:.2f}: {reason}')
+            if not scale_out:
+                if self.scale_in:
+                    self.evaluate_scale_in(now)
+                return
+            new_zone = self.get_new_zone_number()
+            self.autoscaler.record_scale_out(now)
+            if self.dry_run:
+                self.info(f'Dry run: would add zone_{new_zone} ({reason})')
+                return
+            self.info(f'Need more capacity! Adding zone_{new_zone} ({reason})')
+            self.pending_zones.add(new_zone)
+        # The new broker runs its election and event loop in its own thread
+        threading.Thread(target=self.spin_up_new_broker, args=(new_zone,), daemon=True).start()
+
+    def evaluate_scale_in(self, now):
+        """ Retire the least loaded zone if the autoscaling controller decides the other zones
+        can take its load. Zones are retired one at a time, and not while zones are being added. """
+        zones = set(self.get_znode_children("/primaries"))
+        if self.pending_zones or zones & set(self.get_retired_zones()):
+            return
+        scale_in, reason = self.autoscaler.decide_scale_in(now, len(zones), self.min_zones)
+        if not scale_in:
+            return
+        zone = select_idle_zone({
+            zone: weighted_load({zone: self.zone_loads.get(zone, {})}, self.load_weights, 1)
+            for zone in zones
+        })
+        self.autoscaler.record_scale_in(now)
+        if self.dry_run:
+            self.info(f'Dry run: would retire {zone} ({reason})')
+            return
+        self.info(f'Load is low, retiring {zone} ({reason})')
+        # Clients choosing a zone skip retired zones from now on, and its topics move to other zones
+        self.create_znode(znode_name=f'/retirements/{zone}', znode_value=json.dumps({'time': now}))
+        self.update_json_znode(TOPIC_ZONES_ZNODE, lambda ring: remove_ring_zone(ring, zone))
+        self.write_migrations(self.plan_drains(zones, {zone}, pending={}), now)
+
+    def get_zone_clients(self, zones):
+        """ Clients registered in each zone, from /shared_state/zones/zone_<n>/{publishers,subscribers}
+        Returns: {zone: [client ids]} """
+        zone_clients = {}
+        for zone in zones:
+            try:
+                zone_clients[zone] = (
+                    self.get_znode_children(f'/shared_state/zones/{zone}/publishers')
+                    + self.get_znode_children(f'/shared_state/zones/{zone}/subscribers'))
+            except NoNodeError:
+                # Zone retired meanwhile
+                pass
+        return zone_clients
 
-    def need_more_capacity(self):
-        current_load = self.get_znode_value(znode_name=self.current_load_znode)
-        return float(current_load) > self.threshold
+    def get_zone_client_topics(self, zones):
+        """ Topics of the clients registered in each zone, from their shared state znodes
+        Returns: {zone: {client id: [topics]}} """
+        znodes = []
+        for zone in zones:
+            for kind in ['publishers', 'subscribers']:
+                try:
+                    znodes += [
+                        f'/shared_state/zones/{zone}/{kind}/{client_id}'
+                        for client_id in self.get_znode_children(f'/shared_state/zones/{zone}/{kind}')]
+                except NoNodeError:
+                    pass
+        client_topics = {zone: {} for zone in zones}
+        for znode, value in self.get_znode_values(znodes).items():
+            if value:
+                zone, kind, client_id = znode.split('/')[3:]
+                client_topics[zone][client_id] = json.loads(value)['topics']
+        return client_topics
+
+    def plan_drains(self, zones, retiring, pending):
+        """ Moves emptying retiring zones, skipping clients with a pending migration. With
+        topic_affinity, clients go to the zone owning their topics (retiring zones are no
+        longer on the topic ring), otherwise to the least loaded remaining zone. """
+        if not retiring:
+            return []
+        active = zones - retiring
+        if self.topic_affinity:
+            ring = ConsistentHashRing.from_znode(self.get_znode_value(TOPIC_ZONES_ZNODE))
+            client_topics = self.get_zone_client_topics(zones)
+            moves = plan_affinity(
+                {zone: clients if zone in retiring else {} for zone, clients in client_topics.items()}, ring)
+            # Clients whose topics have no active owner are drained by count
+            moved = {client for client, source, target in moves}
+            zone_clients = {
+                zone: [client for client in clients if zone not in retiring or client not in moved]
+                for zone, clients in client_topics.items()
+            }
+        else:
+            moves = []
+            zone_clients = self.get_zone_clients(zones)
+        for zone in retiring:
+            drain = {z: ids for z, ids in zone_clients.items() if z == zone or z in active}
+            moves += plan_drain(drain, zone)
+        return [move for move in moves if move[0] not in pending]
+
+    def get_pending_migrations(self, now):
+        """ Migrations clients have not carried out yet. Those pending for longer than
+        rebalance_interval (client gone or stuck) are deleted and can be planned again.
+        Returns: {client id: migration} """
+        try:
+            client_ids = self.get_znode_children("/migrations")
+        except NoNodeError:
+            return {}
+        pending = {}
+        for client_id, value in self.get_znode_values([f'/migrations/{c}' for c in client_ids]).items():
+            if value is None:
+                continue
+            client_id = client_id.rsplit('/', 1)[1]
+            migration = json.loads(value)
+            if now - migration['time'] > self.rebalance_interval:
+                self.debug(f'Giving up migration of {client_id} to {migration["zone"]}')
+                self.delete_znode(znode_name=f'/migrations/{client_id}')
+            else:
+                pending[client_id] = migration
+        return pending
+
+    def write_migrations(self, moves, now):
+        """ Ask clients to move to another zone
+        Args:
+        - moves (list) - (client id, from zone, to zone) tuples, see placement.py
+        - now (float) - time.time() of the plan """
+        for client_id, source, target in moves:
+            self.info(f'Migrating client {client_id} from {source} to {target}')
+        self.create_znodes([
+            (f'/migrations/{client_id}', json.dumps({'zone': target, 'from': source, 'time': now}))
+            for client_id, source, target in moves
+        ])
+
+    def rebalance(self):
+        """ Every rebalance_interval seconds, move the remaining clients out of retired zones
+        and even out the number of clients per zone (within rebalance_tolerance), or with
+        topic_affinity, move clients to the zone owning their topics. Zones are
+        only rebalanced once all previous migrations are done, so clients in flight are not
+        counted twice. """
+        now = time.time()
+        if now - self.rebalanced < self.rebalance_interval:
+            return
+        self.rebalanced = now
+        with self.autoscale_lock:
+            pending = self.get_pending_migrations(now)
+            zones = set(self.get_znode_children("/primaries"))
+            retiring = zones & set(self.get_retired_zones())
+            moves = self.plan_drains(zones, retiring, pending)
+            if self.topic_affinity and not pending:
+                moves += plan_affinity(
+                    self.get_zone_client_topics(zones - retiring),
+                    ConsistentHashRing.from_znode(self.get_znode_value(TOPIC_ZONES_ZNODE)))
+            elif self.rebalance_tolerance and not pending:
+                zone_clients = self.get_zone_clients(zones - retiring)
+                moves += plan_rebalance(zone_clients, self.rebalance_tolerance)
+            if not moves:
+                return
+            if self.dry_run:
+                self.info(f'Dry run: would migrate {moves}')
+                return
+            self.write_migrations(moves, now)
 
     def get_new_zone_number(self):
-        zones = self.zk.get_children("/primaries")
-        max_current_zone_num = 0
+        zones = self.get_znode_children("/primaries")
+        max_current_zone_num = max(self.pending_zones, default=0)
         for z in zones:
             zone_num = int(z.split("_")[1])
             if zone_num > max_current_zone_num:
                 max_current_zone_num = zone_num
         return max_current_zone_num + 1
 
-    def spin_up_new_broker(self):
-        self.debug('Spinning up a new broker!')
-        new_zone = self.get_new_zone_number()
-        broker = Broker(
+    def create_broker(self, zone):
+        """ Broker for a new zone, with the settings this pool was given for its brokers """
+        return Broker(
             centralized=self.centralized,
             indefinite=self.indefinite,
             max_event_count=self.max_event_count,
             zookeeper_hosts=self.zookeeper_hosts_arg,
             verbose=self.verbose,
-            zone=new_zone
+            zone=zone,
+            registry_buckets=self.registry_buckets,
+            load_interval=self.load_interval,
+            adaptive=self.adaptive,
+            mode_threshold=self.mode_threshold,
+            mode_hysteresis=self.mode_hysteresis,
+            mode_cooldown=self.mode_cooldown,
+            group_backlog=self.group_backlog,
+            last_value=self.last_value,
+            log_dir=self.log_dir,
+            log_segment_bytes=self.log_segment_bytes,
+            log_retention_bytes=self.log_retention_bytes,
+            log_retention_seconds=self.log_retention_seconds,
+            replay_batch=self.replay_batch,
+            shared_memory=self.shared_memory,
+            shm_slots=self.shm_slots,
+            shm_slot_size=self.shm_slot_size
         )
+
+    def spin_up_new_broker(self, new_zone=None):
+        self.debug('Spinning up a new broker!')
+        if new_zone is None:
+            new_zone = self.get_new_zone_number()
+        # Zone numbers of retired zones are reused
+        if self.znode_exists(znode_name=f'/retirements/zone_{new_zone}'):
+            self.delete_znode(znode_name=f'/retirements/zone_{new_zone}')
+        broker = self.create_broker(new_zone)
         # Create a new zone managed by this new primary broker
-        broker.connect_zk()
-        broker.start_session()
-        broker.setup_fault_tolerance_znode()
-        broker.setup_shared_state_znode()
-        broker.setup_load_balancing_znode()
-        broker.watch_shared_state_publishers()
-        broker.watch_shared_state_subscribers()
-        # FIXME: this is going to block! Will this spin up only work for one broker?
-        self.debug(f'Running election for new broker {id(broker)}')
-        broker.zk_run_election()
+        try:
+            broker.connect_zk()
+            broker.start_session()
+            broker.setup_fault_tolerance_znode()
+            broker.setup_shared_state_znode()
+            broker.setup_load_balancing_znode()
+            # Blocks (election, then the broker's event loop); runs in its own thread
+            self.debug(f'Running election for new broker {id(broker)}')
+            broker.zk_run_election()
+        except Exception as e:
+            self.error(f'Broker for zone_{new_zone} failed: {e}')
+            self.pending_zones.discard(new_zone)
 
     def watch_system_load(self):
-        @self.zk.DataWatch(self.current_load_znode)
-        def dump_data_change (data, stat, event):
-            if not event:
-                pass
-            elif event.type == 'CHANGED':
-                # Load has been updated by a broker
-                self.debug('System load has changed!')
-                if self.need_more_capacity():
-                    self.debug('Need more capacity!')
-                    self.spin_up_new_broker()
+        """ Watch the load znode of every zone; brokers write them at most once per
+        --load_interval, so this wakes up at a rate bounded by time, not client churn """
+        self.watch_children_coalesced('/shared_state/load', self.reconcile_zones)
+
+    def reconcile_zones(self, zones):
+        """ Start/stop watching load znodes as zones come and go """
+        for zone in set(zones) - set(self.zone_load_watches):
+            # A zone being spun up is no longer pending once it reports its load
+            self.pending_zones.discard(int(zone.split('_')[1]))
+            self.zone_load_watches[zone] = self.watch_data_coalesced(
+                f'/shared_state/load/{zone}',
+                lambda value, zone=zone: self.update_zone_load(zone, value)
+            )
+        for zone in set(self.zone_load_watches) - set(zones):
+            self.zone_load_watches.pop(zone)()
+            self.zone_loads.pop(zone, None)
+
+    def update_zone_load(self, zone, value):
+        """ Record a zone's new load, publish the aggregate to /shared_state/current_load
+        and add capacity if needed """
+        if value is None:
+            self.zone_loads.pop(zone, None)
+            return
+        self.zone_loads[zone] = json.loads(value)
+        # Load has been updated by a broker
+        self.debug('System load has changed!')
+        self.modify_znode_value(znode_name=self.current_load_znode, znode_value=self.get_current_load())
+        self.evaluate_capacity()
 
     def debug(self, msg):
         self.logger.debug(msg, extra=self.prefix)
@@ -2,24 +2,46 @@
 Message Broker to serve as anonymizing middleware between
 publishers and subscribers
 """
-from .zookeeper_client import ZookeeperClient
+from .zookeeper_client import ZookeeperClient, bucket_index
+from .placement import TOPIC_ZONES_ZNODE, add_ring_zone, remove_ring_zone
+from .dissemination import TopicModeSelector, CENTRALIZED, DIRECT
+from .consumer_groups import ConsumerGroup, ACK
+from .topic_log import TopicLog, topic_directory
+from .shm_ring import ShmRingWriter
+from kazoo.exceptions import NoNodeError
+from . import message
+from . import transport
 import zmq
 import json
 import random
 import logging
-import pickle
 import netifaces
 import sys
 import time
 
+# How long the event loop waits for a subscriber to confirm a topic mode switch, in ms
+SWITCH_CONFIRM_TIMEOUT_MS = 1000
+
 class Broker(ZookeeperClient):
     def __init__(self, centralized=False, indefinite=False, max_event_count=15,
         zookeeper_hosts=['127.0.0.1:2181'], pub_reg_port=5555, sub_reg_port=5556, autokill=None,
-        verbose=False, zone=1, primary=False ):
+        verbose=False, zone=1, primary=False, registry_buckets=0, load_interval=1000,
+        adaptive=False, mode_threshold=200, mode_hysteresis=0.5, mode_cooldown=10, group_backlog=1000,
+        last_value=False, log_dir=None, log_segment_bytes=64 * 1024 * 1024, log_retention_bytes=None,
+        log_retention_seconds=None, replay_batch=1000, shared_memory=False, shm_slots=256,
+        shm_slot_size=16384):
         self.zone = zone
         self.primary = primary # alternative is backup
         self.verbose = verbose
         self.centralized = centralized
+        # Adaptive dissemination (with centralized): each topic is either sent through this
+        # broker or directly by its publishers, whichever is cheaper (see dissemination.py).
+        # Subscribers get notify sockets like with decentralized dissemination, over which
+        # they are told to switch.
+        self.adaptive = adaptive
+        self.mode_selector = TopicModeSelector(
+            threshold=mode_threshold, hysteresis=mode_hysteresis, cooldown=mode_cooldown)
+        self.modes_evaluated = 0
         self.prefix = {'prefix': f'BROKER({id(self)}'}
         self.set_logger()
         self.autokill_time = None
@@ -69,9 +91,98 @@ class Broker(ZookeeperClient):
         self.receive_socket_dict = {}
         self.send_socket_dict = {}
         self.send_port_dict = {}
+        # Endpoints (tcp, ipc, inproc) each topic's send socket is bound to
+        self.send_endpoints_dict = {}
+        # Endpoints each topic's receive socket is connected to
+        self.receive_endpoints_dict = {}
         self.used_ports = []
+
+        # Federation with the brokers of other zones (centralized dissemination, see
+        # setup_federation_binding): the PUB socket this broker republishes its local
+        # publishers' messages on, the SUB socket connected to the other brokers' PUB sockets,
+        # the other zones' PUB endpoints as advertised in /shared_state/federation ({zone:
+        # endpoint}, updated by watches), the endpoints connected and the topics subscribed
+        self.federation_socket = None
+        self.federation_sub = None
+        self.federation_endpoint = None
+        self.federation_peers = {}
+        self.federation_connected = {}
+        self.federation_topics = set()
+        self.federation_watches = {}
         self.zone = zone
 
+        # Consumer groups (centralized dissemination, see consumer_groups.py): the ROUTER
+        # socket group members connect to, its tcp port and endpoints,
+        # {topic: {group name: ConsumerGroup}} and {subscriber id: group name}
+        self.group_socket = None
+        self.group_port = None
+        self.group_endpoints = None
+        self.group_backlog = group_backlog
+        self.consumer_groups = {}
+        self.group_members = {}
+
+        # Last-value cache (centralized dissemination): if last_value, the newest message of
+        # each topic ({topic: frames}), sent to new subscribers with their registration reply
+        # so they have data before the next publish
+        self.last_value = last_value
+        self.last_values = {}
+
+        # Topic logs (centralized dissemination, see topic_log.py): if log_dir, every message
+        # this broker receives is appended to its topic's log under log_dir, which subscribers
+        # can replay through the subscriber registration socket. {topic: TopicLog}; logs are
+        # flushed and retention enforced every load_interval ms.
+        self.log_dir = log_dir
+        self.log_segment_bytes = log_segment_bytes
+        self.log_retention_bytes = log_retention_bytes
+        self.log_retention_seconds = log_retention_seconds
+        self.replay_batch = replay_batch
+        self.topic_logs = {}
+        self.logs_maintained = 0
+
+        # Shared memory rings (centralized dissemination, see shm_ring.py): if shared_memory,
+        # each topic's send socket also gets a ring ({topic: ShmRingWriter}), advertised with
+        # the socket's endpoints, which subscribers on this host read instead of the socket.
+        # The rings and their doorbells get their own ZMQ context, as in Publisher.
+        self.shared_memory = shared_memory
+        self.shm_slots = shm_slots
+        self.shm_slot_size = shm_slot_size
+        self.shm_context = None
+        self.shm_rings = {}
+
+        # Clients registered with this broker:
+        # {id: {'kind': 'publishers' or 'subscribers', 'topics': [...]}}
+        self.local_clients = {}
+        # If > 0, the clients of each topic are hashed into this many bucket znodes
+        # (/shared_state/topics/<topic>/<kind>/bucket_<n>, JSON {id: info}) instead of one
+        # znode per client. Must be the same for all brokers.
+        self.registry_buckets = registry_buckets
+        # Changes to local clients are written to this zone's interest summary and load
+        # znodes at most once every load_interval ms (see flush_zone_summary)
+        self.load_interval = load_interval
+        self.zone_summary_dirty = False
+        self.zone_summary_written = 0
+        # Load metrics of this zone as last written, and the counters they are sampled from
+        self.zone_metrics = {'msgs_per_sec': 0, 'bytes_per_sec': 0, 'cpu': 0, 'backlog': 0}
+        self.metrics_sampled = time.time()
+        # CPU time of the event loop thread at the last sample, None until the first one
+        # (the broker may be built on another thread than the one that runs it)
+        self.metrics_cpu_time = None
+        self.forwarded_msgs = 0
+        self.forwarded_bytes = 0
+        self.backlog_total = 0
+        self.backlog_samples = 0
+        # Topics used by local clients, whose shared state this broker watches:
+        # {topic: [functions that stop its publishers/subscribers watches]}
+        self.topic_watches = {}
+
+        # Largest history requested and codecs accepted by every subscriber, per topic,
+        # as last written to /shared_state/topic_demand/<topic>
+        self.topic_demand = {}
+
+        # Set once the backup pool retires this zone (/retirements/zone_<n>): the broker
+        # leaves once all clients of the zone migrated away (see retire)
+        self.retiring = False
+
         # Initialize configuration for ZooKeeper client
         super().__init__(zookeeper_hosts=zookeeper_hosts, verbose=verbose)
 
@@ -147,96 +258,228 @@ class Broker(ZookeeperClient):
 
     def setup_load_balancing_znode(self):
         self.debug("initializing /primaries/ znode if not exists")
-        if not self.znode_exists(znode_name="/primaries"):
-            self.create_znode(znode_name="/primaries", znode_value="container of all primary brokers")
+        self.create_znodes([("/primaries", "container of all primary brokers")])
 
     def setup_shared_state_znode(self):
-        """ Set up a znode for sharing state among brokers """
+        """ Set up a znode for sharing state among brokers. The whole tree is created with
+        pipelined requests (one round trip); existing znodes are left as they are.
+        Shared state is partitioned so that brokers only watch what their own clients need:
+        - /shared_state/topics/<topic>/[publishers,subscribers]/<id>: clients of each topic
+        - /shared_state/zones/zone_<n>/[publishers,subscribers]/<id>: clients of each zone
+        - /shared_state/interest/zone_<n>: compact summary of each zone's clients
+          (see get_zone_interest)
+        - /shared_state/federation/zone_<n>: endpoint other brokers receive the zone's
+          messages from (centralized dissemination, see join_federation) """
         self.debug("Setting up shared state znode for multiple primary brokers")
-        if not self.znode_exists(znode_name="/shared_state/"):
-            self.create_znode(
-                znode_name="/shared_state/",
-                znode_value="container of shared state among primary brokers"
-            )
-        if not self.znode_exists(znode_name="/shared_state/publishers"):
-            self.create_znode(
-                znode_name="/shared_state/publishers/",
-                znode_value="shared state container of all active publishers"
-            )
-        if not self.znode_exists(znode_name="/shared_state/subscribers"):
-            self.create_znode(
-                znode_name="/shared_state/subscribers/",
-                znode_value="shared state container of all active subscribers"
-            )
+        self.create_znodes([
+            ("/shared_state", "container of shared state among primary brokers"),
+            ("/shared_state/topics", "shared state container of the publishers/subscribers of each topic"),
+            ("/shared_state/zones", "shared state container of the publishers/subscribers of each zone"),
+            ("/shared_state/interest", "shared state container of a client summary per zone"),
+            ("/shared_state/load", "shared state container of the load of each zone"),
+            ("/shared_state/topic_demand", "shared state container of max requested history per topic"),
+            ("/shared_state/federation", "shared state container of the federation endpoint of each zone"),
+            (self.zone_znode, f"shared state container of zone_{self.zone} clients"),
+            (f"{self.zone_znode}/publishers", f"publishers registered in zone_{self.zone}"),
+            (f"{self.zone_znode}/subscribers", f"subscribers registered in zone_{self.zone}"),
+            (self.interest_znode, json.dumps(self.get_zone_interest())),
+            (self.load_znode, json.dumps(self.get_zone_load()))
+        ])
+
+    def remove_publishers(self, pub_ids, topic=None):
+        """ Remove a set of publishers from internal matchmaking data (of one topic,
+        or all topics if not given) in one pass """
+        topics = [topic] if topic else list(self.publishers)
+        for t in topics:
+            if t in self.publishers:
+                self.publishers[t][:] = [pub for pub in self.publishers[t] if pub['id'] not in pub_ids]
+
+    def remove_subscribers(self, sub_ids, topic=None):
+        """ Remove a set of subscribers from internal matchmaking data (of one topic,
+        or all topics if not given) in one pass """
+        topics = [topic] if topic else list(self.subscribers)
+        for t in topics:
+            if t in self.subscribers:
+                self.subscribers[t][:] = [sub for sub in self.subscribers[t] if sub['id'] not in sub_ids]
+
+    def confirm_departed(self, parent, client_ids):
+        """ Of the clients missing from a (possibly stale) children snapshot, return the ones
+        whose znode is really gone; a client registered with this broker after the snapshot
+        was taken is kept. """
+        if not client_ids:
+            return set()
+        values = self.get_znode_values([f'{parent}/{client_id}' for client_id in client_ids])
+        return {client_id for client_id in client_ids if values[f'{parent}/{client_id}'] is None}
+
+    def watch_topic(self, topic):
+        """ Start watching the publishers and subscribers of a topic in every zone, unless
+        already watching it. Brokers only watch the topics their own clients use, so a client
+        joining elsewhere only costs work on brokers that share one of its topics. """
+        if topic in self.topic_watches:
+            return
+        self.debug(f'Watching shared state of topic {topic}')
+        topic_znode = f'/shared_state/topics/{topic}'
+        self.create_znodes([
+            (topic_znode, f"shared state container of topic {topic}"),
+            (f"{topic_znode}/publishers", f"publishers of topic {topic}"),
+            (f"{topic_znode}/subscribers", f"subscribers of topic {topic}")
+        ])
+        self.topic_watches[topic] = []
+        for kind in ['publishers', 'subscribers']:
+            if self.registry_buckets:
+                # Only the buckets that changed are re-read
+                for bucket in range(self.registry_buckets):
+                    self.topic_watches[topic].append(self.watch_data_coalesced(
+                        f'{topic_znode}/{kind}/bucket_{bucket}',
+                        lambda value, kind=kind, bucket=bucket: self.reconcile_bucket(kind, topic, bucket, value)
+                    ))
+            else:
+                self.topic_watches[topic].append(self.watch_children_coalesced(
+                    f'{topic_znode}/{kind}',
+                    lambda children, kind=kind: self.reconcile_clients(kind, topic, children)
+                ))
+
+    def unwatch_unused_topics(self, topics):
+        """ Stop watching those of the given topics no local client uses any more, and forget
+        about their publishers/subscribers in other zones """
+        in_use = self.get_zone_interest()['topics']
+        for topic in topics:
+            if topic in in_use or topic not in self.topic_watches:
+                continue
+            self.debug(f'No local clients of topic {topic} left; no longer watching it')
+            for stop in self.topic_watches.pop(topic):
+                stop()
+            self.publishers.pop(topic, None)
+            self.subscribers.pop(topic, None)
+            self.topic_demand.pop(topic, None)
+            self.mode_selector.forget(topic)
+            self.last_values.pop(topic, None)
+
+    def reconcile_clients(self, kind, topic, children):
+        """ Bring self.publishers[topic] or self.subscribers[topic] in line with the children
+        of /shared_state/topics/<topic>/<kind>. Joined and departed clients are found with set
+        differences; the info of all joined clients is fetched with one pipelined batch of reads.
+        Args:
+        - kind (str) - 'publishers' or 'subscribers'
+        - topic (str)
+        - children (list) - ids of the clients of the topic """
+        if topic not in self.topic_watches:
+            return
+        self.debug(f'{kind.capitalize()} of topic {topic} changed!')
+        # Each znode name is the id of a client; the znode value is JSON client info
+        parent = f'/shared_state/topics/{topic}/{kind}'
+        children = set(children)
+        clients = self.publishers if kind == 'publishers' else self.subscribers
+        current_internally_stored = {client['id'] for client in clients.get(topic, [])}
+        # Also handle if change was a client leaving (trim internal clients to match zookeeper)
+        departed = self.confirm_departed(parent, current_internally_stored - children)
+        joined = children - current_internally_stored
+        client_infos = self.get_znode_values([f'{parent}/{client_id}' for client_id in joined])
+        joined = {
+            client_id: json.loads(client_infos[f'{parent}/{client_id}'])
+            for client_id in joined
+            # None if it left again before we got to it
+            if client_infos[f'{parent}/{client_id}'] is not None
+        }
+        self.apply_client_changes(kind, topic, departed, joined)
+
+    def reconcile_bucket(self, kind, topic, bucket, value):
+        """ Like reconcile_clients, for the bucketed registry layout: bring the clients of
+        topic hashing to bucket in line with the bucket znode's value
+        Args:
+        - kind (str) - 'publishers' or 'subscribers'
+        - topic (str)
+        - bucket (int)
+        - value (str) - JSON {client id: client info}, or None if the bucket does not exist yet """
+        if topic not in self.topic_watches:
+            return
+        self.debug(f'{kind.capitalize()} of topic {topic} changed (bucket {bucket})!')
+        bucket_clients = json.loads(value) if value else {}
+        clients = self.publishers if kind == 'publishers' else self.subscribers
+        current_internally_stored = {
+            client['id'] for client in clients.get(topic, [])
+            if bucket_index(client['id'], self.registry_buckets) == bucket
+        }
+        # Our own clients are added to the bucket after they are stored internally
+        departed = current_internally_stored - set(bucket_clients) - set(self.local_clients)
+        joined = {
+            client_id: info for client_id, info in bucket_clients.items()
+            if client_id not in current_internally_stored
+        }
+        self.apply_client_changes(kind, topic, departed, joined)
+
+    def apply_client_changes(self, kind, topic, departed, joined):
+        """ Update internal matchmaking data of a topic with clients that left or joined
+        in other zones
+        Args:
+        - kind (str) - 'publishers' or 'subscribers'
+        - topic (str)
+        - departed (set) - ids of clients that left
+        - joined (dict) - {client id: client info} of clients that joined """
+        if kind == 'publishers':
+            if departed:
+                self.debug(f'Removing publishers of topic {topic}: {departed}')
+                self.remove_publishers(departed, topic=topic)
+            for pub_id, publisher_info in joined.items():
+                self.debug(f'New pub info: {publisher_info}')
+                pub_addr = publisher_info['address']
+                pub_data = {
+                    'address': pub_addr,
+                    'endpoints': publisher_info.get('endpoints'),
+                    'offered': int(publisher_info['offered']),
+                    'id': pub_id
+                }
+                self.debug(f'Adding publisher to publishers[{topic}]')
+                if topic in self.publishers:
+                    self.publishers[topic].append(pub_data)
+                else:
+                    self.publishers[topic] = [pub_data]
+                # Finally, notify existing subscribers about new publisher!
+                self.notify_subscribers(topics=[topic], pub_address=pub_addr)
+        else:
+            if departed:
+                self.remove_subscribers(departed, topic=topic)
+            for sub_id, subscriber_info in joined.items():
+                self.debug(f'New sub info: {subscriber_info}')
+                sub_data = {
+                    'address': subscriber_info['address'],
+                    'requested': int(subscriber_info['requested']),
+                    'codecs': subscriber_info.get('codecs', []),
+                    'id': sub_id
+                }
+                self.debug(f'Adding sub to subscribers[{topic}]')
+                if topic in self.subscribers:
+                    self.subscribers[topic].append(sub_data)
+                else:
+                    self.subscribers[topic] = [sub_data]
+            # Publishers only need to send as much history as subscribers actually request
+            self.update_topic_demand_znodes()
 
-    def watch_shared_state_publishers(self):
-        @self.zk.ChildrenWatch('/shared_state/publishers/')
-        def changed_publishers(children):
-            self.debug('Publishers shared state changed!')
-            # Each znode name under publishers is an address of a publisher
-            # znode value is JSON/publisher info
-            current_internally_stored_pubs = self.get_all_publisher_ids()
-            for pub_id in children:
-                if pub_id not in current_internally_stored_pubs:
-                    self.debug(f'New publisher {pub_id}')
-                    publisher_info = self.get_znode_value(znode_name=f'/shared_state/publishers/{pub_id}')
-                    self.debug(f'New pub info: {publisher_info}')
-                    publisher_info = json.loads(publisher_info)
-                    topics = publisher_info['topics']
-                    offered = publisher_info['offered']
-                    pub_addr = publisher_info['address']
-                    for topic in topics:
-                        pub_data = {
-                            'address': pub_addr,
-                            'offered': int(offered),
-                            'id': pub_id
-                        }
-                        self.debug(f'Adding publisher to publishers[{topic}]')
-                        if topic in self.publishers:
-                            self.publishers[topic].append(pub_data)
-                        else:
-                            self.publishers[topic] = [pub_data]
-                    # Finally, notify existing subscribers about new publisher!
-                    self.notify_subscribers(topics=topics, pub_address=pub_addr)
-            # Also handle if change was a subscriber leaving
-            # (trim internal subscribers to match zookeeper)
-            for pub_id in current_internally_stored_pubs:
-                if pub_id not in children:
-                    self.debug(f'Removing a publisher: {pub_id}')
-                    self.remove_publisher(pub_id=pub_id)
-
-    def watch_shared_state_subscribers(self):
-        """ Watch for new / """
-        @self.zk.ChildrenWatch('/shared_state/subscribers/')
-        def changed_subscribers(children):
-            self.info('Subscribers shared state changed!')
-            # Each znode name under subscribers is an address of a subscriber
-            # The znode value is json: {topics: <list>, requested: int } -> requested is the requested sliding window/history
-            current_internally_stored_subs = self.get_all_subscriber_ids()
-            for sub_id in children:
-                if sub_id not in current_internally_stored_subs:
-                    self.debug(f'New subscriber! {sub_id}')
-                    subscriber_info = self.get_znode_value(znode_name=f'/shared_state/subscribers/{sub_id}')
-                    self.debug(f'New sub info: {subscriber_info}')
-                    subscriber_info = json.loads(subscriber_info)
-                    topics = subscriber_info['topics']
-                    requested = subscriber_info['requested']
-                    sub_addr = subscriber_info['address']
-                    for topic in topics:
-                        sub_data = {
-                            'address': sub_addr,
-                            'requested': int(requested),
-                            'id': sub_id
-                        }
-                        self.debug(f'Adding sub to subscribers[{topic}]')
-                        if topic in self.subscribers:
-                            self.subscribers[topic].append(sub_data)
-                        else:
-                            self.subscribers[topic] = [sub_data]
-            # Also handle if change was a subscriber leaving (trim internal subscribers to match zookeeper)
-            for sub_id in current_internally_stored_subs:
-                if sub_id not in children:
-                    self.remove_subscriber(sub_id=sub_id)
+    def update_topic_demand_znodes(self):
+        """ Write the max requested history of each topic (across all subscribers of that
+        topic, in any zone) and the compression codecs every one of those subscribers accepts
+        to /shared_state/topic_demand/<topic>. Publishers watch these znodes to truncate the
+        sliding window they serialize and to pick a codec. Only topics whose demand changed
+        are written; a topic with no subscribers left gets demand 0 and no codecs. """
+        demand = {}
+        for topic, sub_list in self.subscribers.items():
+            if sub_list:
+                codecs = set(sub_list[0].get('codecs', []))
+                for sub in sub_list[1:]:
+                    codecs &= set(sub.get('codecs', []))
+                demand[topic] = {
+                    'requested': max(int(sub['requested']) for sub in sub_list),
+                    'codecs': sorted(codecs)
+                }
+        for topic in set(self.topic_demand) | set(demand):
+            topic_demand = demand.get(topic, {'requested': 0, 'codecs': []})
+            if self.topic_demand.get(topic) == topic_demand:
+                continue
+            demand_znode = f'/shared_state/topic_demand/{topic}'
+            self.debug(f'Demand for topic {topic} is now {json.dumps(topic_demand)}')
+            # Compare-and-set, so a broker racing us on the first write doesn't drop ours
+            self.update_json_znode(demand_znode, lambda current, value=topic_demand: value)
+        self.topic_demand = demand
 
     def setup_fault_tolerance_znode(self):
         # Set election path with zone. Backup assigned to same zone will contend via election for
@@ -244,6 +487,12 @@ class Broker(ZookeeperClient):
         self.election_path = f"/elections/zone_{self.zone}"
         # This will take the place of the original /broker znode from Assignment 2. Each zone will have primary broker whose info is stored in this znode.
         self.broker_leader_znode = f"/primaries/zone_{self.zone}"
+        # Shared state of the clients of this zone
+        self.zone_znode = f"/shared_state/zones/zone_{self.zone}"
+        self.interest_znode = f"/shared_state/interest/zone_{self.zone}"
+        self.load_znode = f"/shared_state/load/zone_{self.zone}"
+        self.retirement_znode = f"/retirements/zone_{self.zone}"
+        self.federation_znode = f"/shared_state/federation/zone_{self.zone}"
 
     def set_logger(self, prefix=None):
         if not prefix:
@@ -274,14 +523,18 @@ class Broker(ZookeeperClient):
         self.debug(f"Storing my information in {self.broker_leader_znode}")
         self.info("Configuring myself!")
         self.configure()
-        if self.zk.exists(self.broker_leader_znode):
-            self.debug(f"{self.broker_leader_znode} znode exists : only modify the value)")
-            self.modify_znode_value(znode_name=self.broker_leader_znode, znode_value=self.broker_info)
-        else:
+        # Try the common case (znode left behind by the previous primary) in one round trip
+        if self.modify_znode_value(znode_name=self.broker_leader_znode, znode_value=self.broker_info) is None:
             self.debug(f"{self.broker_leader_znode} znode does not exist: creating!")
             self.create_znode(znode_name=self.broker_leader_znode,znode_value=self.broker_info)
-        self.debug('Updating current system load znode')
-        self.update_current_system_load_znode()
+        if f'zone_{self.zone}' not in self.get_retired_zones():
+            # Take over this zone's share of the topic ring (see placement.py)
+            self.update_json_znode(TOPIC_ZONES_ZNODE, lambda ring: add_ring_zone(ring, f'zone_{self.zone}'))
+        if self.centralized:
+            self.join_federation()
+        self.debug('Updating interest summary and load znodes')
+        self.flush_zone_summary(force=True)
+        self.watch_data_coalesced(self.retirement_znode, self.update_retirement)
         try:
             self.event_loop()
             # Reached if not indefinite
@@ -290,6 +543,39 @@ class Broker(ZookeeperClient):
             # If you interrupt/cancel a broker, be sure to disconnect/clean all sockets
             self.disconnect()
 
+    def update_retirement(self, value):
+        """ Called when this zone's retirement znode changes; a backup elected after the
+        primary retired the zone sees it too and finishes the retirement """
+        if value is not None and not self.retiring:
+            self.info(f"zone_{self.zone} is being retired, waiting for its clients to migrate away")
+        self.retiring = value is not None
+
+    def zone_drained(self):
+        """ Whether no client is registered in this zone anymore. Checks the zone's shared state
+        rather than local_clients, since clients of a previous primary may not have
+        re-registered with this one yet. """
+        for kind in ['publishers', 'subscribers']:
+            try:
+                if self.get_znode_children(f'{self.zone_znode}/{kind}'):
+                    return False
+            except NoNodeError:
+                pass
+        return True
+
+    def retire(self):
+        """ Leave the system once this zone is retired and drained: delete the zone's znodes
+        (so no client or backup pool picks it again), then disconnect """
+        self.info(f"zone_{self.zone} drained, retiring")
+        self.update_json_znode(TOPIC_ZONES_ZNODE, lambda ring: remove_ring_zone(ring, f'zone_{self.zone}'))
+        znodes = [
+            self.federation_znode, self.interest_znode, self.load_znode, f'{self.zone_znode}/publishers',
+            f'{self.zone_znode}/subscribers', self.zone_znode, self.broker_leader_znode
+        ]
+        if not self.commit_transaction([('delete', znode_name) for znode_name in znodes]):
+            for znode_name in znodes:
+                self.delete_znode(znode_name=znode_name)
+        self.disconnect()
+
     def zk_run_election(self):
         """ Run election for a given zone. Each zone has a primary broker replica. """
         self.set_logger(prefix=f'BROKER<zone_{self.zone},backup>')
@@ -321,8 +607,183 @@ class Broker(ZookeeperClient):
         self.debug("Register sockets with a ZMQ poller")
         self.poller.register(self.pub_reg_socket, zmq.POLLIN)
         self.poller.register(self.sub_reg_socket, zmq.POLLIN)
+        if self.centralized:
+            self.setup_federation_binding()
+            self.setup_group_binding()
         self.debug("Configure Stop")
 
+    def setup_federation_binding(self):
+        """ CENTRALIZED DISSEMINATION
+        Brokers of different zones form a federation mesh so subscribers receive the topics
+        of publishers registered in other zones. Each broker republishes the messages of its
+        local publishers on one PUB socket, as [topic, origin, message frames...], and has one
+        SUB socket connected to the PUB socket of every other zone: one link per broker pair,
+        multiplexing all topics. A broker only subscribes to the topics its local subscribers
+        use and PUB sockets filter on the sending side, so only topics with remote interest
+        cross zones. Federated messages are only delivered locally, never republished, and
+        messages carrying this broker's own origin id are dropped, so they cannot loop. """
+        self.federation_socket = self.context.socket(zmq.PUB)
+        port = self.federation_socket.bind_to_random_port('tcp://*', min_port=10000, max_port=20000)
+        self.used_ports.append(port)
+        self.federation_endpoint = f"tcp://{self.get_host_address()}:{port}"
+        self.debug(f"Federation endpoint: {self.federation_endpoint}")
+        self.federation_sub = self.context.socket(zmq.SUB)
+        self.poller.register(self.federation_sub, zmq.POLLIN)
+        self.federation_connected = {}
+        self.federation_topics = set()
+
+    def setup_group_binding(self):
+        """ CENTRALIZED DISSEMINATION
+        Open the ROUTER socket consumer group members connect to (see consumer_groups.py) """
+        self.group_socket = self.context.socket(zmq.ROUTER)
+        self.group_port = self.group_socket.bind_to_random_port('tcp://*', min_port=10000, max_port=20000)
+        self.used_ports.append(self.group_port)
+        self.group_endpoints = transport.advertise(
+            name=f'group-{self.zk_instance_id}',
+            tcp_endpoint=f"tcp://{self.get_host_address()}:{self.group_port}",
+            address=self.get_host_address(),
+            context=self.context
+        )
+        transport.bind_local(self.group_socket, self.group_endpoints)
+        self.poller.register(self.group_socket, zmq.POLLIN)
+
+    def join_group(self, sub_id, group, topics):
+        """ CENTRALIZED DISSEMINATION
+        Add a subscriber to a consumer group of each of its topics. It gets messages once
+        it sends credits. """
+        self.info(f"Subscriber {sub_id} joins consumer group {group} of {topics}")
+        self.group_members[sub_id] = group
+        for topic in topics:
+            groups = self.consumer_groups.setdefault(topic, {})
+            if group not in groups:
+                groups[group] = ConsumerGroup(group, backlog=self.group_backlog)
+            groups[group].join(sub_id)
+
+    def leave_group(self, sub_id, topics):
+        """ CENTRALIZED DISSEMINATION
+        Remove a subscriber from its consumer groups; the messages it did not acknowledge
+        go to the other members """
+        group = self.group_members.pop(sub_id, None)
+        if group is None:
+            return
+        for topic in topics:
+            consumer_group = self.consumer_groups.get(topic, {}).get(group)
+            if not consumer_group:
+                continue
+            requeued = consumer_group.leave(sub_id)
+            if requeued:
+                self.info(f"Redistributing {requeued} unacknowledged {topic} messages of {sub_id} in group {group}")
+            if consumer_group.members:
+                self.dispatch_to_group(topic, consumer_group)
+            else:
+                # Last member gone: nobody left to take the queued messages
+                self.consumer_groups[topic].pop(group)
+                if not self.consumer_groups[topic]:
+                    self.consumer_groups.pop(topic)
+
+    def receive_group_credit(self):
+        """ CENTRALIZED DISSEMINATION
+        Handle [member, b'credit' or b'ack', topic, n] from a group member and send it the
+        messages it can now take """
+        member, command, topic, count = self.group_socket.recv_multipart()
+        member = member.decode('utf8')
+        topic = topic.decode('utf8')
+        count = int(count)
+        consumer_group = self.consumer_groups.get(topic, {}).get(self.group_members.get(member))
+        if not consumer_group:
+            self.debug(f"Credit from {member} for {topic}, which is not in a consumer group of it")
+            return
+        consumer_group.grant(member, count, acked=count if command == ACK else 0)
+        self.dispatch_to_group(topic, consumer_group)
+
+    def dispatch_to_groups(self, topic, frames):
+        """ CENTRALIZED DISSEMINATION
+        Queue a message for each consumer group of its topic and send what members can take """
+        for consumer_group in self.consumer_groups.get(topic, {}).values():
+            consumer_group.offer(frames)
+            self.dispatch_to_group(topic, consumer_group)
+
+    def dispatch_to_group(self, topic, consumer_group):
+        dropped = consumer_group.dropped
+        for member, frames in consumer_group.drain():
+            self.group_socket.send_multipart([member.encode('utf8')] + frames, copy=False)
+        if dropped:
+            self.error(f"Consumer group {consumer_group.name} of {topic} fell behind: dropped {dropped} messages")
+            consumer_group.dropped = 0
+
+    def join_federation(self):
+        """ Advertise this zone's federation endpoint and watch the other zones' endpoints """
+        value = json.dumps({'endpoint': self.federation_endpoint, 'origin': self.zk_instance_id})
+        if self.modify_znode_value(znode_name=self.federation_znode, znode_value=value) is None:
+            self.create_znode(znode_name=self.federation_znode, znode_value=value)
+        self.watch_children_coalesced('/shared_state/federation', self.reconcile_federation)
+
+    def reconcile_federation(self, zones):
+        """ Start/stop watching the federation endpoints of other zones as zones come and go """
+        zones = set(zones) - {f'zone_{self.zone}'}
+        for zone in zones - set(self.federation_watches):
+            self.federation_watches[zone] = self.watch_data_coalesced(
+                f'/shared_state/federation/{zone}',
+                lambda value, zone=zone: self.update_federation_peer(zone, value)
+            )
+        for zone in set(self.federation_watches) - zones:
+            self.federation_watches.pop(zone)()
+            self.federation_peers.pop(zone, None)
+
+    def update_federation_peer(self, zone, value):
+        """ Record another zone's federation endpoint (it changes when the zone's primary fails
+        over). The event loop connects to it (see update_federation). """
+        if value is None:
+            self.federation_peers.pop(zone, None)
+        else:
+            self.federation_peers[zone] = json.loads(value)['endpoint']
+
+    def update_federation(self):
+        """ CENTRALIZED DISSEMINATION
+        Called from the event loop, which owns the federation sockets: connect to the current
+        federation endpoints of other zones and subscribe to the topics of local subscribers """
+        peers = dict(self.federation_peers)
+        for zone, endpoint in list(self.federation_connected.items()):
+            if peers.get(zone) != endpoint:
+                self.debug(f"Leaving federation link to {zone} at {endpoint}")
+                try:
+                    self.federation_sub.disconnect(endpoint)
+                except zmq.error.ZMQError as e:
+                    self.error(f'Could not disconnect from {endpoint}: {e}')
+                self.federation_connected.pop(zone)
+        for zone, endpoint in peers.items():
+            if zone not in self.federation_connected:
+                self.debug(f"Federation link to {zone} at {endpoint}")
+                self.federation_sub.connect(endpoint)
+                self.federation_connected[zone] = endpoint
+        topics = set(self.send_socket_dict)
+        for topic in topics - self.federation_topics:
+            self.federation_sub.setsockopt_string(zmq.SUBSCRIBE, topic)
+        for topic in self.federation_topics - topics:
+            self.federation_sub.setsockopt_string(zmq.UNSUBSCRIBE, topic)
+        self.federation_topics = topics
+
+    def receive_federated(self):
+        """ CENTRALIZED DISSEMINATION
+        Deliver a message republished by another zone's broker to the local subscribers """
+        frames = self.federation_sub.recv_multipart(copy=False)
+        topic = frames[0].bytes.decode('utf8')
+        if frames[1].bytes.decode('utf8') == self.zk_instance_id:
+            # Our own message, e.g. through a stale endpoint of this zone
+            return
+        # Subscriptions are prefix matches, so also check the topic is exactly one of ours
+        if topic in self.send_socket_dict:
+            self.mode_selector.count(topic)
+        if topic in self.consumer_groups:
+            self.dispatch_to_groups(topic, frames[2:])
+        if topic in self.send_socket_dict:
+            self.cache_last_value(topic, frames[2:])
+            self.log_message(topic, frames[2:])
+        if topic in self.send_socket_dict and self.mode_selector.mode(topic) == CENTRALIZED:
+            self.forward_message(topic, frames[2:])
+            self.forwarded_msgs += 1
+            self.forwarded_bytes += sum(len(frame) for frame in frames[2:])
+
     def setup_pub_port_reg_binding(self):
         """
         Method to bind socket to network address to begin publishing/accepting client connections
@@ -392,6 +853,21 @@ class Broker(ZookeeperClient):
             for topic in self.receive_socket_dict.keys():
                 if self.receive_socket_dict[topic] in events:
                     self.send(topic)
+            if self.federation_sub in events:
+                self.receive_federated()
+            if self.group_socket in events:
+                self.receive_group_credit()
+            self.update_federation()
+            if self.adaptive:
+                self.evaluate_topic_modes(time.time())
+            self.maintain_topic_logs(time.time())
+            # Forwarding backlog: topics with messages still waiting after this pass
+            self.backlog_total += sum(
+                1 for sock in self.receive_socket_dict.values() if sock.getsockopt(zmq.EVENTS) & zmq.POLLIN)
+            self.backlog_samples += 1
+        self.flush_zone_summary()
+        if self.retiring and self.zone_drained():
+            self.retire()
 
     def event_loop(self):
         """ BOTH CENTRAL AND DECENTRALIZED DISSEMINATION
@@ -427,33 +903,189 @@ class Broker(ZookeeperClient):
     def update_receive_socket(self):
         """ CENTRALIZED DISSEMINATION
         Once publisher registers with broker, broker will begin receiving messages from it
-        for a given topic; broker must open a SUB socket for the topic if not already opened"""
+        for a given topic; broker must open a SUB socket for the topic if not already opened.
+        Only local publishers are connected to: the messages of publishers registered in
+        other zones arrive through the federation (see setup_federation_binding)"""
         self.debug("Updating receive socket to 'subscribe' to publisher")
         for topic in self.publishers.keys():
-            if topic not in self.receive_socket_dict.keys():
-                self.receive_socket_dict[topic] = self.context.socket(zmq.SUB)
-                self.poller.register(self.receive_socket_dict[topic], zmq.POLLIN)
             for pub in self.publishers[topic]:
-                address = pub['address']
-                self.debug(f"'Subscribing' to publisher {address}")
-                self.receive_socket_dict[topic].connect(f"tcp://{address}")
+                if self.local_clients.get(pub['id'], {}).get('kind') != 'publishers':
+                    continue
+                if topic not in self.receive_socket_dict.keys():
+                    self.receive_socket_dict[topic] = self.context.socket(zmq.SUB)
+                    self.poller.register(self.receive_socket_dict[topic], zmq.POLLIN)
+                    self.receive_endpoints_dict[topic] = set()
+                endpoint = self.get_publisher_endpoint(pub)
+                if endpoint in self.receive_endpoints_dict[topic]:
+                    continue
+                self.debug(f"'Subscribing' to publisher {endpoint}")
+                self.receive_socket_dict[topic].connect(endpoint)
+                self.receive_endpoints_dict[topic].add(endpoint)
                 self.receive_socket_dict[topic].setsockopt_string(zmq.SUBSCRIBE, topic)
         # self.debug("Broker Receive Socket: {0:s}".format(str(list(self.receive_socket_dict.keys()))))
 
+    def get_publisher_endpoint(self, pub):
+        """ Cheapest endpoint (inproc, ipc or tcp) to reach a publisher from this broker """
+        if pub.get('endpoints'):
+            return transport.select_endpoint(pub['endpoints'], self.get_host_address(), self.context)
+        return f"tcp://{pub['address']}"
+
     def send(self, topic):
         """ CENTRALIZED DISSEMINATION
         Take a received message for a given topic and forward
         that message to the appropriate set of subscribers using
-        send_socket_dict[topic] """
-        if topic in self.send_socket_dict.keys():
-            # received_message = self.receive_socket_dict[topic].recv_string()
-            [topic,received_message] = self.receive_socket_dict[topic].recv_multipart()
-            unpickled_message = pickle.loads(received_message)
-            self.debug(f"Forwarding Msg: <{unpickled_message}>")
-            # Beyond this point it is the subscriber's responsibility to check the dominance relationship.
-            # Broker must forward all of these without filtering since some subscribers may satisfy and others may not.
-            # Publisher should include <offered> value in the message, so subscriber can filter before processing.
-            self.send_socket_dict[topic.decode('utf8')].send_multipart([topic, received_message])
+        send_socket_dict[topic], and to the other zones' brokers through the federation """
+        # Publish events are [topic, header, window, payload buffers..., ...] (see message.py).
+        # Receive and forward the frames as-is, without copying payload buffers.
+        frames = self.receive_socket_dict[topic].recv_multipart(copy=False)
+        if self.verbose:
+            self.debug(f"Forwarding Msg: <{message.parse_message(frames)[1]}>")
+        # Beyond this point it is the subscriber's responsibility to check the dominance relationship.
+        # Broker must forward all of these without filtering since some subscribers may satisfy and others may not.
+        # Publisher should include <offered> value in the message, so subscriber can filter before processing.
+        local_topic = frames[0].bytes.decode('utf8')
+        self.mode_selector.count(local_topic)
+        if local_topic in self.send_socket_dict and self.mode_selector.mode(local_topic) == CENTRALIZED:
+            self.forward_message(local_topic, frames)
+        # Consumer groups get their share whatever the mode, since they never connect to publishers
+        self.dispatch_to_groups(local_topic, frames)
+        self.cache_last_value(local_topic, frames)
+        self.log_message(local_topic, frames)
+        if self.federation_socket:
+            # Dropped by the PUB socket unless another zone subscribed to the topic
+            self.federation_socket.send_multipart(
+                [frames[0], self.zk_instance_id.encode('utf8')] + frames, copy=False)
+        self.forwarded_msgs += 1
+        self.forwarded_bytes += sum(len(frame) for frame in frames)
+
+    def cache_last_value(self, topic, frames):
+        """ CENTRALIZED DISSEMINATION
+        Keep the newest message of a topic for subscribers registering later. The frames
+        are kept as received, without copying. """
+        if self.last_value:
+            self.last_values[topic] = frames
+
+    def get_last_values(self, topics, codecs):
+        """ CENTRALIZED DISSEMINATION
+        Cached messages of topics a new subscriber can decode
+        Args:
+        - topics (list) - topics of the subscriber
+        - codecs (list) - compression codecs the subscriber accepts
+        Returns: ([[topic, number of frames], ...], frames of those messages, concatenated) """
+        cached = []
+        frames = []
+        for topic in topics:
+            if topic not in self.last_values:
+                continue
+            codec = message.get_codec(self.last_values[topic])
+            if codec and codec not in codecs:
+                continue
+            cached.append([topic, len(self.last_values[topic])])
+            frames += self.last_values[topic]
+        return cached, frames
+
+    def get_topic_log(self, topic):
+        """ CENTRALIZED DISSEMINATION
+        The log of a topic, opened (and recovered from disk) on first use """
+        if topic not in self.topic_logs:
+            self.topic_logs[topic] = TopicLog(
+                topic_directory(self.log_dir, topic),
+                segment_bytes=self.log_segment_bytes,
+                retention_bytes=self.log_retention_bytes,
+                retention_seconds=self.log_retention_seconds
+            )
+            self.debug(f"Logging topic {topic} from sequence number {self.topic_logs[topic].next_seq}")
+        return self.topic_logs[topic]
+
+    def log_message(self, topic, frames):
+        """ CENTRALIZED DISSEMINATION
+        Append a message to its topic's log """
+        if self.log_dir:
+            self.get_topic_log(topic).append(message.pack_frames(frames))
+
+    def maintain_topic_logs(self, now):
+        """ CENTRALIZED DISSEMINATION
+        Every load_interval ms, flush the topic logs and drop segments beyond retention """
+        if not self.topic_logs or (now - self.logs_maintained) * 1000 < self.load_interval:
+            return
+        self.logs_maintained = now
+        for topic, log in self.topic_logs.items():
+            log.flush()
+            dropped = log.enforce_retention(now)
+            if dropped:
+                self.debug(f"Dropped {dropped} segments of topic {topic}'s log; it now starts at {log.first_seq}")
+
+    def replay(self, request):
+        """ CENTRALIZED DISSEMINATION
+        Reply to a replay request with up to replay_batch logged messages of a topic: the
+        JSON reply {'replay': {'topic', 'records': [[seq, timestamp], ...], 'next_seq',
+        'first_seq'}}, then one frame per record (the message's frames packed with
+        message.pack_frames). Subscribers ask again from next_seq until no record is left.
+        Args:
+        - request (dict) - {'topic': topic, 'from_seq': seq} or {'topic': topic, 'from_time': time}
+        """
+        topic = request['topic']
+        if not self.log_dir:
+            self.sub_reg_socket.send_string(json.dumps({'replay': {'topic': topic, 'error': 'no topic log'}}))
+            return
+        log = self.get_topic_log(topic)
+        records = log.read(from_seq=request.get('from_seq'), from_time=request.get('from_time'),
+            max_records=self.replay_batch)
+        reply = {'replay': {
+            'topic': topic,
+            'records': [[seq, timestamp] for seq, timestamp, data in records],
+            'next_seq': records[-1][0] + 1 if records else log.next_seq,
+            'first_seq': log.first_seq
+        }}
+        self.debug(f"Replaying {len(records)} messages of topic {topic}")
+        self.sub_reg_socket.send_multipart(
+            [json.dumps(reply).encode('utf8')] + [data for seq, timestamp, data in records], copy=False)
+
+    def evaluate_topic_modes(self, now):
+        """ ADAPTIVE DISSEMINATION
+        Every load_interval ms, update the topics' message rates and switch the topics whose
+        cheaper path changed (see dissemination.py). Fanout is the number of subscribers of
+        this broker, since only they follow its decision. """
+        if (now - self.modes_evaluated) * 1000 < self.load_interval:
+            return
+        self.modes_evaluated = now
+        self.mode_selector.sample(now)
+        for topic, counts in self.get_zone_interest()['topics'].items():
+            if not counts['subscribers']:
+                continue
+            mode = self.mode_selector.mode(topic)
+            new_mode = self.mode_selector.decide(
+                topic, counts['subscribers'], len(self.publishers.get(topic, [])), now)
+            if new_mode != mode:
+                self.switch_topic_mode(topic, new_mode)
+
+    def switch_topic_mode(self, topic, mode):
+        """ ADAPTIVE DISSEMINATION
+        Tell the local subscribers of a topic to switch between this broker's stream and
+        direct publisher connections """
+        self.info(f"Topic {topic} is now sent {'through the broker' if mode == CENTRALIZED else 'directly'}")
+        for sub_id, client in list(self.local_clients.items()):
+            if client['kind'] != 'subscribers' or topic not in client['topics'] or sub_id not in self.notify_sub_sockets:
+                continue
+            switch = {'topic': topic, 'mode': mode}
+            if mode == CENTRALIZED:
+                switch.update({'port': self.send_port_dict[topic], 'endpoints': self.send_endpoints_dict[topic]})
+                notification = [{'switch_mode': switch}]
+            else:
+                notification = [{'switch_mode': switch}, self.get_publisher_notification(topic, sub_id)]
+            notify_socket = self.notify_sub_sockets[sub_id]
+            # Runs in the event loop: don't let a gone or unresponsive subscriber stall it
+            try:
+                notify_socket.send_string(json.dumps(notification), flags=zmq.NOBLOCK)
+            except zmq.Again:
+                self.error(f"Subscriber {sub_id} is not connected to be told about topic {topic}")
+                continue
+            if notify_socket.poll(SWITCH_CONFIRM_TIMEOUT_MS, zmq.POLLIN):
+                confirmation = notify_socket.recv_string()
+                self.debug(f"Subscriber {sub_id} switched (confirmation: <{confirmation}>)")
+            else:
+                # The socket is relaxed (see open_notify_socket), so the next request can go out
+                self.error(f"Subscriber {sub_id} did not confirm the switch of topic {topic}")
 
     def get_clear_port(self):
         """ Method to get a clear port that has not been allocated """
@@ -470,34 +1102,58 @@ class Broker(ZookeeperClient):
         topics = dc['topics']
         address = dc['address']
         sub_id = dc['id']
-        sub_znode = f'/shared_state/subscribers/{sub_id}'
         try:
-            self.delete_znode(znode_name=sub_znode)
-            self.update_current_system_load_znode()
+            self.unregister_client_znode(kind='subscribers', client_id=sub_id)
         except Exception as e:
-            self.error(f'Exception when deleting pub znode {sub_znode}: {str(e)}')
+            self.error(f'Exception when deleting sub znodes of {sub_id}: {str(e)}')
 
-        if not self.centralized:
+        if sub_id in self.notify_sub_sockets:
             notify_port = dc['notify_port']
             self.used_ports.remove(notify_port)
             # Close the notification socket for this subscriber with id as key
             self.notify_sub_sockets[sub_id].close()
             self.notify_sub_sockets.pop(sub_id)
+        self.leave_group(sub_id, topics)
+        local_topics = self.get_local_subscriber_topics()
         for t in topics:
             if t in self.subscribers:
                 # if only subscriber to topic, remove topic altogether
                 if len(self.subscribers[t]) == 1:
                     self.subscribers.pop(t)
-                    if self.centralized:
-                        # Close socket then remove. No other subscribers active for t.
-                        self.send_socket_dict[t].close()
-                        self.send_socket_dict.pop(t)
                 else:
                     # Remove just this subscriber
                     self.remove_subscriber(sub_id=sub_id,topic=t)
+            # Subscribers of other zones get the topic from their own broker
+            if self.centralized and t not in local_topics:
+                self.close_send_socket(t)
+        self.unwatch_unused_topics(topics)
         response = {'disconnect': 'success'}
         return json.dumps(response)
 
+    def forward_message(self, topic, frames):
+        """ CENTRALIZED DISSEMINATION
+        Send a message to the local subscribers of a topic: over its send socket and, if
+        enabled, its shared memory ring """
+        self.send_socket_dict[topic].send_multipart(frames, copy=False)
+        ring = self.shm_rings.get(topic)
+        if ring:
+            try:
+                ring.write(message.pack_frames(frames))
+            except ValueError as e:
+                self.error(f'Not written to shared memory: {e}')
+
+    def close_send_socket(self, topic):
+        """ CENTRALIZED DISSEMINATION
+        Close the send socket of a topic once no local subscriber uses it any more """
+        sock = self.send_socket_dict.pop(topic, None)
+        if sock:
+            sock.close()
+        self.send_port_dict.pop(topic, None)
+        self.send_endpoints_dict.pop(topic, None)
+        ring = self.shm_rings.pop(topic, None)
+        if ring:
+            ring.close()
+
     def register_sub(self):
         """ BOTH CENTRAL AND DECENTRALIZED DISSEMINATION
         Register a subscriber address as interested in a set of topics """
@@ -515,14 +1171,20 @@ class Broker(ZookeeperClient):
                 # send response
                 self.sub_reg_socket.send_string(response)
                 return
+            if 'replay' in sub_reg_dict:
+                self.replay(sub_reg_dict['replay'])
+                return
 
             topics = sub_reg_dict['topics']
             sub_address = sub_reg_dict['address']
             sub_id = sub_reg_dict['id']
             requested = int(sub_reg_dict['requested'])
+            group = sub_reg_dict.get('group')
             sub_data = {
                 'address': sub_address,
                 'requested': requested,
+                # Compression codecs this subscriber can decode
+                'codecs': sub_reg_dict.get('codecs', []),
                 'id': sub_id,
                 'topics': topics
                 }
@@ -534,44 +1196,68 @@ class Broker(ZookeeperClient):
                     self.subscribers[topic].append(sub_data)
 
             if not self.centralized:
-                # Allocate a random unique port to notify this subscriber about new hosts.
-                # Port must be different for each subscriber since they are each polling
-                # and subscribers steal poll pipeline events from each other.
-                notify_port = self.get_clear_port()
-                msg = {'register_sub': {'notify_port': notify_port}}
+                msg = {'register_sub': {'notify_port': self.open_notify_socket(sub_id)}}
+                self.sub_reg_socket.send_string(json.dumps(msg))
                 ## Notify new subscriber about all publishers of topic
                 ## so they can listen directly
-                # Set up a new notify socket on a clear port for this subscriber
-                self.debug("Enabling subscriber notification (about publishers)")
-                self.notify_sub_sockets[sub_id] = self.context.socket(zmq.REQ)
-                self.used_ports.append(notify_port)
-                self.notify_sub_sockets[sub_id].bind(f"tcp://*:{notify_port}")
-                self.sub_reg_socket.send_string(json.dumps(msg))
                 self.notify_subscribers(topics=topics, sub_id=sub_id)
             else:
                 ## Make sure there is a socket for each new topic.
-                self.update_send_socket()
+                self.update_send_socket(topics)
 
                 ## Publish topic messages to subscribers.
                 reply_sub_dict = {}
                 for topic in sub_reg_dict['topics']:
                     reply_sub_dict[topic] = self.send_port_dict[topic]
+                # Also let the subscriber pick ipc/inproc if it is co-located with this broker
+                reply_sub_dict['_endpoints'] = {
+                    topic: self.send_endpoints_dict[topic] for topic in sub_reg_dict['topics']
+                }
+                if group and self.group_socket:
+                    # Topics are received from the group socket instead of the topic ports
+                    self.join_group(sub_id, group, topics)
+                    reply_sub_dict['_group'] = {'port': self.group_port, 'endpoints': self.group_endpoints}
+                elif self.adaptive:
+                    # Topics sent directly are connected to through notifications, which also
+                    # tell the subscriber when a topic switches (see switch_topic_mode)
+                    reply_sub_dict['_notify_port'] = self.open_notify_socket(sub_id)
+                    reply_sub_dict['_modes'] = {topic: self.mode_selector.mode(topic) for topic in topics}
+                cached_frames = []
+                if self.last_value and not group:
+                    # Newest message of each topic, as extra frames after the JSON reply
+                    reply_sub_dict['_cached'], cached_frames = self.get_last_values(topics, sub_data['codecs'])
                 self.debug(f"Sending topic/ports: {reply_sub_dict}")
-                self.sub_reg_socket.send_string(json.dumps(reply_sub_dict, indent=4))
+                self.sub_reg_socket.send_multipart(
+                    [json.dumps(reply_sub_dict, indent=4).encode('utf8')] + cached_frames, copy=False)
+                direct_topics = [topic for topic in topics if self.mode_selector.mode(topic) == DIRECT]
+                if self.adaptive and direct_topics and sub_id in self.notify_sub_sockets:
+                    self.notify_subscribers(topics=direct_topics, sub_id=sub_id)
 
             self.debug("Subscriber registered successfully")
             # Write to zookeeper node in shared state.
-            # This notifies the other brokers (all of which watch shared state) about new sub.
-            self.create_znode(
-                znode_name=f"/shared_state/subscribers/{sub_id}",
-                znode_value=json.dumps(sub_data)
-            )
-            # Also update current system load znode!
-            self.update_current_system_load_znode()
+            # This notifies the other brokers watching any of its topics about new sub.
+            # Also update this zone's interest summary and current system load znode (same transaction)!
+            self.register_client_znode(kind='subscribers', client_id=sub_id, client_data=sub_data)
 
         except Exception as e:
             self.error(e)
 
+    def open_notify_socket(self, sub_id):
+        """ Allocate a random unique port to notify a subscriber about new hosts.
+        Port must be different for each subscriber since they are each polling
+        and subscribers steal poll pipeline events from each other.
+        Returns: the notify port """
+        notify_port = self.get_clear_port()
+        self.debug("Enabling subscriber notification (about publishers)")
+        self.notify_sub_sockets[sub_id] = self.context.socket(zmq.REQ)
+        # Allow a new request after one went unanswered (switch_topic_mode gives up waiting),
+        # ignoring a late reply to the old one
+        self.notify_sub_sockets[sub_id].setsockopt(zmq.REQ_RELAXED, 1)
+        self.notify_sub_sockets[sub_id].setsockopt(zmq.REQ_CORRELATE, 1)
+        self.used_ports.append(notify_port)
+        self.notify_sub_sockets[sub_id].bind(f"tcp://*:{notify_port}")
+        return notify_port
+
     def get_pub_id_from_address(self, pub_addr=None):
         pub_id = None
         for pub_list in self.publishers.values():
@@ -608,12 +1294,24 @@ class Broker(ZookeeperClient):
         self.debug("Notifying subscribers")
         message = []
         addresses = []
+        if self.adaptive:
+            # Subscribers of topics sent through this broker don't connect to publishers
+            topics = [t for t in topics if self.mode_selector.mode(t) == DIRECT]
+            if not topics:
+                return
         if pub_address: # when registering single new publisher
             pub_id = self.get_pub_id_from_address(pub_addr=pub_address)
+            pub_endpoints = None
+            for pub_list in self.publishers.values():
+                for pub in pub_list:
+                    if pub['id'] == pub_id:
+                        pub_endpoints = pub.get('endpoints')
             message = [
                 {
                     'register_pub': {
                         'addresses': [pub_address],
+                        # Subscriber picks the cheapest transport from these
+                        'endpoints': [pub_endpoints],
                         'topic': topic
                     }
                 } for topic in topics
@@ -631,25 +1329,7 @@ class Broker(ZookeeperClient):
                 else:
                     self.debug(f"Dominance relationship not satisfied. Not notifying {sub_id} about pub. ")
         else: # registering new subscriber
-            for t in topics:
-                addresses = []
-                if t in self.publishers:
-                    for publisher in self.publishers[t]:
-                        pub_id = publisher['id']
-                        self.debug(f'notify_subscribers::sub_id={sub_id}')
-                        if self.dominance_relationship_satisfied(pub_id=pub_id,sub_id=sub_id):
-                            addresses.append(publisher['address'])
-                        else:
-                            self.debug(f'Dominance relationship not satisfied for publisher {pub_id} and subscriber {sub_id}')
-                message.append(
-                    {
-                        'register_pub': {
-                            'addresses': addresses,
-                            'topic': t
-                        }
-                    }
-                )
-            message = json.dumps(message)
+            message = json.dumps([self.get_publisher_notification(t, sub_id) for t in topics])
             # Send to notify socket for new subscriber address
             self.debug(f"Sending message to subscriber: {message}")
             self.notify_sub_sockets[sub_id].send_string(message)
@@ -657,6 +1337,28 @@ class Broker(ZookeeperClient):
             confirmation = self.notify_sub_sockets[sub_id].recv_string()
             self.debug(f"Subscriber notified successfully (confirmation: <{confirmation}>")
 
+    def get_publisher_notification(self, topic, sub_id):
+        """ DECENTRALIZED DISSEMINATION
+        Notification telling a subscriber about all publishers of a topic it should listen
+        to directly (those satisfying the offered vs. requested dominance relationship) """
+        addresses = []
+        endpoints = []
+        for publisher in self.publishers.get(topic, []):
+            pub_id = publisher['id']
+            self.debug(f'notify_subscribers::sub_id={sub_id}')
+            if self.dominance_relationship_satisfied(pub_id=pub_id,sub_id=sub_id):
+                addresses.append(publisher['address'])
+                endpoints.append(publisher.get('endpoints'))
+            else:
+                self.debug(f'Dominance relationship not satisfied for publisher {pub_id} and subscriber {sub_id}')
+        return {
+            'register_pub': {
+                'addresses': addresses,
+                'endpoints': endpoints,
+                'topic': topic
+            }
+        }
+
     def disconnect_pub(self, msg):
         """ Method to remove data related to a disconnecting publisher """
         self.debug(f"Disconnecting publisher...")
@@ -664,12 +1366,10 @@ class Broker(ZookeeperClient):
         topics = dc['topics']
         address = dc['address']
         pub_id = dc['id']
-        pub_znode = f'/shared_state/publishers/{pub_id}'
         try:
-            self.delete_znode(znode_name=pub_znode)
-            self.update_current_system_load_znode()
+            self.unregister_client_znode(kind='publishers', client_id=pub_id)
         except Exception as e:
-            self.error(f'Exception when deleting pub znode {pub_znode}: {str(e)}')
+            self.error(f'Exception when deleting pub znodes of {pub_id}: {str(e)}')
         for t in topics:
             # If this is the only publisher of a topic, remove the topic from
             # self.publishers and from self.receive_socket_dict
@@ -679,12 +1379,22 @@ class Broker(ZookeeperClient):
                     # Close socket then remove. No other publishers active for t.
                     self.receive_socket_dict[t].close()
                     self.receive_socket_dict.pop(t)
+                    self.receive_endpoints_dict.pop(t, None)
             else:
                 # Only remove the single publisher connection from
                 # publisher connections for this topic
+                endpoint = None
+                for pub in self.publishers[t]:
+                    if pub['id'] == pub_id:
+                        endpoint = self.get_publisher_endpoint(pub)
                 self.remove_publisher(pub_id=pub_id, topic=t)
-                if self.centralized:
-                    self.receive_socket_dict[t].disconnect(address)
+                if self.centralized and endpoint and endpoint in self.receive_endpoints_dict.get(t, set()):
+                    self.receive_endpoints_dict[t].discard(endpoint)
+                    try:
+                        self.receive_socket_dict[t].disconnect(endpoint)
+                    except zmq.error.ZMQError as e:
+                        self.error(f'Could not disconnect from publisher {endpoint}: {e}')
+        self.unwatch_unused_topics(topics)
         response = {'disconnect': 'success'}
         return json.dumps(response)
 
@@ -706,6 +1416,8 @@ class Broker(ZookeeperClient):
             topics = pub_reg_dict['topics']
             pub_data = {
                 'address': pub_address,
+                # tcp/ipc/inproc endpoints the publisher is bound to (see transport.py)
+                'endpoints': pub_reg_dict.get('endpoints'),
                 'offered': offered,
                 'id': pub_id,
                 'topics': topics
@@ -716,8 +1428,8 @@ class Broker(ZookeeperClient):
                 else:
                     self.publishers[topic].append(pub_data)
 
-            if not self.centralized:
-                # For de-centralized dissemination:
+            if not self.centralized or self.adaptive:
+                # For de-centralized dissemination (and topics sent directly by adaptive brokers):
                 # Subscribers interested in this topic need to know to listen
                 # directly to this new publisher.
                 # This starts a while loop on the subscriber.
@@ -725,13 +1437,9 @@ class Broker(ZookeeperClient):
 
             response = {'success': 'registration success'}
             # write to zookeeper node in shared state.
-            # This notifies the other brokers (all of which watch shared state) about new pub.
-            self.create_znode(
-                znode_name=f"/shared_state/publishers/{pub_id}",
-                znode_value=json.dumps(pub_data)
-            )
-            # Also update current system load znode!
-            self.update_current_system_load_znode()
+            # This notifies the other brokers watching any of its topics about new pub.
+            # Also update this zone's interest summary and current system load znode (same transaction)!
+            self.register_client_znode(kind='publishers', client_id=pub_id, client_data=pub_data)
 
         except Exception as e:
             response = {'error': f'registration failed due to exception: {e}'}
@@ -739,21 +1447,137 @@ class Broker(ZookeeperClient):
         self.pub_reg_socket.send_string(json.dumps(response))
         self.debug("Publisher Registration Succeeded")
 
-    def update_current_system_load_znode(self):
-        """ Assumption; the /shared_state/[publishers,subscribers] and
-        /primaries children znodes are always updated before this gets called,
-        so we can just read the current values and update the /shared_state/current_load znode"""
-        num_publishers = len(self.zk.get_children("/shared_state/publishers/"))
-        num_subscribers = len(self.zk.get_children("/shared_state/subscribers/"))
-        num_clients_total = num_publishers + num_subscribers
-        num_zones = len(self.zk.get_children("/primaries/"))
-        updated_system_load = num_clients_total / num_zones
-        self.modify_znode_value(
-            znode_name="/shared_state/current_load",
-            znode_value=updated_system_load
-        )
+    def get_zone_interest(self):
+        """ Compact summary of the clients registered in this zone, written to
+        /shared_state/interest/zone_<n> so other brokers (and the backup pool) don't need
+        the per-client znodes: {'publishers': count, 'subscribers': count,
+        'topics': {topic: {'publishers': count, 'subscribers': count}}} """
+        interest = {'publishers': 0, 'subscribers': 0, 'topics': {}}
+        for client in self.local_clients.values():
+            interest[client['kind']] += 1
+            for topic in client['topics']:
+                counts = interest['topics'].setdefault(topic, {'publishers': 0, 'subscribers': 0})
+                counts[client['kind']] += 1
+        return interest
+
+    def get_zone_load(self):
+        """ Load of this zone, written to /shared_state/load/zone_<n>: client counts and the
+        metrics of the last sample (see sample_zone_metrics). The backup pool combines the
+        zones' loads into the current system load. """
+        interest = self.get_zone_interest()
+        load = {
+            'publishers': interest['publishers'],
+            'subscribers': interest['subscribers'],
+            'clients': interest['publishers'] + interest['subscribers']
+        }
+        load.update(self.zone_metrics)
+        return load
 
+    def sample_zone_metrics(self, now):
+        """ Metrics since the previous sample: forwarded messages and bytes per second, CPU
+        used by this broker's event loop thread (in cores, from thread_time, so brokers sharing
+        a process, as in the backup pool, don't count each other) and forwarding backlog
+        (average number of topics whose receive socket still had queued messages after an
+        event loop pass). Resets the counters. Must be called from the event loop thread.
+        Args:
+        - now (float) - time.time() of the sample """
+        elapsed = max(now - self.metrics_sampled, 1e-3)
+        cpu_time = time.thread_time()
+        cpu_used = cpu_time - self.metrics_cpu_time if self.metrics_cpu_time is not None else 0
+        metrics = {
+            'msgs_per_sec': round(self.forwarded_msgs / elapsed, 1),
+            'bytes_per_sec': round(self.forwarded_bytes / elapsed, 1),
+            'cpu': round(cpu_used / elapsed, 2),
+            'backlog': round(self.backlog_total / self.backlog_samples, 2) if self.backlog_samples else 0
+        }
+        self.metrics_sampled = now
+        self.metrics_cpu_time = cpu_time
+        self.forwarded_msgs = 0
+        self.forwarded_bytes = 0
+        self.backlog_total = 0
+        self.backlog_samples = 0
+        return metrics
+
+    def flush_zone_summary(self, force=False):
+        """ Every load_interval ms, sample this zone's metrics and write its interest summary
+        and load if anything changed, so ZooKeeper writes scale with time rather than with
+        client churn or message rates. Called from the event loop.
+        Args:
+        - force (bool) - write now, even if unchanged or written recently """
+        now = time.time()
+        if not force and (now - self.zone_summary_written) * 1000 < self.load_interval:
+            return
+        metrics = self.sample_zone_metrics(now)
+        self.zone_summary_written = now
+        if not force and not self.zone_summary_dirty and metrics == self.zone_metrics:
+            return
+        self.zone_metrics = metrics
+        operations = [
+            ('set', self.interest_znode, json.dumps(self.get_zone_interest())),
+            ('set', self.load_znode, json.dumps(self.get_zone_load()))
+        ]
+        if not self.commit_transaction(operations):
+            for operation, znode_name, znode_value in operations:
+                if self.modify_znode_value(znode_name=znode_name, znode_value=znode_value) is None:
+                    self.create_znode(znode_name=znode_name, znode_value=znode_value)
+        self.zone_summary_dirty = False
 
+    def get_client_znodes(self, kind, client_id, topics):
+        """ Shared state znodes of a client: one in this zone and, unless the bucketed
+        registry layout is used, one per topic """
+        znodes = [f'{self.zone_znode}/{kind}/{client_id}']
+        if not self.registry_buckets:
+            znodes += [f'/shared_state/topics/{topic}/{kind}/{client_id}' for topic in topics]
+        return znodes
+
+    def get_bucket_znode(self, kind, topic, client_id):
+        """ Bucket znode holding a client of a topic in the bucketed registry layout """
+        return f'/shared_state/topics/{topic}/{kind}/bucket_{bucket_index(client_id, self.registry_buckets)}'
+
+    def register_client_znode(self, kind, client_id, client_data):
+        """ Record a client that registered with this broker in the shared state: its znodes
+        (see get_client_znodes) are written in one transaction. Falls back to separate writes
+        if the client znodes already exist. With the bucketed layout, the client is then
+        added to its bucket of each topic.
+        Args:
+        - kind (str) - 'publishers' or 'subscribers'
+        - client_id (str)
+        - client_data (dict) - JSON-able client info, including its 'topics' """
+        topics = client_data['topics']
+        self.local_clients[client_id] = {'kind': kind, 'topics': topics}
+        for topic in topics:
+            self.watch_topic(topic)
+        znode_value = json.dumps(client_data)
+        znodes = self.get_client_znodes(kind, client_id, topics)
+        if not self.commit_transaction([('create', znode_name, znode_value) for znode_name in znodes]):
+            for znode_name in znodes:
+                self.create_znode(znode_name=znode_name, znode_value=znode_value)
+        # Interest summary and load are written by the event loop (see flush_zone_summary)
+        self.zone_summary_dirty = True
+        if self.registry_buckets:
+            # Bucket entries are keyed by id and don't repeat the topics
+            entry = {k: v for k, v in client_data.items() if k not in ['id', 'topics']}
+            for topic in topics:
+                self.update_json_znode(
+                    self.get_bucket_znode(kind, topic, client_id),
+                    lambda clients: dict(clients, **{client_id: entry})
+                )
+
+    def unregister_client_znode(self, kind, client_id):
+        """ Remove a client of this broker from the shared state, in one transaction """
+        client = self.local_clients.pop(client_id, None)
+        topics = client['topics'] if client else []
+        znodes = self.get_client_znodes(kind, client_id, topics)
+        if not self.commit_transaction([('delete', znode_name) for znode_name in znodes]):
+            for znode_name in znodes:
+                self.delete_znode(znode_name=znode_name)
+        self.zone_summary_dirty = True
+        if self.registry_buckets:
+            for topic in topics:
+                self.update_json_znode(
+                    self.get_bucket_znode(kind, topic, client_id),
+                    lambda clients: {k: v for k, v in clients.items() if k != client_id}
+                )
 
     def get_host_address(self):
         """ Method to return IP address of current host.
@@ -770,13 +1594,22 @@ class Broker(ZookeeperClient):
             address = f"127.0.0.1"
         return address
 
-    def update_send_socket(self):
+    def get_local_subscriber_topics(self):
+        """ Topics of the subscribers registered with this broker (self.subscribers also
+        holds the other zones' subscribers) """
+        return {topic for client in self.local_clients.values() if client['kind'] == 'subscribers'
+            for topic in client['topics']}
+
+    def update_send_socket(self, topics=()):
         """ CENTRALIZED DISSEMINATION
         Once a subscriber registers with the broker, the broker must
         create a socket to publish the topic; the broker will let the
-        subscriber know the port """
-        # Use PUB sockets (one per topic) for sending publish events
-        for topic in self.subscribers.keys():
+        subscriber know the port
+        Args:
+        - topics (list) - topics of the subscriber registering, which is not in local_clients yet
+        """
+        # Use PUB sockets (one per topic, for local subscribers only) for sending publish events
+        for topic in self.get_local_subscriber_topics() | set(topics):
             if topic not in self.send_socket_dict.keys():
                 self.send_socket_dict[topic] = self.context.socket(zmq.PUB)
                 while True:
@@ -786,10 +1619,37 @@ class Broker(ZookeeperClient):
                 self.send_port_dict[topic] = port
                 self.debug(f"Topic {topic} is being sent at port {port}")
                 self.send_socket_dict[topic].bind(f"tcp://{self.get_host_address()}:{port}")
+                self.send_endpoints_dict[topic] = transport.advertise(
+                    name=f'broker-{self.zk_instance_id}-{port}',
+                    tcp_endpoint=f"tcp://{self.get_host_address()}:{port}",
+                    address=self.get_host_address(),
+                    context=self.context
+                )
+                transport.bind_local(self.send_socket_dict[topic], self.send_endpoints_dict[topic])
+                if self.shared_memory:
+                    self.setup_shm_ring(topic)
+
+    def setup_shm_ring(self, topic):
+        """ CENTRALIZED DISSEMINATION
+        Create a topic's shared memory ring and advertise it with its send socket's endpoints;
+        subscribers on this host get it in their registration reply """
+        if not self.shm_context:
+            self.shm_context = zmq.Context()
+        self.shm_rings[topic] = ShmRingWriter(
+            self.shm_context, slot_count=self.shm_slots, slot_size=self.shm_slot_size)
+        self.send_endpoints_dict[topic]['shm'] = {topic: self.shm_rings[topic].describe()}
+        self.debug(f'Shared memory ring for topic {topic}: {self.shm_rings[topic].describe()}')
 
     def disconnect(self):
         """ Method to disconnect from the publish/subscribe system by destroying the ZMQ context """
         self.debug("Disconnect")
+        for log in self.topic_logs.values():
+            log.close()
+        for ring in self.shm_rings.values():
+            ring.close()
+        self.shm_rings.clear()
+        if self.shm_context:
+            self.shm_context.destroy()
         try:
             self.info("Disconnecting. Destroying ZMQ context..")
             self.context.destroy()
@@ -0,0 +1,94 @@
+""" Shared subscriptions (consumer groups), centralized dissemination only.
+
+Subscribers that register with a group name share the topic's messages instead of each
+getting all of them: every message of a topic goes to one member of each group using the
+topic. Members connect a DEALER socket (identity = subscriber id) to the broker's ROUTER
+socket and control the flow with credits, per topic:
+- [b'credit', topic, n]: the member can take n more messages (sent once, its prefetch)
+- [b'ack', topic, n]: the member processed its n oldest messages, and can take n more
+So faster members return credits sooner and get more messages. The broker keeps the
+messages sent to each member until they are acknowledged. When a member leaves, those go
+back to the front of the group's queue and are sent to the other members (at least once
+delivery). Messages wait in the queue while no member has credits, up to `backlog`
+messages; beyond that the oldest are dropped.
+
+ConsumerGroup only decides who gets what; the broker does the sending.
+"""
+from collections import deque
+
+CREDIT = b'credit'
+ACK = b'ack'
+
+
+class ConsumerGroup:
+    def __init__(self, name, backlog=1000):
+        """
+        Args:
+        - name (str) - group name
+        - backlog (int) - max number of messages waiting for a member with credits
+        """
+        self.name = name
+        self.backlog = backlog
+        # Members in join order (round robin order), their credits and the messages sent to
+        # them but not acknowledged yet
+        self.members = []
+        self.credits = {}
+        self.in_flight = {}
+        self.pending = deque()
+        self.next_member = 0
+        self.dropped = 0
+
+    def join(self, member):
+        if member not in self.credits:
+            self.members.append(member)
+            self.credits[member] = 0
+            self.in_flight[member] = deque()
+
+    def leave(self, member):
+        """ Remove a member; its unacknowledged messages are queued again, in order
+        Returns: number of messages queued again """
+        if member not in self.credits:
+            return 0
+        self.members.remove(member)
+        self.credits.pop(member)
+        unacked = self.in_flight.pop(member)
+        self.pending.extendleft(reversed(unacked))
+        return len(unacked)
+
+    def grant(self, member, credits, acked=0):
+        """ Give a member credits, after it acknowledged acked messages """
+        if member not in self.credits:
+            return
+        for i in range(min(acked, len(self.in_flight[member]))):
+            self.in_flight[member].popleft()
+        self.credits[member] += credits
+
+    def offer(self, msg):
+        """ Queue a message for the group """
+        self.pending.append(msg)
+        while len(self.pending) > self.backlog:
+            self.pending.popleft()
+            self.dropped += 1
+
+    def drain(self):
+        """ Assign queued messages to members with credits, round robin
+        Returns: [(member, message)] to send """
+        assignments = []
+        while self.pending and self.members:
+            member = self.pick()
+            if member is None:
+                break
+            msg = self.pending.popleft()
+            self.credits[member] -= 1
+            self.in_flight[member].append(msg)
+            assignments.append((member, msg))
+        return assignments
+
+    def pick(self):
+        """ Next member in round robin order that has credits, None if none has """
+        for i in range(len(self.members)):
+            member = self.members[(self.next_member + i) % len(self.members)]
+            if self.credits[member] > 0:
+                self.next_member = (self.next_member + i + 1) % len(self.members)
+                return member
+        return None
@@ -0,0 +1,97 @@
+""" Per-topic choice between centralized and direct dissemination, used by adaptive brokers.
+
+With centralized dissemination a publisher sends each message once, to the broker, which
+sends it on to every subscriber: one extra hop, but a publisher's work doesn't grow with the
+number of subscribers. With direct dissemination every publisher sends each message to every
+subscriber itself. So the cost that matters is the number of copies per second each
+publisher would send with direct dissemination:
+    direct_cost = rate * fanout / publishers
+where rate is the topic's message rate (all publishers together) and fanout the number of
+subscribers. High fanout topics with few publishers get expensive and are sent through the
+broker, low fanout topics skip the broker hop.
+
+Rates are EWMAs of the messages counted per sample (the broker keeps receiving every topic
+so it can count messages in both modes). Flapping is prevented by:
+- hysteresis: a topic is centralized once direct_cost exceeds `threshold` and only goes
+  back to direct once it falls below threshold * (1 - hysteresis)
+- a cooldown of `cooldown` seconds after each switch of a topic
+
+New topics start centralized, since the broker path works before any rate is known.
+The selector is pure (times are passed in) so it can be tested without a network.
+"""
+
+CENTRALIZED = 'centralized'
+DIRECT = 'direct'
+
+
+def direct_cost(rate, fanout, publishers):
+    """ Copies per second each publisher of a topic would send with direct dissemination """
+    return rate * fanout / max(publishers, 1)
+
+
+class TopicModeSelector:
+    def __init__(self, threshold=200, hysteresis=0.5, alpha=0.5, cooldown=10):
+        """
+        Args:
+        - threshold (float) - direct_cost above which a topic is centralized
+        - hysteresis (float) - fraction below threshold direct_cost must drop to go direct again
+        - alpha (float) - smoothing factor of the topic rates (0-1, higher reacts faster)
+        - cooldown (float) - min seconds between two switches of a topic
+        """
+        self.threshold = threshold
+        self.hysteresis = hysteresis
+        self.alpha = alpha
+        self.cooldown = cooldown
+        # Messages counted since the last sample, smoothed rates (messages per second),
+        # current modes and times of the last switch, per topic
+        self.counts = {}
+        self.rates = {}
+        self.modes = {}
+        self.switched = {}
+        self.sampled = None
+
+    def count(self, topic, messages=1):
+        """ Count messages of a topic received by the broker """
+        self.counts[topic] = self.counts.get(topic, 0) + messages
+
+    def sample(self, now):
+        """ Turn the counts since the last sample into rates and reset them """
+        if self.sampled is not None:
+            elapsed = max(now - self.sampled, 1e-3)
+            for topic in set(self.rates) | set(self.counts):
+                rate = self.counts.get(topic, 0) / elapsed
+                previous = self.rates.get(topic)
+                self.rates[topic] = rate if previous is None else self.alpha * rate + (1 - self.alpha) * previous
+        self.counts = {}
+        self.sampled = now
+
+    def mode(self, topic):
+        return self.modes.get(topic, CENTRALIZED)
+
+    def decide(self, topic, fanout, publishers, now):
+        """ Mode a topic should use now, recorded as its current mode
+        Args:
+        - topic (str)
+        - fanout (int) - number of subscribers of the topic
+        - publishers (int) - number of publishers of the topic
+        - now (float) - time in seconds
+        Returns: CENTRALIZED or DIRECT """
+        mode = self.mode(topic)
+        if topic not in self.rates or now - self.switched.get(topic, float('-inf')) < self.cooldown:
+            return mode
+        cost = direct_cost(self.rates[topic], fanout, publishers)
+        if cost > self.threshold:
+            new_mode = CENTRALIZED
+        elif cost < self.threshold * (1 - self.hysteresis):
+            new_mode = DIRECT
+        else:
+            new_mode = mode
+        if new_mode != mode:
+            self.modes[topic] = new_mode
+            self.switched[topic] = now
+        return new_mode
+
+    def forget(self, topic):
+        """ Drop the state of a topic no longer used """
+        for state in [self.counts, self.rates, self.modes, self.switched]:
+            state.pop(topic, None)
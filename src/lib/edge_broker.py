@@ -0,0 +1,191 @@
+"""
+Edge broker: a broker placed at a switch of a tree topology, between the zone brokers and
+the subscribers below that switch (centralized dissemination only)
+
+Edge brokers form a tree matching the network. Each edge has one XPUB socket its
+subscribers and child edges connect to, and one XSUB socket connected upstream: to its
+parent edge's XPUB socket, or, for a root edge (no parent), to the federation PUB socket of
+every zone broker (see Broker.setup_federation_binding). Subscriptions arriving on the XPUB
+socket are passed to the XSUB socket and messages arriving on the XSUB socket are passed
+to the XPUB socket. XPUB sockets only pass on the first subscription to a topic and its
+last unsubscription, so each edge subscribes upstream once per topic however many
+subscribers below it use the topic, and every message crosses each inter-switch link once.
+
+ZooKeeper layout:
+- /edge_elections/<name>: election among the replicas of an edge
+- /edges/<name>: "address,xpub_port,sub_reg_port" of the elected replica. Subscribers
+  register at sub_reg_port like with a zone broker; child edges connect to xpub_port.
+- /shared_state/edges/<name>/[publishers,subscribers]/<id>: subscribers of the edge. They
+  are also written to /shared_state/topics/<topic>/subscribers so publishers still learn the
+  history and codecs requested (see Broker.update_topic_demand_znodes).
+"""
+from .broker import Broker
+from . import transport
+import zmq
+import time
+
+
+class EdgeBroker(Broker):
+    def __init__(self, name, parent=None, **kwargs):
+        """
+        Args:
+        - name (str) - name of this edge, e.g. the switch it serves
+        - parent (str) - name of the parent edge; None for a root edge, which connects to
+          the zone brokers
+        - kwargs - passed to Broker (centralized dissemination is implied; an edge is not
+          part of any zone)
+        """
+        self.name = name
+        self.parent = parent
+        # XPUB socket subscribers and child edges connect to, its tcp port and endpoints
+        self.edge_socket = None
+        self.edge_port = None
+        self.edge_endpoints = None
+        # XSUB socket connected to the parent edge or to the zone brokers
+        self.upstream_socket = None
+        super().__init__(centralized=True, zone=None, **kwargs)
+
+    def setup_fault_tolerance_znode(self):
+        self.election_path = f"/edge_elections/{self.name}"
+        self.broker_leader_znode = f"/edges/{self.name}"
+        self.parent_znode = f"/edges/{self.parent}" if self.parent else None
+        self.zone_znode = f"/shared_state/edges/{self.name}"
+
+    def setup_shared_state_znode(self):
+        self.create_znodes([
+            ("/edges", "container of all edge brokers"),
+            ("/shared_state", "container of shared state among primary brokers"),
+            ("/shared_state/topics", "shared state container of the publishers/subscribers of each topic"),
+            ("/shared_state/topic_demand", "shared state container of max requested history per topic"),
+            ("/shared_state/federation", "shared state container of the federation endpoint of each zone"),
+            ("/shared_state/edges", "shared state container of the subscribers of each edge"),
+            (self.zone_znode, f"shared state container of edge {self.name} clients"),
+            (f"{self.zone_znode}/publishers", f"publishers registered at edge {self.name}"),
+            (f"{self.zone_znode}/subscribers", f"subscribers registered at edge {self.name}")
+        ])
+
+    def set_logger(self, prefix=None):
+        super().set_logger(prefix=prefix or f'EDGE<{self.name}>')
+
+    def zk_run_election(self):
+        """ Run election among the replicas of this edge """
+        self.set_logger(prefix=f'EDGE<{self.name},backup>')
+        self.info(f"I am currently a contender/backup for edge {self.name}")
+        self.election = self.zk.Election(self.election_path, self.zk_instance_id)
+        self.election.run(self.leader_function)
+
+    def leader_function(self):
+        self.set_logger(prefix=f'EDGE<{self.name},primary>')
+        self.info(f"I ({self.zk_instance_id}) AM LEADER OF {self.election_path}")
+        self.configure()
+        if self.modify_znode_value(znode_name=self.broker_leader_znode, znode_value=self.broker_info) is None:
+            self.create_znode(znode_name=self.broker_leader_znode, znode_value=self.broker_info)
+        if self.parent_znode:
+            self.watch_data_coalesced(self.parent_znode, self.update_parent)
+        else:
+            self.watch_children_coalesced('/shared_state/federation', self.reconcile_federation)
+        try:
+            self.event_loop()
+            self.disconnect()
+        except KeyboardInterrupt:
+            self.disconnect()
+
+    def configure(self):
+        """ Open the subscriber registration socket and the XPUB/XSUB pair """
+        self.debug("Configure Start")
+        self.context = zmq.Context()
+        self.poller = zmq.Poller()
+        self.sub_reg_socket = self.context.socket(zmq.REP)
+        self.setup_sub_port_reg_binding()
+        self.used_ports.append(self.sub_reg_port)
+        self.edge_socket = self.context.socket(zmq.XPUB)
+        self.edge_port = self.edge_socket.bind_to_random_port('tcp://*', min_port=10000, max_port=20000)
+        self.used_ports.append(self.edge_port)
+        self.edge_endpoints = transport.advertise(
+            name=f'edge-{self.zk_instance_id}',
+            tcp_endpoint=f"tcp://{self.get_host_address()}:{self.edge_port}",
+            address=self.get_host_address(),
+            context=self.context
+        )
+        transport.bind_local(self.edge_socket, self.edge_endpoints)
+        self.upstream_socket = self.context.socket(zmq.XSUB)
+        self.broker_info = f"{self.get_host_address()},{self.edge_port},{self.sub_reg_port}"
+        self.debug(f"Edge {self.name} serving subscribers at {self.broker_info}")
+        self.poller.register(self.sub_reg_socket, zmq.POLLIN)
+        self.poller.register(self.edge_socket, zmq.POLLIN)
+        self.poller.register(self.upstream_socket, zmq.POLLIN)
+        self.debug("Configure Stop")
+
+    def update_parent(self, value):
+        """ Record the parent edge's endpoint (it changes when the parent fails over) """
+        if value is None:
+            self.federation_peers.pop(self.parent, None)
+        else:
+            address, edge_port, sub_reg_port = value.split(',')
+            self.federation_peers[self.parent] = f"tcp://{address}:{edge_port}"
+
+    def update_federation(self):
+        """ Called from the event loop: connect the XSUB socket to the current upstream
+        endpoints. Subscriptions are made by subscribers through the XPUB socket; the XSUB
+        socket sends them to every upstream peer, including peers connected later. """
+        peers = dict(self.federation_peers)
+        for peer, endpoint in list(self.federation_connected.items()):
+            if peers.get(peer) != endpoint:
+                self.debug(f"Leaving upstream link to {peer} at {endpoint}")
+                try:
+                    self.upstream_socket.disconnect(endpoint)
+                except zmq.error.ZMQError as e:
+                    self.error(f'Could not disconnect from {endpoint}: {e}')
+                self.federation_connected.pop(peer)
+        for peer, endpoint in peers.items():
+            if peer not in self.federation_connected:
+                self.debug(f"Upstream link to {peer} at {endpoint}")
+                self.upstream_socket.connect(endpoint)
+                self.federation_connected[peer] = endpoint
+
+    def forward_subscriptions(self):
+        """ Pass (un)subscriptions of subscribers and child edges upstream """
+        self.upstream_socket.send_multipart(self.edge_socket.recv_multipart())
+
+    def relay(self):
+        """ Pass a message from upstream down to the subscribers and child edges. Zone
+        brokers' federation messages are [topic, origin, message frames...]; the origin is
+        only used between zone brokers, so a root edge strips it. """
+        frames = self.upstream_socket.recv_multipart(copy=False)
+        if not self.parent:
+            frames = frames[2:]
+        self.edge_socket.send_multipart(frames, copy=False)
+        topic = frames[0].bytes.decode('utf8')
+        self.cache_last_value(topic, frames)
+        self.log_message(topic, frames)
+        self.forwarded_msgs += 1
+        self.forwarded_bytes += sum(len(frame) for frame in frames)
+
+    def parse_events(self, index):
+        try:
+            events = dict(self.poller.poll(500))
+        except zmq.error.ZMQError as e:
+            self.error(f'Exception with self.poller.poll(): {e}')
+            events = {}
+        if self.sub_reg_socket in events:
+            self.debug(f"Event {index}: subscriber")
+            self.register_sub()
+        if self.edge_socket in events:
+            self.forward_subscriptions()
+        if self.upstream_socket in events:
+            self.relay()
+        self.update_federation()
+        self.maintain_topic_logs(time.time())
+
+    def update_send_socket(self, topics=()):
+        """ All topics are sent on the XPUB socket
+        Args:
+        - topics (list) - topics of the subscriber registering, which is not in subscribers yet
+        """
+        for topic in set(self.subscribers) | set(topics):
+            self.send_port_dict[topic] = self.edge_port
+            self.send_endpoints_dict[topic] = self.edge_endpoints
+
+    def close_send_socket(self, topic):
+        self.send_port_dict.pop(topic, None)
+        self.send_endpoints_dict.pop(topic, None)
@@ -0,0 +1,115 @@
+""" Wire format of publish events, shared by publishers, brokers and subscribers.
+
+A publish message is one ZMQ multipart message:
+    [topic, header, window, buffer, ..., window, buffer, ...]
+where each window is a pickled (protocol 5) sliding-history list of events and is
+followed by the out-of-band buffers of the binary payloads it carries. The JSON header
+lists how many buffers follow each window, e.g. {"buffers": [1, 0]} for a batch of two
+windows where only the first carries a payload. If the windows were compressed, the
+header also names the codec, e.g. {"buffers": [0], "codec": "zlib"}.
+
+Payload buffers are never pickled in-band, so they can be sent with copy=False, forwarded
+by the broker as the received frames and unpickled by the subscriber as views (memoryview,
+or numpy arrays backed by the frame) without any per-hop memcpy.
+"""
+import json
+import lzma
+import pickle
+import struct
+import zlib
+
+# Stdlib compression codecs usable on pickled windows: name -> (compress(data, level), decompress)
+CODECS = {
+    'zlib': (lambda data, level: zlib.compress(data, level), zlib.decompress),
+    'lzma': (lambda data, level: lzma.compress(data, preset=level), lzma.decompress),
+}
+
+
+def wrap_payload(payload):
+    """ Prepare a buffer-protocol payload (bytes, bytearray, memoryview, numpy array, ...)
+    for out-of-band serialization. Numpy arrays already pickle their data out-of-band
+    with protocol 5 (and come back as arrays); anything else is wrapped in a PickleBuffer
+    and comes back as a memoryview. """
+    if hasattr(payload, '__array_interface__'):
+        return payload
+    return pickle.PickleBuffer(payload)
+
+
+def serialize_window(window):
+    """ Pickle a sliding-history window, keeping payload buffers out-of-band
+    Returns: (pickled window bytes, list of payload buffers as memoryviews) """
+    buffers = []
+    data = pickle.dumps(window, protocol=5, buffer_callback=buffers.append)
+    return data, [buffer.raw() for buffer in buffers]
+
+
+def build_message(topic, serialized_windows, codec=None, level=6, threshold=512):
+    """ Build the multipart frames for a topic from one or more serialized windows
+    Args:
+    - topic (bytes)
+    - serialized_windows (list) - (data, buffers) tuples from serialize_window
+    - codec (str) - optional key of CODECS used to compress the pickled windows. Payload
+      buffers are never compressed so they stay zero-copy.
+    - level (int) - compression level (zlib level / lzma preset)
+    - threshold (int) - only compress if the pickled windows add up to at least this many bytes
+    """
+    header = {'buffers': [len(buffers) for data, buffers in serialized_windows]}
+    if codec and sum(len(data) for data, buffers in serialized_windows) >= threshold:
+        compress = CODECS[codec][0]
+        serialized_windows = [(compress(data, level), buffers) for data, buffers in serialized_windows]
+        header['codec'] = codec
+    frames = [topic, json.dumps(header).encode('utf8')]
+    for data, buffers in serialized_windows:
+        frames.append(data)
+        frames.extend(buffers)
+    return frames
+
+
+def frame_buffer(frame):
+    """ Bytes-like view of a frame, whether it was received with copy=True (bytes)
+    or copy=False (zmq.Frame) """
+    return getattr(frame, 'buffer', frame)
+
+
+def parse_message(frames):
+    """ Parse multipart frames built by build_message
+    Returns: (topic (bytes), list of windows) """
+    topic = bytes(frame_buffer(frames[0]))
+    header = json.loads(bytes(frame_buffer(frames[1])))
+    decompress = CODECS[header['codec']][1] if 'codec' in header else None
+    windows = []
+    index = 2
+    for num_buffers in header['buffers']:
+        data = frame_buffer(frames[index])
+        if decompress:
+            data = decompress(data)
+        buffers = [frame_buffer(f) for f in frames[index + 1:index + 1 + num_buffers]]
+        windows.append(pickle.loads(data, buffers=buffers))
+        index += 1 + num_buffers
+    return topic, windows
+
+
+def get_codec(frames):
+    """ Compression codec of a message built by build_message, None if not compressed """
+    return json.loads(bytes(frame_buffer(frames[1]))).get('codec')
+
+
+def pack_frames(frames):
+    """ Pack multipart frames into a single bytes object (for transports without
+    multipart messages, e.g. the shared memory ring): [count][length]*count[frame]*count """
+    buffers = [frame_buffer(f) for f in frames]
+    lengths = [memoryview(b).nbytes for b in buffers]
+    return b''.join([struct.pack(f'<I{len(lengths)}I', len(lengths), *lengths)] + buffers)
+
+
+def unpack_frames(data):
+    """ Split bytes packed by pack_frames back into frames (memoryviews into data) """
+    view = memoryview(data)
+    count = struct.unpack_from('<I', view, 0)[0]
+    lengths = struct.unpack_from(f'<{count}I', view, 4)
+    frames = []
+    offset = 4 + 4 * count
+    for length in lengths:
+        frames.append(view[offset:offset + length])
+        offset += length
+    return frames
@@ -0,0 +1,82 @@
+""" Partitioned topics.
+
+A partitioned topic T is sent as N separate topics T#0..T#N-1 (its partitions), so several
+publishers can share it: each partition has its own ownership lock (/topics/T#<p>) and its
+own sliding history, and publishers own disjoint sets of partitions. Brokers and the shared
+state only ever see partition topics, so matchmaking, federation and demand work per partition.
+
+The number of partitions is stored in /shared_state/partitions/T. It is written by the first
+partitioned publisher of T and adopted by every later publisher and subscriber. The children
+of that znode are the topic's live publishers (a ZooKeeper party); each publisher claims its
+share, ceil(N / publishers), of the partitions, preferring its own order of them (see
+preferred_partitions) so publishers rarely compete for the same lock, and gives up partitions
+beyond its share when more publishers join.
+
+Publishers route keyed events to one of their own partitions by rendezvous hashing, so all
+events with a key stay ordered in one partition while ownership is stable, and spread
+events without a key round robin. Subscribers subscribe to every partition and record events
+under T; ordering holds per partition.
+"""
+import hashlib
+import math
+
+PARTITIONS_ZNODE = '/shared_state/partitions'
+SEPARATOR = '#'
+
+
+def _weight(text):
+    """ Pseudo-random weight of text. Not crc32 like placement.py: crc32 is linear, so for
+    names differing only in a small partition number it orders them the same way for most keys. """
+    return int.from_bytes(hashlib.blake2b(text.encode('utf8'), digest_size=8).digest(), 'big')
+
+
+def partition_topic(topic, partition):
+    """ Name of partition of topic, e.g. A#2 """
+    return f'{topic}{SEPARATOR}{partition}'
+
+
+def split_partition(topic):
+    """ (topic, partition) of a partition topic; (topic, None) for an unpartitioned topic """
+    name, separator, partition = topic.rpartition(SEPARATOR)
+    if separator and partition.isdigit():
+        return name, int(partition)
+    return topic, None
+
+
+def expand_topics(topics, topic_partitions):
+    """ Topics as sent on the wire: each partitioned topic replaced by its partitions
+    Args:
+    - topics (list) - topic names
+    - topic_partitions (dict) - {topic: number of partitions} of the partitioned topics """
+    expanded = []
+    for topic in topics:
+        if topic_partitions.get(topic, 1) > 1:
+            expanded += [partition_topic(topic, p) for p in range(topic_partitions[topic])]
+        else:
+            expanded.append(topic)
+    return expanded
+
+
+def partition_share(partitions, publishers):
+    """ Max number of partitions each of publishers publishers should own """
+    return math.ceil(partitions / max(publishers, 1))
+
+
+def preferred_partitions(partitions, member):
+    """ The partitions 0..partitions-1 in the order a publisher tries to claim them, a
+    different pseudo-random order per publisher id (member) """
+    return sorted(range(partitions), key=lambda p: (_weight(f'{member}/{p}'), p))
+
+
+def route(owned, key=None, counter=0):
+    """ Partition an event is sent on
+    Args:
+    - owned (list) - partitions owned by the publisher, in claim order
+    - key (str) - optional event key; events with the same key go to the same partition
+    - counter (int) - events sent so far without a key, for round robin
+    Returns: partition, None if no partition is owned """
+    if not owned:
+        return None
+    if key is None:
+        return owned[counter % len(owned)]
+    return max(owned, key=lambda p: (_weight(f'{key}/{p}'), p))
@@ -0,0 +1,244 @@
+""" Placement of clients across zones.
+
+Clients choose a zone when they join with one of PLACEMENT_STRATEGIES (see choose_zone):
+- random: uniformly at random
+- p2c: power of two choices, the less loaded of two random zones, using the client counts
+  zones report in /shared_state/load/zone_<n>. Stale counts don't cause herding since
+  every client compares a different random pair.
+- least_rtt: the zone whose broker answers a TCP connect to its registration port fastest,
+  which keeps traffic close in tree topologies
+- rendezvous: highest random weight hashing of the client's placement key (its configured
+  name, else its address and topics, see placement_key), so a client keeps its zone across
+  restarts and only clients of a removed zone move
+- topic_affine: the zone owning most of the client's topics on the topic ring, so all
+  publishers and subscribers of a topic meet at one broker (a single broker hop)
+
+The topic ring is a consistent hash ring of the live zones, stored in
+/shared_state/topic_zones as {"zones": [...], "vnodes": <points per zone>}. Primaries add
+their zone when elected; zones are removed when retired. Adding a zone only moves the
+topics the new zone takes over (about 1/zones of them).
+
+The BackupPool rebalances zones after scale events and drains zones it retires. Zones are
+described by their client lists, {zone: [client ids]}, as read from
+/shared_state/zones/zone_<n>/{publishers,subscribers}. Plans are lists of moves
+(client id, from zone, to zone) which the BackupPool writes to /migrations/<client id>.
+
+Apart from choose_zone and probe_rtt, the functions are pure so they can be tested
+without ZooKeeper.
+"""
+import bisect
+import json
+import random
+import socket
+import time
+import zlib
+
+PLACEMENT_STRATEGIES = ['random', 'p2c', 'least_rtt', 'rendezvous', 'topic_affine']
+TOPIC_ZONES_ZNODE = '/shared_state/topic_zones'
+RING_VNODES = 64
+
+
+def zone_number(zone):
+    """ Number of a zone name, e.g. 2 for zone_2 """
+    return int(zone.split('_')[1])
+
+
+def plan_rebalance(zone_clients, tolerance=1):
+    """ Moves evening out the number of clients per zone: one client at a time is moved from
+    the most to the least loaded zone until they differ by at most tolerance clients.
+    Args:
+    - zone_clients (dict) - {zone: [client ids]}
+    - tolerance (int) - allowed difference between the most and least loaded zone (>= 1)
+    Returns: list of (client id, from zone, to zone) """
+    tolerance = max(tolerance, 1)
+    clients = {zone: list(ids) for zone, ids in zone_clients.items()}
+    moves = []
+    if len(clients) < 2:
+        return moves
+    while True:
+        # Ties go to the lowest zone number so plans are deterministic
+        busiest = max(clients, key=lambda zone: (len(clients[zone]), -zone_number(zone)))
+        idlest = min(clients, key=lambda zone: (len(clients[zone]), zone_number(zone)))
+        if len(clients[busiest]) - len(clients[idlest]) <= tolerance:
+            return moves
+        client = clients[busiest].pop()
+        clients[idlest].append(client)
+        moves.append((client, busiest, idlest))
+
+
+def plan_drain(zone_clients, zone):
+    """ Moves emptying a zone: each of its clients goes to the least loaded remaining zone.
+    Args:
+    - zone_clients (dict) - {zone: [client ids]}, including the zone to drain
+    - zone (str) - zone to drain
+    Returns: list of (client id, from zone, to zone), empty if there is no other zone """
+    counts = {z: len(ids) for z, ids in zone_clients.items() if z != zone}
+    moves = []
+    if not counts:
+        return moves
+    for client in zone_clients.get(zone, []):
+        target = min(counts, key=lambda z: (counts[z], zone_number(z)))
+        counts[target] += 1
+        moves.append((client, zone, target))
+    return moves
+
+
+def select_idle_zone(zone_loads):
+    """ Zone to retire: the least loaded one, the newest one on ties.
+    Args:
+    - zone_loads (dict) - {zone: load}
+    Returns: zone name, None if there are no zones """
+    if not zone_loads:
+        return None
+    return min(zone_loads, key=lambda zone: (zone_loads[zone], -zone_number(zone)))
+
+
+class ConsistentHashRing:
+    def __init__(self, zones, vnodes=RING_VNODES):
+        """ Consistent hash ring of zones, each placed at vnodes points
+        Args:
+        - zones (list) - zone names
+        - vnodes (int) - points per zone; more points spread topics more evenly
+        """
+        self.points = sorted(
+            (zlib.crc32(f'{zone}#{i}'.encode('utf8')), zone) for zone in zones for i in range(vnodes))
+        self.hashes = [point for point, zone in self.points]
+
+    @classmethod
+    def from_znode(cls, value):
+        """ Ring described by the value of TOPIC_ZONES_ZNODE (None if missing) """
+        ring = json.loads(value) if value else {}
+        return cls(ring.get('zones', []), ring.get('vnodes', RING_VNODES))
+
+    def owner(self, topic):
+        """ Zone owning a topic: the first zone point clockwise from the topic's hash """
+        if not self.points:
+            return None
+        index = bisect.bisect(self.hashes, zlib.crc32(topic.encode('utf8'))) % len(self.points)
+        return self.points[index][1]
+
+    def preferred_zone(self, topics):
+        """ Zone owning most of topics, the owner of the first topic on ties """
+        owners = [self.owner(topic) for topic in topics]
+        if not owners or owners[0] is None:
+            return None
+        return max(owners, key=lambda zone: (owners.count(zone), -owners.index(zone)))
+
+
+def add_ring_zone(ring, zone):
+    """ Update for TOPIC_ZONES_ZNODE (see ZookeeperClient.update_json_znode) adding a zone """
+    return {'zones': sorted(set(ring.get('zones', [])) | {zone}), 'vnodes': ring.get('vnodes', RING_VNODES)}
+
+
+def remove_ring_zone(ring, zone):
+    """ Update for TOPIC_ZONES_ZNODE removing a zone """
+    return {'zones': sorted(set(ring.get('zones', [])) - {zone}), 'vnodes': ring.get('vnodes', RING_VNODES)}
+
+
+def plan_affinity(zone_client_topics, ring):
+    """ Moves bringing each client to the zone owning most of its topics on the ring. Clients
+    whose preferred zone is not among the given zones stay where they are.
+    Args:
+    - zone_client_topics (dict) - {zone: {client id: [topics]}}
+    - ring (ConsistentHashRing)
+    Returns: list of (client id, from zone, to zone) """
+    moves = []
+    for zone, clients in sorted(zone_client_topics.items()):
+        for client, topics in clients.items():
+            target = ring.preferred_zone(topics)
+            if target and target != zone and target in zone_client_topics:
+                moves.append((client, zone, target))
+    return moves
+
+
+def two_choices(zone_loads, rng=random):
+    """ Power of two choices: the less loaded of two zones sampled at random
+    Args:
+    - zone_loads (dict) - {zone: load}
+    - rng - source of randomness (random module or random.Random)
+    Returns: zone name, None if there are no zones """
+    zones = sorted(zone_loads, key=zone_number)
+    if len(zones) < 2:
+        return zones[0] if zones else None
+    first, second = rng.sample(zones, 2)
+    return first if zone_loads[first] <= zone_loads[second] else second
+
+
+def least_rtt(zone_rtts):
+    """ Zone with the lowest round trip time (lowest zone number on ties)
+    Args:
+    - zone_rtts (dict) - {zone: seconds}
+    Returns: zone name, None if there are no zones """
+    if not zone_rtts:
+        return None
+    return min(zone_rtts, key=lambda zone: (zone_rtts[zone], zone_number(zone)))
+
+
+def placement_key(address, topics, name=None):
+    """ Key a client is placed by with rendezvous. Unlike the client id, it stays the same
+    when the client restarts.
+    Args:
+    - address (str) - address of the client's host (and port, for publishers)
+    - topics (list) - the client's topics
+    - name (str) - optional name configured for the client, used as is
+    Returns: str """
+    if name:
+        return name
+    return f"{address}/{','.join(sorted(topics))}"
+
+
+def rendezvous(zones, key):
+    """ Highest random weight (rendezvous) hashing: the zone whose hash with key is highest
+    Args:
+    - zones (list) - zone names
+    - key (str) - client placement key (see placement_key)
+    Returns: zone name, None if there are no zones """
+    if not zones:
+        return None
+    return max(zones, key=lambda zone: (zlib.crc32(f'{key}/{zone}'.encode('utf8')), zone))
+
+
+def probe_rtt(address, port, timeout=1.0):
+    """ Time a TCP connect to address:port
+    Returns: seconds, infinity if unreachable within timeout """
+    start = time.perf_counter()
+    try:
+        with socket.create_connection((address, int(port)), timeout=timeout):
+            return time.perf_counter() - start
+    except OSError:
+        return float('inf')
+
+
+def choose_zone(client, zones, strategy, key, port_index, topics=()):
+    """ Choose the zone a client joins
+    Args:
+    - client (ZookeeperClient) - connected client, to read the zones' load or broker znodes
+    - zones (list) - candidate zones
+    - strategy (str) - one of PLACEMENT_STRATEGIES
+    - key (str) - client placement key (see placement_key), for rendezvous
+    - port_index (int) - position of the client's registration port in /primaries/zone_<n>
+      ("address,pub_reg_port,sub_reg_port"), probed by least_rtt
+    - topics (list) - the client's topics, for topic_affine
+    """
+    if strategy == 'p2c':
+        values = client.get_znode_values([f'/shared_state/load/{zone}' for zone in zones])
+        return two_choices({
+            zone: json.loads(values[f'/shared_state/load/{zone}'])['clients']
+            if values[f'/shared_state/load/{zone}'] else 0
+            for zone in zones
+        })
+    if strategy == 'least_rtt':
+        values = client.get_znode_values([f'/primaries/{zone}' for zone in zones])
+        rtts = {}
+        for zone in zones:
+            broker_info = values[f'/primaries/{zone}']
+            if broker_info:
+                broker_info = broker_info.split(',')
+                rtts[zone] = probe_rtt(broker_info[0], broker_info[port_index])
+        return least_rtt(rtts) or random.choice(zones)
+    if strategy == 'rendezvous':
+        return rendezvous(zones, key)
+    if strategy == 'topic_affine':
+        zone = ConsistentHashRing.from_znode(client.get_znode_value(TOPIC_ZONES_ZNODE)).preferred_zone(topics)
+        return zone if zone in zones else random.choice(zones)
+    return random.choice(zones)
@@ -1,13 +1,17 @@
 from .zookeeper_client import ZookeeperClient
-import random
+from . import message
+from . import transport
+from .shm_ring import ShmRingWriter
+from .placement import choose_zone, placement_key
+from . import partitions
 import zmq
 import logging
 import time
 import json
-import pickle
 import netifaces
 import uuid
 import sys
+from collections import deque
 
 class Publisher(ZookeeperClient):
     """ Class to represent a single publisher in a Publish/Subscribe distributed
@@ -19,7 +23,10 @@ class Publisher(ZookeeperClient):
         broker_address='127.0.0.1',
         topics=[], sleep_period=1, bind_port=5556,
         indefinite=False, max_event_count=15,zookeeper_hosts=["127.0.0.1:2181"],
-        verbose=False, offered=1):
+        verbose=False, offered=1, batch_size=1, batch_latency=1000,
+        compression=None, compression_level=6, compression_threshold=512,
+        shared_memory=False, shm_slots=256, shm_slot_size=16384, placement='random', partitions=1,
+        repair_buffer=1024, name=None):
         """ Constructor
         args:
         - broker_address (str) - IP address of broker
@@ -29,9 +36,26 @@ class Publisher(ZookeeperClient):
         - bind_port - port on which to publish information
         - indefinite (boolean) - whether to publish events/updates indefinitely
         - max_event_count (int) - if not (indefinite), max number of events/updates to publish
+        - batch_size (int) - if > 1, pack up to this many events per topic into one multipart message
+        - batch_latency (int) - max microseconds an event may wait in a batch before it is flushed
+        - compression (str) - optional codec ('zlib' or 'lzma') used for topics whose subscribers all accept it
+        - compression_level (int) - zlib level / lzma preset
+        - compression_threshold (int) - only compress messages of at least this many bytes
+        - shared_memory (boolean) - also write every message to a per-topic shared memory ring
+          that subscribers on the same host read instead of a socket connection
+        - shm_slots (int) / shm_slot_size (int) - messages per ring / max bytes per message
+        - placement (str) - how to choose a zone, one of placement.PLACEMENT_STRATEGIES
+        - name (str) - optional name of this client, stable across restarts, which rendezvous
+          placement hashes instead of its address and topics
+        - partitions (int) - if > 1, split each topic into this many partitions (unless the topic
+          is already partitioned, see partitions.py) so several publishers can share it
+        - repair_buffer (int) - number of recent events per topic kept to answer subscribers'
+          repair requests (NACKs) for events they missed; 0 disables repairs
         """
         self.verbose = verbose
         self.id = str(id(self))
+        self.placement = placement
+        self.name = name
         self.broker_address = broker_address
         # self.own_address = own_address
         self.topics = topics
@@ -43,6 +67,8 @@ class Publisher(ZookeeperClient):
         self.broker_reg_socket = None
         self.pub_socket = None
         self.pub_port = None
+        # Endpoints (tcp, ipc, inproc) pub_socket is bound to; advertised at registration
+        self.endpoints = None
         # Get this from zookeeper. Will change dynamically for different primary publishers if on localhost,
         # since port can only be used by one broker at a time.
         #self.pub_reg_port = 5555
@@ -51,6 +77,51 @@ class Publisher(ZookeeperClient):
         self.offered = offered
         # Maintain a sliding window of historical events/messages published of length <offered>
         self.sliding_history = []
+        # Max history requested by current subscribers per topic (pushed by brokers through
+        # /shared_state/topic_demand/<topic>). Unknown topics fall back to the full <offered> window.
+        self.topic_demand = {}
+        # Compression codecs accepted by all current subscribers per topic (same znodes)
+        self.topic_codecs = {}
+        self.compression = compression
+        self.compression_level = compression_level
+        self.compression_threshold = compression_threshold
+        # Shared memory rings per topic ({topic: ShmRingWriter}). The rings and their doorbells
+        # get their own ZMQ context since self.context is recreated whenever the broker changes.
+        self.shared_memory = shared_memory
+        self.shm_slots = shm_slots
+        self.shm_slot_size = shm_slot_size
+        self.shm_context = None
+        self.shm_rings = {}
+        # Opt-in micro-batching: {topic (bytes): {'windows': [serialized windows], 'started': time}}
+        self.batch_size = batch_size
+        self.batch_latency = batch_latency
+        self.pending_batches = {}
+        # Partitioned topics (see partitions.py): {topic: number of partitions}, set by
+        # resolve_partitions. Each partition has its own lock and sliding history, and this
+        # publisher only sends the partitions whose lock it holds:
+        # {partition topic: Lock}, {partition topic: [events]}, {topic: Party},
+        # {topic: partitions owned in claim order}, {topic: time ownership was last checked}
+        # and {topic: events sent without a key} (for round robin)
+        self.partitions = partitions
+        self.topic_partitions = {}
+        self.partition_locks = {}
+        self.partition_history = {}
+        self.partition_parties = {}
+        self.owned_partitions = {}
+        self.partitions_checked = {}
+        self.partition_counter = {}
+        # Gap repair: events carry a sequence number per topic (partition topic for
+        # partitioned topics) and the port of the REP socket where subscribers that detect a
+        # gap in the sequence numbers ask for the missing events (see Subscriber.detect_gaps).
+        # {topic: next sequence number}, {topic: deque of the latest repair_buffer events}
+        # Like the shared memory rings, the socket has its own ZMQ context and is bound once:
+        # self.context is destroyed by the ZooKeeper thread whenever the broker changes.
+        self.repair_buffer = repair_buffer
+        self.sequence = {}
+        self.repair_history = {}
+        self.repair_context = None
+        self.repair_socket = None
+        self.repair_port = None
 
         # Set up initial config for ZooKeeper client.
         # FIXME: publisher needs to be aware of what zone it belongs to for load balancing.
@@ -73,15 +144,31 @@ class Publisher(ZookeeperClient):
         ###############################################################################
 
     def assign_to_zone(self):
-        """ Random assignment to load balance across zones """
+        """ Choose a zone to load balance across zones (see placement.py) """
         # This is the node this subscriber will watch for updated broker information in case of broker failure.
-        all_zones = self.zk.get_children("/primaries/")
+        all_zones = self.get_znode_children("/primaries/")
+        # Zones being drained by the backup pool don't take new clients
+        retired = self.get_retired_zones()
+        all_zones = [zone for zone in all_zones if zone not in retired] or all_zones
         self.debug(f"All available zones: {all_zones}")
-        self.zone = random.choice(all_zones)
+        self.zone = choose_zone(
+            self, all_zones, self.placement, placement_key(self.get_host_address(), self.topics, self.name),
+            port_index=1, topics=self.topics)
         self.debug(f"out of all zones ({all_zones}), choosing {self.zone}")
         self.broker_leader_znode = f'/primaries/{self.zone}'
         self.set_logger(prefix=f'PUB<{",".join(self.topics)}>:offer={self.offered}:{self.zone}')
 
+    def resolve_partitions(self):
+        """ Look up (or, with partitions > 1, record) the partition count of each topic """
+        self.topic_partitions = self.get_topic_partitions(self.topics, self.partitions, create=True)
+        if self.topic_partitions:
+            self.info(f"Partitioned topics: {self.topic_partitions}")
+
+    def get_wire_topics(self):
+        """ Topics as registered with the broker: partitioned topics as all their partitions,
+        since this publisher may own any of them """
+        return partitions.expand_topics(self.topics, self.topic_partitions)
+
     def debug(self, msg):
         self.logger.debug(msg, extra=self.prefix)
 
@@ -122,12 +209,17 @@ class Publisher(ZookeeperClient):
         # To overcome the need for this, Kazoo has come up with a decorator.
         # Decorators can be of two kinds: watching for data on a znode changing,
         # and children on a znode changing
-        @self.zk.DataWatch(self.broker_leader_znode)
+        broker_leader_znode = self.broker_leader_znode
+
+        @self.zk.DataWatch(broker_leader_znode)
         def dump_data_change (data, stat, event):
+            if broker_leader_znode != self.broker_leader_znode:
+                # Migrated to another zone; its watch took over
+                return False
             if event == None:
                 self.WATCH_FLAG = True
                 self.debug("No ZNODE Event - First Watch Call! Initializing publisher...")
-                self.update_broker_info(znode_value=self.get_znode_value(znode_name=self.broker_leader_znode))
+                self.update_broker_info(znode_value=self.cache_watched_value(broker_leader_znode, data))
                 self.configure()
                 self.WATCH_FLAG = False
             elif event.type == 'CHANGED':
@@ -137,13 +229,86 @@ class Publisher(ZookeeperClient):
                 self.context.destroy()
                 self.debug("Update Broker Information")
                 self.debug(f"Data changed for znode: data={data},stat={stat}")
-                self.update_broker_info(znode_value=self.get_znode_value(znode_name=self.broker_leader_znode))
+                self.update_broker_info(znode_value=self.cache_watched_value(broker_leader_znode, data))
                 self.debug("Reconfiguring...")
                 self.configure()
                 self.WATCH_FLAG = False
             elif event.type == 'DELETED':
                 self.debug("ZNODE DELETED")
 
+    def watch_migration(self):
+        """ Watch /migrations/<id>, where the backup pool asks this publisher to move to
+        another zone to rebalance zones or drain a retired one """
+        self.migration_znode = f'/migrations/{self.id}'
+
+        @self.zk.DataWatch(self.migration_znode)
+        def migration_change(data, stat):
+            if data:
+                self.migrate_to_zone(json.loads(data)['zone'])
+
+    def migrate_to_zone(self, zone):
+        """ Move to another zone: unregister from the current broker, then watch and register
+        with the new zone's primary. Deletes the migration znode when done.
+        Args:
+        - zone (str) - zone to move to, e.g. zone_2 """
+        if zone != self.zone and self.znode_exists(znode_name=f'/primaries/{zone}'):
+            self.info(f"Migrating from {self.zone} to {zone}")
+            self.WATCH_FLAG = True
+            try:
+                self.unregister_pub()
+            except zmq.error.ZMQError as e:
+                self.error(f"Could not unregister from {self.zone}: {e}")
+            self.context.destroy()
+            self.zone = zone
+            self.broker_leader_znode = f'/primaries/{zone}'
+            self.set_logger(prefix=f'PUB<{",".join(self.topics)}>:offer={self.offered}:{self.zone}')
+            # The first call of the new watch registers with the new broker
+            self.watch_znode_data_change()
+        self.delete_znode(znode_name=self.migration_znode)
+
+    def watch_topic_demand(self):
+        """ Watch /shared_state/topic_demand/<topic> for each published topic. Brokers write
+        the largest history any current subscriber requested for that topic there, along with
+        the compression codecs all of those subscribers accept. """
+        for topic in self.get_wire_topics():
+            self.watch_topic_demand_znode(topic)
+
+    def watch_topic_demand_znode(self, topic):
+        @self.zk.DataWatch(f'/shared_state/topic_demand/{topic}')
+        def demand_change(data, stat):
+            if data is None:
+                # No subscriber has ever requested this topic; keep sending full window
+                self.topic_demand.pop(topic, None)
+                self.topic_codecs.pop(topic, None)
+            else:
+                demand = json.loads(data.decode('utf-8'))
+                self.debug(f'Demand for topic {topic}: {demand}')
+                self.topic_demand[topic] = int(demand['requested'])
+                self.topic_codecs[topic] = set(demand.get('codecs', []))
+
+    def get_window_size(self, topic):
+        """ Number of historical events to send for a topic: the largest window requested
+        by current subscribers, capped at <offered>. Always send at least the newest event. """
+        if topic not in self.topic_demand:
+            return self.offered
+        return max(1, min(self.offered, self.topic_demand[topic]))
+
+    def get_codec(self, topic):
+        """ Compression codec to use for a topic: the configured codec, but only once every
+        current subscriber of the topic has declared that it accepts it """
+        if self.compression and self.compression in self.topic_codecs.get(topic, set()):
+            return self.compression
+        return None
+
+    def build_message(self, topic, serialized_windows):
+        """ Build multipart frames for a topic (bytes), compressing if negotiated """
+        return message.build_message(
+            topic, serialized_windows,
+            codec=self.get_codec(topic.decode('utf8')),
+            level=self.compression_level,
+            threshold=self.compression_threshold
+        )
+
     def configure(self):
         """ Method to perform initial configuration of Publisher """
         self.debug("Configure Start")
@@ -160,9 +325,42 @@ class Publisher(ZookeeperClient):
         self.pub_socket = self.context.socket(zmq.PUB)
         self.setup_port_binding()
         self.debug(f"Binding at {self.get_host_address()} to publish")
+        # Also publish over ipc/inproc so co-located peers can skip the TCP stack
+        self.endpoints = transport.advertise(
+            name=f'pub-{self.instanceId}',
+            tcp_endpoint=f'tcp://{self.get_host_address()}',
+            address=self.get_host_address().split(':')[0],
+            context=self.context
+        )
+        transport.bind_local(self.pub_socket, self.endpoints)
+        if self.repair_buffer:
+            self.setup_repair_socket()
+        if self.shared_memory:
+            self.setup_shm_rings()
+            # Advertised with the other endpoints; the broker hands it out to same-host subscribers
+            self.endpoints['shm'] = {topic: ring.describe() for topic, ring in self.shm_rings.items()}
         self.register_pub()
         self.debug("Configure Stop")
 
+    def setup_shm_rings(self):
+        """ Create one shared memory ring per topic (once; rings survive broker changes) """
+        if not self.shm_context:
+            self.shm_context = zmq.Context()
+        for topic in self.get_wire_topics():
+            if topic not in self.shm_rings:
+                self.shm_rings[topic] = ShmRingWriter(
+                    self.shm_context, slot_count=self.shm_slots, slot_size=self.shm_slot_size)
+                self.debug(f'Shared memory ring for topic {topic}: {self.shm_rings[topic].describe()}')
+
+    def setup_repair_socket(self):
+        """ Bind the socket answering repair requests (once; it survives broker changes) """
+        if self.repair_socket:
+            return
+        self.repair_context = zmq.Context()
+        self.repair_socket = self.repair_context.socket(zmq.REP)
+        self.repair_port = self.repair_socket.bind_to_random_port('tcp://*', min_port=10000, max_port=20000)
+        self.debug(f"Answering repair requests on port {self.repair_port}")
+
     def setup_port_binding(self):
         """
         Method to bind socket to network address to begin publishing/accepting client connections
@@ -187,8 +385,8 @@ class Publisher(ZookeeperClient):
     def register_pub(self):
         """ Method to register this publisher with the broker """
         self.debug(f"Registering with broker at {self.broker_address}:{self.pub_reg_port}")
-        message_dict = {'address': self.get_host_address(), 'topics': self.topics,
-            'id': self.id, 'offered': self.offered}
+        message_dict = {'address': self.get_host_address(), 'topics': self.get_wire_topics(),
+            'id': self.id, 'offered': self.offered, 'endpoints': self.endpoints}
         message = json.dumps(message_dict, indent=4)
         self.debug(f"Sending registration message: {message}")
         self.broker_reg_socket.send_string(message)
@@ -215,11 +413,20 @@ class Publisher(ZookeeperClient):
             address = f"127.0.0.1:{self.bind_port}"
         return address
 
-    def generate_publish_event(self, topic_index=0):
+    def generate_publish_event(self, topic_index=0, payload=None, key=None):
         """ Try to create a lock for topic. If obtained, publisher is leader for
         topic can publish. If not obtained, publisher not leader for topic, cannot publish.
+        Args:
+        - topic_index (int) - index of topic in self.topics
+        - payload - optional buffer-protocol object (bytes, memoryview, numpy array) to send
+          with the event. It is sent without copying, so it must not be modified afterwards.
+        - key (str) - optional key of the event; for a partitioned topic, events with the same
+          key are sent on the same partition
+        Returns: [topic (bytes), (pickled window, payload buffers)] or None if not owner of topic
         """
         topic_index = topic_index % len(self.topics)
+        if self.topics[topic_index] in self.topic_partitions:
+            return self.generate_partition_event(self.topics[topic_index], payload=payload, key=key)
         # make sure the path exists for a particular topic
         self.zk.ensure_path(f"/topics/{self.topics[topic_index]}")
 
@@ -239,16 +446,193 @@ class Publisher(ZookeeperClient):
                 'topic': self.topics[topic_index],
                 'publish_time': time.time()
             }
+            if payload is not None:
+                event['payload'] = message.wrap_payload(payload)
+            self.stamp_event(self.topics[topic_index], event)
             topic = self.topics[topic_index].encode('utf8')
             if len(self.sliding_history) == self.offered:
                 # Remove the oldest historical message
                 self.sliding_history.pop(0)
             self.sliding_history.append(event)
-            event = [b'%b' % topic, pickle.dumps(self.sliding_history)]
+            # Only serialize as much history as subscribers of this topic requested
+            window = self.sliding_history[-self.get_window_size(self.topics[topic_index]):]
+            event = [b'%b' % topic, message.serialize_window(window)]
             return event
         else:
             return None
 
+    def stamp_event(self, topic, event):
+        """ Give an event the next sequence number of its topic (as sent on the wire) and this
+        run's epoch, and keep it for repairs """
+        event['seq'] = self.sequence.get(topic, 0)
+        self.sequence[topic] = event['seq'] + 1
+        # Sequence numbers start over when a publisher restarts: tell subscribers which run
+        # they belong to (a short prefix of the instance id is unique enough)
+        event['epoch'] = self.instanceId[:8]
+        if self.repair_buffer:
+            event['repair'] = self.repair_port
+            if topic not in self.repair_history:
+                self.repair_history[topic] = deque(maxlen=self.repair_buffer)
+            self.repair_history[topic].append(event)
+
+    def serve_repairs(self, timeout):
+        """ Wait timeout seconds, answering repair requests in the meantime """
+        if not self.repair_socket:
+            time.sleep(timeout)
+            return
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            try:
+                if remaining <= 0 or not self.repair_socket.poll(remaining * 1000):
+                    return
+                self.answer_repair()
+            except zmq.ZMQError as e:
+                # Closed by disconnect, or a request cut short: stop answering, keep the pace
+                self.error(f"Repair socket error: {e}")
+                time.sleep(max(0, deadline - time.time()))
+                return
+
+    def answer_repair(self):
+        """ Answer a repair request {'topic': topic, 'first': seq, 'last': seq} with the
+        requested events still in the repair buffer, as one history window (see message.py) """
+        request = json.loads(self.repair_socket.recv_string())
+        topic = request['topic']
+        events = [event for event in self.repair_history.get(topic, [])
+            if request['first'] <= event['seq'] <= request['last']]
+        self.debug(f"Repairing {len(events)} events {request['first']}-{request['last']} of topic {topic}")
+        self.repair_socket.send_multipart(
+            message.build_message(topic.encode('utf8'), [message.serialize_window(events)]), copy=False)
+
+    def claim_partitions(self, topic):
+        """ Take this publisher's share of a partitioned topic's partitions: join the topic's
+        party of publishers, give up partitions beyond ceil(partitions / publishers) and try
+        to lock free ones (without blocking) until the share is reached. Checked at most
+        once per second per topic. """
+        now = time.time()
+        if now - self.partitions_checked.get(topic, 0) < 1:
+            return
+        self.partitions_checked[topic] = now
+        if topic not in self.partition_parties:
+            self.partition_parties[topic] = self.zk.Party(f'{partitions.PARTITIONS_ZNODE}/{topic}', self.instanceId)
+            self.partition_parties[topic].join()
+        count = self.topic_partitions[topic]
+        share = partitions.partition_share(count, len(self.partition_parties[topic]))
+        owned = self.owned_partitions.setdefault(topic, [])
+        while len(owned) > share:
+            partition = owned.pop()
+            self.info(f"Releasing partition {partition} of {topic} to another publisher")
+            self.partition_locks.pop(partitions.partition_topic(topic, partition)).release()
+        for partition in partitions.preferred_partitions(count, self.instanceId):
+            if len(owned) >= share:
+                break
+            if partition in owned:
+                continue
+            partition_topic = partitions.partition_topic(topic, partition)
+            lock = self.zk.Lock(f"/topics/{partition_topic}", self.instanceId)
+            if lock.acquire(blocking=False):
+                self.debug(f"Publishing partition {partition} of {topic}")
+                self.partition_locks[partition_topic] = lock
+                owned.append(partition)
+
+    def generate_partition_event(self, topic, payload=None, key=None):
+        """ generate_publish_event for a partitioned topic: the event goes to one of the
+        partitions this publisher owns (see partitions.route), with that partition's history
+        Returns: [partition topic (bytes), (pickled window, payload buffers)] or None if no
+        partition of topic is owned """
+        self.claim_partitions(topic)
+        counter = self.partition_counter.get(topic, 0)
+        partition = partitions.route(self.owned_partitions.get(topic, []), key=key, counter=counter)
+        if partition is None:
+            return None
+        if key is None:
+            self.partition_counter[topic] = counter + 1
+        event = {
+            'publisher': self.get_host_address(),
+            # Subscribers record events under the topic, whichever partition carried them
+            'topic': topic,
+            'partition': partition,
+            'publish_time': time.time()
+        }
+        if payload is not None:
+            event['payload'] = message.wrap_payload(payload)
+        partition_topic = partitions.partition_topic(topic, partition)
+        self.stamp_event(partition_topic, event)
+        history = self.partition_history.setdefault(partition_topic, [])
+        if len(history) == self.offered:
+            history.pop(0)
+        history.append(event)
+        window = history[-self.get_window_size(partition_topic):]
+        return [partition_topic.encode('utf8'), message.serialize_window(window)]
+
+    def publish_event(self, topic, payload=None, key=None):
+        """ Publish a single event about topic, optionally carrying a binary payload
+        (bytes, memoryview, numpy array or any other buffer-protocol object). Payload bytes are
+        sent as their own frames without being copied or pickled. If topic is partitioned,
+        events with the same key are sent on the same partition.
+        Returns: True if sent (or queued in a batch), False if this publisher does not own topic """
+        event = self.generate_publish_event(topic_index=self.topics.index(topic), payload=payload, key=key)
+        if not event:
+            self.debug(f'I do not have priority for {topic}')
+            return False
+        self.send_event(event)
+        return True
+
+    def send_event(self, event):
+        """ Send a publish event [topic, serialized window]. With batching enabled, queue the
+        window in its topic's batch instead; the batch goes out as one multipart message
+        (see message.py) once it holds batch_size windows or its oldest window is
+        batch_latency microseconds old. """
+        if self.batch_size <= 1:
+            topic, window = event
+            self.send_message(topic, self.build_message(topic, [window]))
+            return
+        topic, window = event
+        if topic not in self.pending_batches:
+            self.pending_batches[topic] = {'windows': [], 'started': time.time()}
+        self.pending_batches[topic]['windows'].append(window)
+        if len(self.pending_batches[topic]['windows']) >= self.batch_size:
+            self.flush_batch(topic)
+        self.flush_expired_batches()
+
+    def send_message(self, topic, frames):
+        """ Send multipart frames over the PUB socket and, if enabled, the topic's shared memory ring """
+        self.pub_socket.send_multipart(frames, copy=False)
+        ring = self.shm_rings.get(topic.decode('utf8'))
+        if ring:
+            try:
+                ring.write(message.pack_frames(frames))
+            except ValueError as e:
+                self.error(f'Not written to shared memory: {e}')
+
+    def flush_batch(self, topic):
+        """ Send all queued windows of a topic as a single multipart message """
+        batch = self.pending_batches.pop(topic, None)
+        if batch:
+            self.debug(f"Flushing batch of {len(batch['windows'])} events for topic {topic}")
+            self.send_message(topic, self.build_message(topic, batch['windows']))
+
+    def flush_expired_batches(self, force=False):
+        """ Flush batches whose oldest event has waited batch_latency microseconds (or all if force) """
+        now = time.time()
+        for topic in list(self.pending_batches.keys()):
+            if force or (now - self.pending_batches[topic]['started']) * 1e6 >= self.batch_latency:
+                self.flush_batch(topic)
+
+    def sleep_between_events(self):
+        """ Sleep sleep_period seconds, waking up early to flush any batch whose latency
+        bound expires during the sleep """
+        wake_time = time.time() + self.sleep_period
+        while True:
+            self.flush_expired_batches()
+            now = time.time()
+            if now >= wake_time:
+                break
+            next_flush = wake_time
+            for batch in self.pending_batches.values():
+                next_flush = min(next_flush, batch['started'] + self.batch_latency / 1e6)
+            self.serve_repairs(max(0, next_flush - now))
+
     def publish(self):
         """ Method to publish events either indefinitely or until a max event count
         is reached. Only publish if you own (have the lock for) topic.
@@ -265,8 +649,8 @@ class Publisher(ZookeeperClient):
                             self.debug(f'I do not have priority for {topic}')
                             continue
                         self.debug(f'Sending event: [{event}]')
-                        self.pub_socket.send_multipart(event)
-                        time.sleep(self.sleep_period)
+                        self.send_event(event)
+                        self.sleep_between_events()
                         i += 1
                 else:
                     self.debug("SWITCHING BROKER")
@@ -281,31 +665,48 @@ class Publisher(ZookeeperClient):
                             self.debug(f'I do not have priority for {topic}')
                             continue
                         self.debug(f'Sending event: [{event}]')
-                        self.pub_socket.send_multipart(event)
-                        time.sleep(self.sleep_period)
+                        self.send_event(event)
+                        self.sleep_between_events()
                         event_count += 1
                 else:
                     self.debug("SWITCHING BROKER")
 
+    def unregister_pub(self):
+        """ Tell broker publisher is disconnecting. Remove from storage. """
+        msg = {'disconnect': {'id': self.id, 'address': self.get_host_address(),
+            'topics': self.get_wire_topics()}}
+        self.debug(f"Disconnecting, telling broker: {msg}")
+        self.broker_reg_socket.send_string(json.dumps(msg))
+        # Wait for response
+        response = self.broker_reg_socket.recv_string()
+        self.debug(f"Broker response: {response} ")
+
     def disconnect(self):
         """ Method to disconnect from the pub/sub network """
+        # Don't leave events behind in partially filled batches
+        self.flush_expired_batches(force=True)
         # release all the locks and close the ZooKeeper session
         self.debug("Release all locks if any and close zooKeeper sessions")
         for lock in self.topics_locks:
+            if lock:
+                lock.release()
+        for lock in self.partition_locks.values():
             lock.release()
+        for party in self.partition_parties.values():
+            party.leave()
         self.zk.stop()
         self.zk.close()
+        for ring in self.shm_rings.values():
+            ring.close()
+        if self.shm_context:
+            self.shm_context.destroy()
+        if self.repair_context:
+            self.repair_context.destroy(linger=0)
+            self.repair_socket = None
 
         # Close all sockets associated with this context
-        # Tell broker publisher is disconnecting. Remove from storage.
         self.debug("Disconnect")
-        msg = {'disconnect': {'id': self.id, 'address': self.get_host_address(),
-            'topics': self.topics}}
-        self.debug(f"Disconnecting, telling broker: {msg}")
-        self.broker_reg_socket.send_string(json.dumps(msg))
-        # Wait for response
-        response = self.broker_reg_socket.recv_string()
-        self.debug(f"Broker response: {response} ")
+        self.unregister_pub()
         try:
             self.debug(f'Destroying ZMQ context, closing all sockets')
             self.context.destroy()
@@ -0,0 +1,147 @@
+""" Single-writer, multi-reader ring buffer in shared memory, used as a transport between a
+publisher (or, with centralized dissemination, a broker) and subscribers on the same host
+(one ring per topic).
+
+Segment layout (little endian):
+    header: magic (u32), slot_count (u32), slot_size (u32), unused (u32), write_seq (u64)
+    slots:  slot_count slots of slot_size bytes, each [seq (u64), length (u32), unused (u32), data]
+
+The writer fills slot write_seq % slot_count, stamps it with its sequence number and only then
+advances write_seq. While a slot is being rewritten its seq is set to EMPTY, so a reader that
+sees the expected seq both before and after copying the data knows the copy is intact. A reader
+that falls more than slot_count messages behind the writer has been lapped: the overwritten
+messages are counted in reader.lost and reading resumes at the oldest message still available.
+
+Readers are woken through a doorbell: the writer sends a tiny message on an ipc PUB socket after
+every write, readers poll a SUB socket connected to it and then drain the ring.
+"""
+import os
+import struct
+import tempfile
+import uuid
+import zmq
+from multiprocessing import shared_memory
+
+MAGIC = 0x50534852
+HEADER = struct.Struct('<IIIIQ')
+WRITE_SEQ_OFFSET = 16
+SLOT_HEADER = struct.Struct('<QII')
+EMPTY = 2 ** 64 - 1
+
+# Segments created by writers in this process (tracked and unlinked by the writer)
+_owned_segments = set()
+
+
+def doorbell_endpoint(name):
+    return f"ipc://{os.path.join(tempfile.gettempdir(), f'pubsub-{name}.doorbell')}"
+
+
+class ShmRingWriter:
+    def __init__(self, context, slot_count=256, slot_size=16384):
+        """ Create a new ring segment and its doorbell
+        Args:
+        - context (zmq.Context) - context for the doorbell socket
+        - slot_count (int) - number of messages the ring holds
+        - slot_size (int) - max bytes per message (including a 16 byte slot header)
+        """
+        self.name = f'pubsub-{uuid.uuid4().hex[:16]}'
+        self.slot_count = slot_count
+        self.slot_size = slot_size
+        self.shm = shared_memory.SharedMemory(
+            name=self.name, create=True, size=HEADER.size + slot_count * slot_size)
+        _owned_segments.add(self.name)
+        HEADER.pack_into(self.shm.buf, 0, MAGIC, slot_count, slot_size, 0, 0)
+        for i in range(slot_count):
+            SLOT_HEADER.pack_into(self.shm.buf, self.slot_offset(i), EMPTY, 0, 0)
+        self.seq = 0
+        self.doorbell = doorbell_endpoint(self.name)
+        self.doorbell_socket = context.socket(zmq.PUB)
+        self.doorbell_socket.bind(self.doorbell)
+
+    def slot_offset(self, seq):
+        return HEADER.size + (seq % self.slot_count) * self.slot_size
+
+    def describe(self):
+        """ What a reader needs to attach: advertised to subscribers through the broker """
+        return {'segment': self.name, 'doorbell': self.doorbell}
+
+    def write(self, data):
+        """ Append one message (bytes-like) to the ring and ring the doorbell """
+        if len(data) > self.slot_size - SLOT_HEADER.size:
+            raise ValueError(
+                f'Message of {len(data)} bytes does not fit in a {self.slot_size} byte ring slot')
+        offset = self.slot_offset(self.seq)
+        buf = self.shm.buf
+        SLOT_HEADER.pack_into(buf, offset, EMPTY, 0, 0)
+        start = offset + SLOT_HEADER.size
+        buf[start:start + len(data)] = data
+        SLOT_HEADER.pack_into(buf, offset, self.seq, len(data), 0)
+        self.seq += 1
+        struct.pack_into('<Q', buf, WRITE_SEQ_OFFSET, self.seq)
+        self.doorbell_socket.send(b'', zmq.NOBLOCK)
+
+    def close(self):
+        self.doorbell_socket.close()
+        self.shm.close()
+        self.shm.unlink()
+        _owned_segments.discard(self.name)
+
+
+class ShmRingReader:
+    def __init__(self, context, segment, doorbell):
+        """ Attach to an existing ring. Reading starts with the next message written.
+        Args:
+        - context (zmq.Context) - context for the doorbell socket
+        - segment (str) - shared memory segment name
+        - doorbell (str) - ipc endpoint of the writer's doorbell
+        """
+        self.shm = shared_memory.SharedMemory(name=segment)
+        if segment not in _owned_segments:
+            try:
+                # Only the writer owns (and unlinks) the segment; don't let this process's
+                # resource tracker unlink it on exit. (If the writer runs in this process,
+                # the registration is the writer's and must stay.)
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(self.shm._name, 'shared_memory')
+            except Exception:
+                pass
+        magic, self.slot_count, self.slot_size, unused, write_seq = HEADER.unpack_from(self.shm.buf, 0)
+        if magic != MAGIC:
+            raise ValueError(f'Shared memory segment {segment} is not a publish ring')
+        self.next_seq = write_seq
+        # Number of messages overwritten before this reader got to them
+        self.lost = 0
+        self.doorbell_socket = context.socket(zmq.SUB)
+        self.doorbell_socket.connect(doorbell)
+        self.doorbell_socket.setsockopt(zmq.SUBSCRIBE, b'')
+
+    def read(self):
+        """ Drain pending doorbells and return all messages (bytes) written since the last read """
+        while True:
+            try:
+                self.doorbell_socket.recv(zmq.NOBLOCK)
+            except zmq.error.Again:
+                break
+        buf = self.shm.buf
+        write_seq = struct.unpack_from('<Q', buf, WRITE_SEQ_OFFSET)[0]
+        if write_seq - self.next_seq > self.slot_count:
+            # Lapped by the writer; skip to the oldest message still in the ring
+            self.lost += write_seq - self.slot_count - self.next_seq
+            self.next_seq = write_seq - self.slot_count
+        messages = []
+        while self.next_seq < write_seq:
+            offset = HEADER.size + (self.next_seq % self.slot_count) * self.slot_size
+            seq, length, unused = SLOT_HEADER.unpack_from(buf, offset)
+            start = offset + SLOT_HEADER.size
+            data = bytes(buf[start:start + length])
+            if seq == self.next_seq and SLOT_HEADER.unpack_from(buf, offset)[0] == seq:
+                messages.append(data)
+            else:
+                # Slot was rewritten while we were reading it
+                self.lost += 1
+            self.next_seq += 1
+        return messages
+
+    def close(self):
+        self.doorbell_socket.close()
+        self.shm.close()
@@ -1,10 +1,16 @@
 from .zookeeper_client import ZookeeperClient
+from . import message
+from . import transport
+from .shm_ring import ShmRingReader
+from .placement import choose_zone, placement_key
+from .dissemination import CENTRALIZED, DIRECT
+from . import partitions
+from .consumer_groups import CREDIT, ACK
 import zmq
+from collections import deque
 import logging
-import random
 import json
 import time
-import pickle
 import netifaces
 import sys
 
@@ -18,7 +24,9 @@ class Subscriber(ZookeeperClient):
     def __init__(self, broker_address='127.0.0.1', filename=None,
         topics=[], indefinite=False,
         max_event_count=15, centralized=False, zookeeper_hosts=["127.0.0.1:2181"],
-        verbose=False, requested=1):
+        verbose=False, requested=1, payload_handler=None, codecs=None, placement='random', edge=None,
+        adaptive=False, partitions=1, group=None, group_credits=10, replay_seconds=None,
+        repair_window=1000, repair_timeout=500, repair_retries=3, name=None):
         """ Constructor
         args:
         - broker_address - IP address of broker
@@ -26,14 +34,64 @@ class Subscriber(ZookeeperClient):
         - topics (list) - list of topics this subscriber should subscribe to / 'is interested in'
         - indefinite (boolean) - whether to listen for published updates indefinitely
         - max_event_count (int) - if not (indefinite), max number of relevant published updates to receive
+        - payload_handler (callable) - optional, called as payload_handler(topic, payload) with the
+          binary payload of each newly received event; payloads are memoryviews (or numpy arrays)
+          backed directly by the received ZMQ frame
+        - codecs (list) - compression codecs this subscriber accepts; defaults to all supported
+        - placement (str) - how to choose a zone, one of placement.PLACEMENT_STRATEGIES
+        - name (str) - optional name of this client, stable across restarts, which rendezvous
+          placement hashes instead of its address and topics
+        - edge (str) - optional name of the edge broker to register with instead of a zone
+          broker (centralized dissemination, see edge_broker.py)
+        - adaptive (bool) - with centralized, let an adaptive broker switch each topic between
+          its stream and direct publisher connections (see dissemination.py)
+        - partitions (int) - number of partitions of topics whose publishers have not
+          partitioned them yet (see partitions.py); a recorded partition count always wins
+        - group (str) - with centralized, optional consumer group to join: the topics' messages
+          are shared among the group's subscribers instead of all sent to each of them
+          (see consumer_groups.py)
+        - group_credits (int) - with group, max number of messages per topic the broker sends
+          ahead of processing
+        - replay_seconds (float) - with centralized, after registering, replay the topics'
+          messages of the last replay_seconds seconds from the broker's topic logs (see topic_log.py)
+        - repair_window (int) - when a gap is detected in a publisher's sequence numbers, ask it
+          for at most this many of the newest missing events; 0 only counts losses
+        - repair_timeout (int) - ms to wait for a repair reply before retrying
+        - repair_retries (int) - max repair requests sent per gap
          """
         self.verbose = verbose
         self.id = str(id(self))
+        self.placement = placement
+        self.name = name
+        self.edge = edge
         self.filename = filename
         self.broker_address = broker_address
         # self.own_address = own_address
         self.centralized = centralized
+        self.adaptive = adaptive
+        # Adaptive dissemination: 'centralized' or 'direct' per topic, as told by the broker
+        self.topic_modes = {}
         self.topics = topics # topic subscriber is interested in
+        # Partitioned topics: {topic: number of partitions}, set by resolve_partitions.
+        # All partitions of a topic are subscribed to and their events recorded under the topic.
+        self.partitions = partitions
+        self.topic_partitions = {}
+        # Consumer group and the DEALER socket its messages arrive on
+        self.group = group
+        self.group_credits = group_credits
+        self.group_socket = None
+        self.replay_seconds = replay_seconds
+        # Gap repair (see detect_gaps): (epoch, last sequence number) seen per (publisher, topic),
+        # {(publisher, topic): {'lost': n, 'repaired': n}}, DEALER sockets to the publishers'
+        # repair endpoints and the requests waiting for a reply on each, oldest first:
+        # {endpoint: deque of {'key', 'topic', 'first', 'last', 'attempts', 'deadline'}}
+        self.repair_window = repair_window
+        self.repair_timeout = repair_timeout
+        self.repair_retries = repair_retries
+        self.last_seqs = {}
+        self.repair_stats = {}
+        self.repair_sockets = {}
+        self.pending_repairs = {}
         self.set_logger()
         self.requested = requested
         # FIXME: subscriber needs to be aware of what zone it belongs to
@@ -55,6 +113,10 @@ class Subscriber(ZookeeperClient):
         # key = topic, value = socket for that topic
         self.sub_socket_dict = {}
 
+        # Shared memory rings of same-host publishers (decentralized dissemination):
+        # segment name -> {'topic': topic, 'reader': ShmRingReader}
+        self.shm_readers = {}
+
         # Socket for registering with broker
         self.broker_reg_socket = None
 
@@ -64,6 +126,11 @@ class Subscriber(ZookeeperClient):
 
         # a list to store all the messages received
         self.received_message_list = []
+        # Binary payload of the newest received event per topic, plus optional handler
+        self.latest_payloads = {}
+        self.payload_handler = payload_handler
+        # Declared at registration; publishers only compress a topic if all its subscribers accept the codec
+        self.codecs = list(message.CODECS) if codecs is None else codecs
 
         # port on broker to listen for notifications about new hosts
         # without competition/stealing from other subscriber poll()s
@@ -77,14 +144,36 @@ class Subscriber(ZookeeperClient):
         self.info(f"Successfully initialized subscriber object (SUB{id(self)})")
 
     def assign_to_zone(self):
-        """ Random assignment to load balance across zones """
+        """ Choose a zone to load balance across zones (see placement.py) """
         # This is the node this subscriber will watch for updated broker information in case of broker failure.
-        all_zones = self.zk.get_children("/primaries/")
-        self.zone = random.choice(all_zones)
+        all_zones = self.get_znode_children("/primaries/")
+        # Zones being drained by the backup pool don't take new clients
+        retired = self.get_retired_zones()
+        all_zones = [zone for zone in all_zones if zone not in retired] or all_zones
+        self.zone = choose_zone(
+            self, all_zones, self.placement, placement_key(self.get_host_address(), self.topics, self.name),
+            port_index=2, topics=self.topics)
         self.debug(f"out of all zones ({all_zones}), choosing {self.zone}")
         self.broker_leader_znode = f'/primaries/{self.zone}'
         self.set_logger(prefix=f'SUB<{",".join(self.topics)}>:request={self.requested}:{self.zone}')
 
+    def assign_to_edge(self):
+        """ Register with an edge broker (typically the one on this subscriber's switch)
+        instead of a zone. Edges are not rebalanced, so the subscriber stays with its edge. """
+        self.zone = f'edge_{self.edge}'
+        self.broker_leader_znode = f'/edges/{self.edge}'
+        self.set_logger(prefix=f'SUB<{",".join(self.topics)}>:request={self.requested}:{self.zone}')
+
+    def resolve_partitions(self):
+        """ Look up the partition count of each topic """
+        self.topic_partitions = self.get_topic_partitions(self.topics, self.partitions)
+        if self.topic_partitions:
+            self.info(f"Partitioned topics: {self.topic_partitions}")
+
+    def get_wire_topics(self):
+        """ Topics as registered with the broker: partitioned topics as all their partitions """
+        return partitions.expand_topics(self.topics, self.topic_partitions)
+
     def set_logger(self, prefix=None ):
         if not prefix:
             self.prefix = {'prefix': f'SUB<{",".join(self.topics)}>'}
@@ -112,12 +201,17 @@ class Subscriber(ZookeeperClient):
         """  Watch callback function invoked upon change to znode of interest.
         Watch effective only once so the client has to set the watch every time.
         Decorator zk.DataWatch used to overcome this. """
-        @self.zk.DataWatch(self.broker_leader_znode)
+        broker_leader_znode = self.broker_leader_znode
+
+        @self.zk.DataWatch(broker_leader_znode)
         def dump_data_change (data, stat, event):
+            if broker_leader_znode != self.broker_leader_znode:
+                # Migrated to another zone; its watch took over
+                return False
             if event == None:
                 self.WATCH_FLAG = True
                 self.debug("No ZNODE Event - First Watch Call! Initializing subscriber...")
-                self.update_broker_info(znode_value=self.get_znode_value(znode_name=self.broker_leader_znode))
+                self.update_broker_info(znode_value=self.cache_watched_value(broker_leader_znode, data))
                 self.configure()
                 self.WATCH_FLAG = False
             elif event.type == 'CHANGED':
@@ -125,15 +219,52 @@ class Subscriber(ZookeeperClient):
                 self.debug("ZNODE CHANGED")
                 self.debug("Broker Changed! Destroying context and clearing topic connection dict")
                 self.sub_socket_dict.clear()
+                self.repair_sockets.clear()
+                self.pending_repairs.clear()
+                self.close_shm_readers()
                 self.context.destroy()
                 self.debug(f"Data changed for znode: data={data},stat={stat}")
-                self.update_broker_info(znode_value=self.get_znode_value(znode_name=self.broker_leader_znode))
+                self.update_broker_info(znode_value=self.cache_watched_value(broker_leader_znode, data))
                 self.debug("Reconfiguring...")
                 self.configure()
                 self.WATCH_FLAG = False
             elif event.type == 'DELETED':
                 self.debug("ZNODE DELETED")
 
+    def watch_migration(self):
+        """ Watch /migrations/<id>, where the backup pool asks this subscriber to move to
+        another zone to rebalance zones or drain a retired one """
+        self.migration_znode = f'/migrations/{self.id}'
+
+        @self.zk.DataWatch(self.migration_znode)
+        def migration_change(data, stat):
+            if data:
+                self.migrate_to_zone(json.loads(data)['zone'])
+
+    def migrate_to_zone(self, zone):
+        """ Move to another zone: unregister from the current broker, then watch and register
+        with the new zone's primary. Deletes the migration znode when done.
+        Args:
+        - zone (str) - zone to move to, e.g. zone_2 """
+        if zone != self.zone and self.znode_exists(znode_name=f'/primaries/{zone}'):
+            self.info(f"Migrating from {self.zone} to {zone}")
+            self.WATCH_FLAG = True
+            try:
+                self.unregister_sub()
+            except zmq.error.ZMQError as e:
+                self.error(f"Could not unregister from {self.zone}: {e}")
+            self.sub_socket_dict.clear()
+            self.repair_sockets.clear()
+            self.pending_repairs.clear()
+            self.close_shm_readers()
+            self.context.destroy()
+            self.zone = zone
+            self.broker_leader_znode = f'/primaries/{zone}'
+            self.set_logger(prefix=f'SUB<{",".join(self.topics)}>:request={self.requested}:{self.zone}')
+            # The first call of the new watch registers with the new broker
+            self.watch_znode_data_change()
+        self.delete_znode(znode_name=self.migration_znode)
+
     def configure(self):
         """ Method to perform initial configuration of Subscriber entity """
         self.debug("Configure Start")
@@ -168,12 +299,17 @@ class Subscriber(ZookeeperClient):
     def register_sub(self):
         """ Register self with broker """
         self.debug(f"Registering with broker at {self.broker_address}:{self.sub_reg_port}")
-        message_dict = {'address': self.get_host_address(), 'id': self.id, 'topics': self.topics, 'requested': self.requested}
+        message_dict = {'address': self.get_host_address(), 'id': self.id, 'topics': self.get_wire_topics(),
+            'requested': self.requested, 'codecs': self.codecs}
+        if self.group:
+            message_dict['group'] = self.group
         message = json.dumps(message_dict, indent=4)
         self.broker_reg_socket.send_string(message)
         self.debug(f"Sent registration message: {json.dumps(message)}")
-        received_message = self.broker_reg_socket.recv_string()
-        received_message = json.loads(received_message)
+        # A centralized broker with a last-value cache appends the newest message of each
+        # topic to its reply (see Broker.get_last_values)
+        frames = self.broker_reg_socket.recv_multipart(copy=False)
+        received_message = json.loads(frames[0].bytes.decode('utf8'))
         self.debug(f"Registration start msg from broker: {received_message}")
         # Structure: {'register_sub': {'notify_port': notify_port}}
         if not self.centralized:
@@ -183,11 +319,73 @@ class Subscriber(ZookeeperClient):
             self.notify_port = received_message['register_sub']['notify_port']
             # Set up notification polling with that port
             self.setup_notification_polling()
+        elif self.group and '_group' in received_message:
+            self.setup_group_connection(received_message['_group'])
+        elif self.adaptive and '_notify_port' in received_message:
+            # Topics are sent through the broker or directly, as the broker decides.
+            # Publishers of direct topics come in notifications, like for decentralized.
+            self.topic_modes = received_message['_modes']
+            self.notify_port = received_message['_notify_port']
+            self.setup_notification_polling()
+            self.setup_broker_topic_port_connections(received_message, topics=[
+                topic for topic in self.get_wire_topics() if self.topic_modes.get(topic) == CENTRALIZED])
         else:
             # Get topics/ports mapping from received_message
             self.setup_broker_topic_port_connections(received_message)
             self.debug(f"Successfully set up broker topic/port connections")
+        self.parse_cached_messages(received_message.get('_cached', []), frames[1:])
         self.info("Registration successful")
+        if self.centralized and self.replay_seconds:
+            for topic in self.get_wire_topics():
+                self.replay(topic, from_time=time.time() - self.replay_seconds)
+
+    def replay(self, topic, from_seq=None, from_time=None):
+        """ CENTRALIZED DISSEMINATION
+        Process the messages of a topic logged by the broker from a sequence number or a time
+        on, asking for them batch by batch (see Broker.replay). Live messages received in
+        the meantime wait in their sockets; ones logged before the replay ended are received
+        twice.
+        Returns: sequence number following the last message replayed, None if the broker
+        keeps no topic log """
+        count = 0
+        while True:
+            request = {'topic': topic}
+            if from_seq is not None:
+                request['from_seq'] = from_seq
+            else:
+                request['from_time'] = from_time
+            self.broker_reg_socket.send_string(json.dumps({'replay': request}))
+            frames = self.broker_reg_socket.recv_multipart(copy=False)
+            reply = json.loads(frames[0].bytes.decode('utf8'))['replay']
+            if 'error' in reply:
+                self.error(f"Cannot replay topic {topic}: {reply['error']}")
+                return None
+            if from_seq is not None and from_seq < reply['first_seq']:
+                self.error(f"Messages {from_seq}-{reply['first_seq'] - 1} of topic {topic} are past retention")
+            for frame in frames[1:]:
+                received_topic, windows = message.parse_message(message.unpack_frames(frame.buffer))
+                for received_message in windows:
+                    self.parse_history_window(received_message)
+            count += len(frames) - 1
+            from_seq = reply['next_seq']
+            if len(frames) == 1:
+                self.info(f"Replayed {count} messages of topic {topic}")
+                return from_seq
+
+    def parse_cached_messages(self, cached, frames):
+        """ Process the cached newest messages of topics sent with the registration reply,
+        before any live message
+        Args:
+        - cached (list) - [topic, number of frames] of each message, in order
+        - frames (list) - frames of those messages, concatenated
+        """
+        index = 0
+        for topic, num_frames in cached:
+            self.debug(f"Cached message of topic {topic} from the broker")
+            received_topic, windows = message.parse_message(frames[index:index + num_frames])
+            for received_message in windows:
+                self.parse_history_window(received_message)
+            index += num_frames
 
     def setup_publisher_direct_connections(self, notification=None):
         """ Method to set up direct connections with publishers
@@ -207,44 +405,55 @@ class Subscriber(ZookeeperClient):
         for item in notification:
             # each item = { 'register_pub': { 'addresses': addresses,  'topic': t } }
             publisher_addresses = item['register_pub']['addresses']
+            # Advertised tcp/ipc/inproc endpoints of each publisher (None if not advertised)
+            publisher_endpoints = item['register_pub'].get('endpoints') or [None] * len(publisher_addresses)
             # The topic these publishers publish
             topic = item['register_pub']['topic']
-            if topic in self.topics:
+            if topic in self.get_wire_topics() and self.topic_modes.get(topic, DIRECT) == DIRECT:
                 # Set up one SUB socket for topic if not already created
                 if topic not in self.sub_socket_dict:
                     self.sub_socket_dict[topic] = self.context.socket(zmq.SUB)
                     self.debug(f"Registering topic socket {self.sub_socket_dict[topic]} with poller")
                     self.poller.register(self.sub_socket_dict[topic], zmq.POLLIN)
                 # Connect to publisher addresses if topic is of interest
-                for p in publisher_addresses:
+                for p, endpoints in zip(publisher_addresses, publisher_endpoints):
                     self.debug(f'Adding publisher {p} to known publishers')
+                    if self.attach_shm_ring(topic, endpoints):
+                        continue
                     # p includes port!
-                    self.sub_socket_dict[topic].connect(f"tcp://{p}")
+                    self.sub_socket_dict[topic].connect(self.select_endpoint(endpoints, f"tcp://{p}"))
                     self.sub_socket_dict[topic].setsockopt_string(zmq.SUBSCRIBE, topic)
 
 
         self.debug("Finished setting up direct publisher connections")
 
-    def setup_broker_topic_port_connections(self, received_message):
+    def setup_broker_topic_port_connections(self, received_message, topics=None):
         """ Method to set up one socket per topic to listen to the broker
         where each topic is published from a different port on the broker address
-        Args: received_message (dict) - message received from broker containing mapping
-        between topics published from the broker and ports on which they will be published
+        Args:
+        - received_message (dict) - message received from broker containing mapping
+          between topics published from the broker and ports on which they will be published
+        - topics (list) - topics to listen to the broker for; defaults to all topics
         """
         self.debug(f"Broker port dict: {received_message}")
         # Broker will provide the published events so
         # create socket to receive message from broker
-        for topic in self.topics:
+        for topic in self.get_wire_topics() if topics is None else topics:
             # Get the port on which the broker publishes about this topic
             broker_port = received_message[topic]
+            # Same host as the broker: read the topic from the broker's shared memory ring
+            if self.attach_shm_ring(topic, received_message.get('_endpoints', {}).get(topic)):
+                continue
             # One SUB socket per topic
             self.sub_socket_dict[topic] = self.context.socket(zmq.SUB)
             self.debug(f"Registering topic socket {self.sub_socket_dict[topic]} with poller")
             self.poller.register(self.sub_socket_dict[topic], zmq.POLLIN)
-            self.debug(
-                f"Connecting to broker for topic <{topic}> at "
-                f"tcp://{self.broker_address}:{broker_port}")
-            self.sub_socket_dict[topic].connect(f"tcp://{self.broker_address}:{broker_port}")
+            endpoint = self.select_endpoint(
+                received_message.get('_endpoints', {}).get(topic),
+                f"tcp://{self.broker_address}:{broker_port}"
+            )
+            self.debug(f"Connecting to broker for topic <{topic}> at {endpoint}")
+            self.sub_socket_dict[topic].connect(endpoint)
             # Set filter <topic> on the socket
             self.sub_socket_dict[topic].setsockopt_string(zmq.SUBSCRIBE, topic)
             self.debug(
@@ -252,6 +461,87 @@ class Subscriber(ZookeeperClient):
                 f"{self.broker_address}:{broker_port}"
                 )
 
+    def setup_group_connection(self, group_info):
+        """ CONSUMER GROUPS
+        Connect to the broker's group socket, which sends this subscriber its share of the
+        topics' messages, and give the broker group_credits credits per topic
+        Args:
+        - group_info (dict) - {'port': port, 'endpoints': endpoints} of the broker's group socket
+        """
+        self.group_socket = self.context.socket(zmq.DEALER)
+        self.group_socket.setsockopt(zmq.IDENTITY, self.id.encode('utf8'))
+        endpoint = self.select_endpoint(
+            group_info['endpoints'], f"tcp://{self.broker_address}:{group_info['port']}")
+        self.debug(f"Joining consumer group {self.group} at {endpoint}")
+        self.group_socket.connect(endpoint)
+        self.poller.register(self.group_socket, zmq.POLLIN)
+        for topic in self.get_wire_topics():
+            self.group_socket.send_multipart([CREDIT, topic.encode('utf8'), str(self.group_credits).encode('utf8')])
+
+    def parse_group_event(self):
+        """ CONSUMER GROUPS
+        Process a message received from the group socket, then acknowledge it, which also
+        gives its credit back
+        Returns: number of history windows received """
+        frames = self.group_socket.recv_multipart(copy=False)
+        received_topic, windows = message.parse_message(frames)
+        for received_message in windows:
+            self.parse_history_window(received_message)
+        self.group_socket.send_multipart([ACK, received_topic, b'1'])
+        return len(windows)
+
+    def attach_shm_ring(self, topic, endpoints):
+        """ Read a publisher's (or, with centralized dissemination, the broker's) topic from its
+        shared memory ring instead of a socket if it offers one and runs on this host.
+        Returns: True if attached (or already attached) """
+        if not endpoints or topic not in endpoints.get('shm', {}):
+            return False
+        if endpoints.get('host') != transport.host_id(self.get_host_address()):
+            return False
+        ring = endpoints['shm'][topic]
+        if ring['segment'] not in self.shm_readers:
+            try:
+                reader = ShmRingReader(self.context, ring['segment'], ring['doorbell'])
+            except (FileNotFoundError, ValueError) as e:
+                self.error(f"Cannot attach shared memory ring {ring['segment']}: {e}")
+                return False
+            self.debug(f"Reading topic {topic} from shared memory ring {ring['segment']}")
+            self.shm_readers[ring['segment']] = {'topic': topic, 'reader': reader}
+            self.poller.register(reader.doorbell_socket, zmq.POLLIN)
+        return True
+
+    def close_shm_readers(self):
+        for shm in self.shm_readers.values():
+            shm['reader'].close()
+        self.shm_readers.clear()
+
+    def parse_shm_events(self, events):
+        """ Read all new messages from shared memory rings whose doorbell rang.
+        Returns: number of history windows received """
+        count = 0
+        for segment, shm in self.shm_readers.items():
+            reader = shm['reader']
+            if reader.doorbell_socket not in events:
+                continue
+            lost = reader.lost
+            for data in reader.read():
+                topic, windows = message.parse_message(message.unpack_frames(data))
+                for received_message in windows:
+                    self.parse_history_window(received_message)
+                count += len(windows)
+            if reader.lost > lost:
+                self.error(
+                    f"Fell behind on shared memory ring {segment} ({shm['topic']}): "
+                    f"{reader.lost - lost} messages overwritten before they were read")
+        return count
+
+    def select_endpoint(self, endpoints, tcp_endpoint):
+        """ Cheapest of the advertised endpoints (inproc, ipc, tcp) reachable from this
+        subscriber; tcp_endpoint if the peer did not advertise any """
+        if not endpoints:
+            return tcp_endpoint
+        return transport.select_endpoint(endpoints, self.get_host_address(), self.context)
+
     def parse_notification(self):
         """ DECENTRALIZED DISSEMINATION
         Method to parse notification about new publishers from broker
@@ -261,36 +551,190 @@ class Subscriber(ZookeeperClient):
         self.debug("Parsing notification...")
         notification = self.notify_sub_socket.recv_string()
         self.debug(f"Notification: {notification}")
-        if 'register_pub' in notification:
+        if 'switch_mode' in notification:
+            notification = json.loads(notification)
+            for item in notification:
+                if 'switch_mode' in item:
+                    self.switch_topic_mode(**item['switch_mode'])
+            self.setup_publisher_direct_connections(
+                notification=[item for item in notification if 'register_pub' in item])
+            self.notify_sub_socket.send_string("Notification Acknowledged. Topic switched.")
+        elif 'register_pub' in notification:
             self.debug(f"New register_pub notification...")
             notification = json.loads(notification) # [{'register_pub':{'addresses': [<pub address list>], 'topic': topic published by these pubs}},...]
             self.setup_publisher_direct_connections(notification=notification)
             self.notify_sub_socket.send_string("Notification Acknowledged. New publishers added.")
 
+    def switch_topic_mode(self, topic, mode, port=None, endpoints=None):
+        """ ADAPTIVE DISSEMINATION
+        Stop receiving a topic on its current path (after reading what already arrived on
+        it) and, when switching to the broker, connect to the broker's stream. Publishers of
+        a topic switching to direct follow in the same notification.
+        Args:
+        - topic (str)
+        - mode (str) - 'centralized' or 'direct'
+        - port (int) - broker port of the topic, when switching to centralized
+        - endpoints (dict) - broker endpoints of the topic, when switching to centralized
+        """
+        self.info(f"Switching topic {topic} to {mode} dissemination")
+        if topic in self.sub_socket_dict:
+            while self.sub_socket_dict[topic].poll(0):
+                self.parse_publish_event(topic=topic)
+            socket = self.sub_socket_dict.pop(topic)
+            self.poller.unregister(socket)
+            socket.close(linger=0)
+        for segment, shm in list(self.shm_readers.items()):
+            if shm['topic'] == topic:
+                self.poller.unregister(shm['reader'].doorbell_socket)
+                shm['reader'].close()
+                self.shm_readers.pop(segment)
+        self.topic_modes[topic] = mode
+        if mode == CENTRALIZED:
+            self.setup_broker_topic_port_connections(
+                {topic: port, '_endpoints': {topic: endpoints}}, topics=[topic])
+
     def parse_publish_event(self, topic=""):
-        """ Method to parse a published event for a given topic
+        """ Method to parse a published event for a given topic. A single message may carry a
+        batch of sliding-history windows from a batching publisher (see message.py).
+        Frames are received without copying so that binary payloads stay zero-copy.
         Args: topic (string) - topic this publish event corresponds to
+        Returns: number of history windows received
          """
         self.debug(f"Waiting for publish event for topic {topic}")
-        # received_message = self.sub_socket_dict[topic].recv_string()
-        [topic, received_message] = self.sub_socket_dict[topic].recv_multipart()
-        received_message = pickle.loads(received_message)
-        self.debug(f'Received: <{json.dumps(received_message)}>')
+        frames = self.sub_socket_dict[topic].recv_multipart(copy=False)
+        received_topic, windows = message.parse_message(frames)
+        if received_topic.decode('utf8') != topic:
+            # Subscriptions are prefix matches: another topic starting with this one
+            return 0
+        for received_message in windows:
+            self.parse_history_window(received_message)
+        return len(windows)
+
+    def parse_history_window(self, received_message):
+        """ Method to process one received sliding-history window (list of events) """
+        if self.verbose:
+            self.debug(f'Received: <{json.dumps(received_message, default=str)}>')
         # Received message is a list of messages structured as a sliding window whose max
         # size is the publisher source's "offered" value. Must be >= sub's requested size to process.
+        self.detect_gaps(received_message)
         if len(received_message) >= self.requested:
             self.info(f"Received message length ({len(received_message)}) >= requested ({self.requested})!")
             for historical_message in received_message:
-                self.received_message_list.append(
-                    {
-                        'publisher': historical_message['publisher'],
-                        'topic': historical_message['topic'],
-                        'total_time_seconds': time.time() - float(historical_message['publish_time'])
-                    }
-                )
+                self.record_event(historical_message)
+            # Newest event of the window is the one just published
+            newest = received_message[-1]
+            if 'payload' in newest:
+                self.latest_payloads[newest['topic']] = newest['payload']
+                if self.payload_handler:
+                    self.payload_handler(newest['topic'], newest['payload'])
         else:
             self.debug("Received message smaller than what I requested. Not processing.")
 
+    def record_event(self, event):
+        self.received_message_list.append(
+            {
+                'publisher': event['publisher'],
+                'topic': event['topic'],
+                'total_time_seconds': time.time() - float(event['publish_time'])
+            }
+        )
+
+    def detect_gaps(self, window):
+        """ Check the sequence numbers of the newest event's publisher and topic in a history
+        window. Events missed since the previous window of that publisher and topic (beyond
+        what this window's history covers, e.g. dropped under load or during a broker
+        failover) are requested from the publisher; the reply is handled by handle_repairs
+        so the receive loop does not wait for it. """
+        newest = window[-1]
+        if 'seq' not in newest or self.group:
+            # Consumer group members only get a share of the events
+            return
+        topic = newest['topic']
+        if newest.get('partition') is not None:
+            topic = partitions.partition_topic(topic, newest['partition'])
+        key = (newest['publisher'], topic)
+        # A window may also hold events of the publisher's other topics
+        first = min(event['seq'] for event in window
+            if event['publisher'] == newest['publisher'] and event['topic'] == newest['topic']
+            and event.get('partition') == newest.get('partition'))
+        epoch, last = self.last_seqs.get(key, (None, None))
+        if epoch != newest.get('epoch'):
+            # First window of this publisher, or it restarted and its sequence numbers started over
+            self.last_seqs[key] = (newest.get('epoch'), newest['seq'])
+            return
+        if newest['seq'] > last:
+            self.last_seqs[key] = (epoch, newest['seq'])
+        if first <= last + 1:
+            return
+        stats = self.repair_stats.setdefault(key, {'lost': 0, 'repaired': 0})
+        stats['lost'] += first - last - 1
+        self.info(f"Missed events {last + 1}-{first - 1} of topic {topic} from {newest['publisher']}")
+        if self.repair_window and 'repair' in newest:
+            address = newest['publisher'].rsplit(':', 1)[0]
+            self.request_repair(
+                f"tcp://{address}:{newest['repair']}", key, topic, max(last + 1, first - self.repair_window), first - 1)
+
+    def request_repair(self, endpoint, key, topic, first, last):
+        """ Ask a publisher for the events first-last of a topic (a NACK), without waiting for
+        the reply (see handle_repairs)
+        Args:
+        - endpoint (str) - the publisher's repair endpoint
+        - key (tuple) - (publisher, topic) the repaired events are counted under
+        - topic (str) - topic as sent on the wire
+        - first, last (int) - sequence numbers of the missed events """
+        request = {'key': key, 'topic': topic, 'first': first, 'last': last, 'attempts': 0}
+        self.pending_repairs.setdefault(endpoint, deque()).append(request)
+        self.send_repair(endpoint, request)
+
+    def send_repair(self, endpoint, request):
+        if endpoint not in self.repair_sockets:
+            self.repair_sockets[endpoint] = self.context.socket(zmq.DEALER)
+            self.repair_sockets[endpoint].connect(endpoint)
+            if self.poller:
+                self.poller.register(self.repair_sockets[endpoint], zmq.POLLIN)
+        request['attempts'] += 1
+        request['deadline'] = time.time() + self.repair_timeout / 1000
+        # Empty delimiter frame, as a REQ socket would send
+        self.repair_sockets[endpoint].send_multipart([b'', json.dumps(
+            {'topic': request['topic'], 'first': request['first'], 'last': request['last']}).encode('utf8')])
+
+    def repair_poll_timeout(self):
+        """ ms until the oldest repair request times out, None (wait forever) if none is pending """
+        deadlines = [pending[0]['deadline'] for pending in self.pending_repairs.values() if pending]
+        if not deadlines:
+            return None
+        return max(0, (min(deadlines) - time.time()) * 1000)
+
+    def handle_repairs(self, events):
+        """ Record the events of repair replies that arrived, and retry timed out requests.
+        A publisher answers its requests in order, so each reply is for the oldest request
+        pending on its endpoint. When the oldest request gets no reply within repair_timeout
+        ms, the socket is replaced and every request pending on it sent again (lazy pirate
+        pattern); a request is given up after repair_retries attempts (its events stay lost).
+        Args:
+        - events (dict) - sockets ready to read, as returned by the poller """
+        for endpoint, socket in list(self.repair_sockets.items()):
+            pending = self.pending_repairs.get(endpoint)
+            while socket in events and pending and socket.poll(0):
+                frames = socket.recv_multipart(copy=False)
+                request = pending.popleft()
+                received_topic, windows = message.parse_message(frames[1:])
+                self.debug(
+                    f"Repaired {len(windows[0])} of events {request['first']}-{request['last']} of topic {request['topic']}")
+                for event in windows[0]:
+                    self.record_event(event)
+                self.repair_stats[request['key']]['repaired'] += len(windows[0])
+            if not pending or pending[0]['deadline'] > time.time():
+                continue
+            self.error(f"No repair reply from {endpoint} (attempt {pending[0]['attempts']}/{self.repair_retries})")
+            if self.poller:
+                self.poller.unregister(socket)
+            self.repair_sockets.pop(endpoint).close(linger=0)
+            retried = deque(request for request in pending if request['attempts'] < self.repair_retries)
+            self.pending_repairs[endpoint] = retried
+            for request in retried:
+                self.send_repair(endpoint, request)
+
     def notify(self):
         """ Method to poll for published events (or notifications about
         new publishers from broker) either indefinitely
@@ -302,7 +746,7 @@ class Subscriber(ZookeeperClient):
             while True:
                 if not self.WATCH_FLAG:
                     try:
-                        events = dict(self.poller.poll())
+                        events = dict(self.poller.poll(self.repair_poll_timeout()))
                     except zmq.error.ZMQError as e:
                         # Socket operation on non socket error expected here
                         # due to race condition when broker is being switched out.
@@ -317,6 +761,10 @@ class Subscriber(ZookeeperClient):
                         for topic, socket in self.sub_socket_dict.items():
                             if socket in events:
                                 self.parse_publish_event(topic=topic)
+                        if self.group_socket in events:
+                            self.parse_group_event()
+                        self.parse_shm_events(events)
+                        self.handle_repairs(events)
                 else:
                     self.debug("SWITCHING BROKER")
         else:
@@ -324,7 +772,7 @@ class Subscriber(ZookeeperClient):
             while event_count < self.max_event_count:
                 if not self.WATCH_FLAG:
                     try:
-                        events = dict(self.poller.poll())
+                        events = dict(self.poller.poll(self.repair_poll_timeout()))
                     except zmq.error.ZMQError as e:
                         # Socket operation on non socket error expected here
                         # due to race condition when broker is being switched out.
@@ -337,8 +785,11 @@ class Subscriber(ZookeeperClient):
                     else:
                         for topic, socket in self.sub_socket_dict.items():
                             if socket in events and event_count < self.max_event_count:
-                                event_count += 1
-                                self.parse_publish_event(topic=topic)
+                                event_count += self.parse_publish_event(topic=topic)
+                        if self.group_socket in events and event_count < self.max_event_count:
+                            event_count += self.parse_group_event()
+                        event_count += self.parse_shm_events(events)
+                        self.handle_repairs(events)
                 else:
                     self.debug("SWITCHING BROKER.")
 
@@ -354,6 +805,11 @@ class Subscriber(ZookeeperClient):
                     topic = message['topic']
                     total_time_seconds = message['total_time_seconds']
                     f.write(f'{publisher},{topic},{total_time_seconds}\n')
+            # Loss and repair counters go to a separate file so the format above stays the same
+            with open(f'{self.filename}.gaps', 'w') as f:
+                f.write('publisher,topic,lost,repaired\n')
+                for (publisher, topic), stats in self.repair_stats.items():
+                    f.write(f"{publisher},{topic},{stats['lost']},{stats['repaired']}\n")
         else:
             self.info("No filename was provided at construction of Subscriber")
 
@@ -371,17 +827,21 @@ class Subscriber(ZookeeperClient):
             address = "127.0.0.1"
         return address
 
-    def disconnect(self):
-        """ Method to disconnect from the pub/sub network """
-        # Close all sockets associated with this context
-        # Tell broker publisher is disconnecting. Remove from storage.
+    def unregister_sub(self):
+        """ Tell broker subscriber is disconnecting. Remove from storage. """
         msg = {'disconnect': {'id': self.id, 'address': self.get_host_address(),
-            'topics': self.topics, 'notify_port': self.notify_port}}
+            'topics': self.get_wire_topics(), 'notify_port': self.notify_port}}
         self.debug(f"Disconnecting, telling broker: {msg}")
         self.broker_reg_socket.send_string(json.dumps(msg))
         # Wait for response
         response = self.broker_reg_socket.recv_string()
         self.debug(f"Broker response: {response} ")
+
+    def disconnect(self):
+        """ Method to disconnect from the pub/sub network """
+        # Close all sockets associated with this context
+        self.unregister_sub()
+        self.close_shm_readers()
         try:
             self.debug(f'Destroying ZMQ context, closing all sockets')
             self.context.destroy()
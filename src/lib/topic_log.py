@@ -0,0 +1,217 @@
+""" Durable append-only log of one topic's messages, kept by centralized brokers for replay.
+
+The log is a directory of segment files, each named after the sequence number of its first
+record (<first seq, 20 digits>.log). Segments are preallocated to segment_bytes and
+memory-mapped; a record that does not fit in the active segment starts a new one.
+
+Record layout (little endian):
+    [length (u32), seq (u64), timestamp (f64), data (length bytes)]
+Preallocated space is zeros, so a length of 0 marks the end of a segment's records. On open,
+segments are scanned once to find their end and rebuild their sparse index.
+
+Each segment has a sparse in-memory index of (seq, timestamp, offset) entries, one at the
+start of the segment and one every index_interval bytes. A read from a sequence number or a
+timestamp finds its segment, jumps to the last index entry before the target and scans
+forward from there.
+
+Retention drops whole segments, oldest first, never the active one: while the log is larger
+than retention_bytes, or while a segment's newest record is older than retention_seconds.
+"""
+import mmap
+import os
+import struct
+import time
+from urllib.parse import quote
+
+RECORD_HEADER = struct.Struct('<IQd')
+SUFFIX = '.log'
+
+
+class Segment:
+    def __init__(self, path, base_seq, size=None):
+        """ Open a segment file, creating it with size bytes if it does not exist """
+        self.path = path
+        self.base_seq = base_seq
+        if size is not None and not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.truncate(size)
+        self.file = open(path, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        self.size = len(self.map)
+        # Offset new records are written at, sequence number of the next record and
+        # timestamps of the first and last records (None while empty)
+        self.end = 0
+        self.next_seq = base_seq
+        self.first_time = None
+        self.last_time = None
+        self.index = []
+
+    def records(self, offset=0):
+        """ Yield (offset, seq, timestamp, length) of the records from offset on """
+        while offset + RECORD_HEADER.size <= self.size:
+            length, seq, timestamp = RECORD_HEADER.unpack_from(self.map, offset)
+            if length == 0:
+                break
+            yield offset, seq, timestamp, length
+            offset += RECORD_HEADER.size + length
+
+    def recover(self, index_interval):
+        """ Find the end of an existing segment and rebuild its index """
+        for offset, seq, timestamp, length in self.records():
+            self.add_to_index(offset, seq, timestamp, index_interval)
+            self.end = offset + RECORD_HEADER.size + length
+            self.next_seq = seq + 1
+
+    def add_to_index(self, offset, seq, timestamp, index_interval):
+        if self.first_time is None:
+            self.first_time = timestamp
+        self.last_time = timestamp
+        if not self.index or offset - self.index[-1][2] >= index_interval:
+            self.index.append((seq, timestamp, offset))
+
+    def fits(self, length):
+        return self.end + RECORD_HEADER.size + length <= self.size
+
+    def append(self, data, timestamp, index_interval):
+        seq = self.next_seq
+        offset = self.end
+        # Data first, header last: a record only counts once its length is set
+        self.map[offset + RECORD_HEADER.size:offset + RECORD_HEADER.size + len(data)] = data
+        RECORD_HEADER.pack_into(self.map, offset, len(data), seq, timestamp)
+        self.add_to_index(offset, seq, timestamp, index_interval)
+        self.end = offset + RECORD_HEADER.size + len(data)
+        self.next_seq = seq + 1
+        return seq
+
+    def seek(self, seq=None, timestamp=None):
+        """ Offset of the last index entry before a sequence number or timestamp """
+        offset = 0
+        if seq is None and timestamp is None:
+            return offset
+        for entry_seq, entry_time, entry_offset in self.index:
+            if (seq is not None and entry_seq > seq) or (timestamp is not None and entry_time > timestamp):
+                break
+            offset = entry_offset
+        return offset
+
+    def read(self, offset, length):
+        start = offset + RECORD_HEADER.size
+        return bytes(self.map[start:start + length])
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class TopicLog:
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024, index_interval=4096,
+        retention_bytes=None, retention_seconds=None):
+        """
+        Args:
+        - directory (str) - directory of this topic's segments, created if needed
+        - segment_bytes (int) - size of each segment file
+        - index_interval (int) - bytes between two entries of a segment's sparse index
+        - retention_bytes (int) - optional max total size of the segments
+        - retention_seconds (float) - optional max age of the records
+        """
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.index_interval = index_interval
+        self.retention_bytes = retention_bytes
+        self.retention_seconds = retention_seconds
+        os.makedirs(directory, exist_ok=True)
+        self.segments = []
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(SUFFIX):
+                segment = Segment(os.path.join(directory, name), int(name[:-len(SUFFIX)]))
+                segment.recover(index_interval)
+                self.segments.append(segment)
+
+    @property
+    def next_seq(self):
+        """ Sequence number of the next record appended """
+        return self.segments[-1].next_seq if self.segments else 0
+
+    @property
+    def first_seq(self):
+        """ Sequence number of the oldest record kept """
+        return self.segments[0].base_seq if self.segments else 0
+
+    def append(self, data, timestamp=None):
+        """ Append a record
+        Args:
+        - data (bytes) - the record
+        - timestamp (float) - time of the record; defaults to now
+        Returns: sequence number of the record """
+        if not data:
+            raise ValueError('Empty records cannot be logged')
+        if timestamp is None:
+            timestamp = time.time()
+        if not self.segments or not self.segments[-1].fits(len(data)):
+            seq = self.next_seq
+            self.segments.append(Segment(
+                os.path.join(self.directory, f'{seq:020d}{SUFFIX}'), seq,
+                size=max(self.segment_bytes, RECORD_HEADER.size + len(data))))
+        return self.segments[-1].append(data, timestamp, self.index_interval)
+
+    def read(self, from_seq=None, from_time=None, max_records=None):
+        """ Records from a sequence number or from a time on, oldest first (all records if
+        neither is given)
+        Args:
+        - from_seq (int) - first sequence number to read
+        - from_time (float) - read records with a timestamp of at least from_time
+        - max_records (int) - optional max number of records
+        Returns: list of (seq, timestamp, data) """
+        records = []
+        for i, segment in enumerate(self.segments):
+            following = self.segments[i + 1] if i + 1 < len(self.segments) else None
+            # Skip segments wholly before the start
+            if from_seq is not None and following and following.base_seq <= from_seq:
+                continue
+            if from_time is not None and (segment.last_time is None or segment.last_time < from_time):
+                continue
+            for offset, seq, timestamp, length in segment.records(segment.seek(from_seq, from_time)):
+                if (from_seq is not None and seq < from_seq) or (from_time is not None and timestamp < from_time):
+                    continue
+                if max_records is not None and len(records) >= max_records:
+                    return records
+                records.append((seq, timestamp, segment.read(offset, length)))
+        return records
+
+    def size(self):
+        """ Total bytes of the segment files """
+        return sum(segment.size for segment in self.segments)
+
+    def enforce_retention(self, now=None):
+        """ Drop the oldest segments beyond retention_bytes or retention_seconds
+        Returns: number of segments dropped """
+        now = time.time() if now is None else now
+        dropped = 0
+        while len(self.segments) > 1:
+            oldest = self.segments[0]
+            too_big = self.retention_bytes is not None and self.size() > self.retention_bytes
+            too_old = (self.retention_seconds is not None and oldest.last_time is not None
+                and now - oldest.last_time > self.retention_seconds)
+            if not (too_big or too_old):
+                break
+            oldest.close()
+            os.remove(oldest.path)
+            self.segments.pop(0)
+            dropped += 1
+        return dropped
+
+    def flush(self):
+        """ Write the active segment's changes to disk """
+        if self.segments:
+            self.segments[-1].map.flush()
+
+    def close(self):
+        for segment in self.segments:
+            segment.map.flush()
+            segment.close()
+        self.segments = []
+
+
+def topic_directory(log_dir, topic):
+    """ Directory of a topic's log under log_dir (topic names are escaped) """
+    return os.path.join(log_dir, quote(topic, safe=''))
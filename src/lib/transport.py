@@ -0,0 +1,72 @@
+""" Endpoint advertisement and selection for publish data paths.
+
+Every data socket that others connect to (publisher PUB sockets, broker per-topic PUB sockets)
+binds tcp and, where possible, also ipc and inproc. The bound endpoints are advertised as a dict:
+    {'tcp': 'tcp://10.0.0.1:5556', 'ipc': 'ipc:///tmp/pubsub-<name>.ipc',
+     'inproc': 'inproc://pubsub-<name>', 'host': <host id>, 'context': <context id>}
+and the connecting peer picks the cheapest transport it can reach: inproc if it shares the
+ZMQ context (inproc only works within one context), ipc if it runs on the same host, tcp otherwise.
+
+The host id includes the host IP, so separate Mininet hosts (which share a kernel and a
+filesystem) never pick ipc and keep their traffic on the emulated links.
+"""
+import os
+import socket
+import tempfile
+import uuid
+import weakref
+import zmq
+
+# Id of each live context (see context_id). Entries go away with their context, so a new
+# context never inherits the id of a destroyed one, even at the same address.
+_context_ids = weakref.WeakKeyDictionary()
+
+
+def host_id(address):
+    """ Identify the host a process runs on from its IP address """
+    return f'{socket.gethostname()}/{address}'
+
+
+def context_id(context):
+    """ Identify a ZMQ context; only sockets of the same context can use inproc """
+    return f'{socket.gethostname()}/{os.getpid()}/{_context_ids.setdefault(context, uuid.uuid4().hex)}'
+
+
+def advertise(name, tcp_endpoint, address, context):
+    """ Endpoints to bind and advertise for a data socket
+    Args:
+    - name (str) - unique name of the socket (used in ipc path and inproc name)
+    - tcp_endpoint (str) - tcp endpoint peers on other hosts connect to
+    - address (str) - IP address of this host
+    - context (zmq.Context) - context the socket belongs to
+    """
+    endpoints = {
+        'tcp': tcp_endpoint,
+        'inproc': f'inproc://pubsub-{name}',
+        'host': host_id(address),
+        'context': context_id(context)
+    }
+    if zmq.has('ipc'):
+        endpoints['ipc'] = f"ipc://{os.path.join(tempfile.gettempdir(), f'pubsub-{name}.ipc')}"
+    return endpoints
+
+
+def bind_local(sock, endpoints):
+    """ Bind a socket (already bound to tcp) to the ipc and inproc endpoints it advertises """
+    for transport in ['ipc', 'inproc']:
+        if transport in endpoints:
+            sock.bind(endpoints[transport])
+
+
+def select_endpoint(endpoints, address, context):
+    """ Pick the cheapest advertised endpoint reachable from this process
+    Args:
+    - endpoints (dict) - advertised endpoints (see advertise)
+    - address (str) - IP address of the connecting host
+    - context (zmq.Context) - context of the connecting socket
+    """
+    if 'inproc' in endpoints and endpoints.get('context') == context_id(context):
+        return endpoints['inproc']
+    if 'ipc' in endpoints and endpoints.get('host') == host_id(address):
+        return endpoints['ipc']
+    return endpoints['tcp']
@@ -3,8 +3,28 @@ for basic zookeeper client functionality
 """
 import uuid
 import sys
+import json
+import threading
+import time
+import zlib
 from kazoo.client import KazooClient, KazooState
+from kazoo.exceptions import BadVersionError, KazooException, NoNodeError, NodeExistsError
+from kazoo.handlers.threading import KazooTimeoutError
 import logging
+from .partitions import PARTITIONS_ZNODE
+
+# Seconds to wait before retrying a reconciliation that failed to reach ZooKeeper
+RECONCILE_RETRY_SECONDS = 1
+
+# Subtrees whose values and children are served from the local watch-backed cache
+CACHED_PATHS = ['/primaries', '/shared_state', '/topics']
+
+
+def bucket_index(key, buckets):
+    """ Bucket (0..buckets-1) a key hashes to; stable across processes, unlike hash() """
+    return zlib.crc32(key.encode('utf-8')) % buckets
+
+
 class ZookeeperClient:
     def __init__(self, zookeeper_hosts=["127.0.0.1:2181"],verbose=False, use_logger=False):
         try:
@@ -16,11 +36,25 @@ class ZookeeperClient:
         self.zk = None
         self.zk_instance_id = str(uuid.uuid4())
         self.verbose = verbose
+        # Read-through cache for znodes under CACHED_PATHS: {path: value} and {path: children}.
+        # Each read sets a one-shot watch that drops the entry when the znode changes.
+        # cache_generation[path] (and cache_epoch, for the whole cache) is bumped on every
+        # invalidation so a read that raced with a change does not store a stale value.
+        self.cache_lock = threading.Lock()
+        self.value_cache = {}
+        self.children_cache = {}
+        self.cache_generation = {}
+        self.cache_epoch = 0
+        # Latest child lists / values waiting to be reconciled (see watch_children_coalesced):
+        # {znode_name: (children or value, reconcile, watch)}
+        self.reconcile_condition = threading.Condition()
+        self.pending_changes = {}
+        self.reconcile_thread = None
         if use_logger:
             self.set_logger()
 
     def clear_zookeeper(self):
-        for znode in ['/shared_state','/topics','/primaries']:
+        for znode in ['/shared_state','/topics','/primaries','/migrations','/retirements','/edges']:
             self.delete_znode(znode_name=znode, recursive=True)
 
     def debug(self, msg):
@@ -44,8 +78,11 @@ class ZookeeperClient:
     def listener4state (self, state):
         if state == KazooState.LOST:
             self.debug ("Current state is now = LOST")
+            # Watch events may have been missed; stop trusting cached values
+            self.clear_cache()
         elif state == KazooState.SUSPENDED:
             self.debug ("Current state is now = SUSPENDED")
+            self.clear_cache()
         elif state == KazooState.CONNECTED:
             self.debug ("Current state is now = CONNECTED")
         else:
@@ -93,37 +130,139 @@ class ZookeeperClient:
             self.error(f"Exception thrown in close (): {sys.exc_info()[0]}")
         return success
 
+    def normalize_path(self, znode_name):
+        """ Strip trailing slashes so that '/primaries/' and '/primaries' share a cache entry """
+        return znode_name.rstrip('/') or '/'
+
+    def is_cached_path(self, path):
+        return any(path == p or path.startswith(f'{p}/') for p in CACHED_PATHS)
+
+    def clear_cache(self):
+        with self.cache_lock:
+            self.value_cache.clear()
+            self.children_cache.clear()
+            self.cache_epoch += 1
+
+    def invalidate_cache(self, path):
+        with self.cache_lock:
+            self.value_cache.pop(path, None)
+            self.children_cache.pop(path, None)
+            self.cache_generation[path] = self.cache_generation.get(path, 0) + 1
+
+    def cache_version(self, path):
+        """ Must be called with cache_lock held """
+        return (self.cache_epoch, self.cache_generation.get(path, 0))
+
+    def cache_watch(self, event):
+        """ Watch callback set by cached reads: drop whatever we cached for the znode """
+        self.invalidate_cache(event.path)
+
+    def cache_watched_value(self, znode_name, data):
+        """ Store a value delivered by a DataWatch callback. Kazoo fires a znode's watches in
+        no particular order, so the one-shot cache_watch may not have dropped the old value
+        yet: reading it back here could return the value from before the change.
+        Returns the value (str), None if the znode was deleted """
+        path = self.normalize_path(znode_name)
+        value = data.decode('utf-8') if isinstance(data, bytes) else data
+        with self.cache_lock:
+            self.cache_generation[path] = self.cache_generation.get(path, 0) + 1
+            if value is None:
+                self.value_cache.pop(path, None)
+            elif self.is_cached_path(path):
+                self.value_cache[path] = value
+        return value
+
     def get_znode_value (self, znode_name=""):
+        """ Get a znode's value (str) in one round trip, or from the local cache if the znode
+        is under CACHED_PATHS and has not changed since it was last read.
+        Returns None if the znode does not exist. """
+        path = self.normalize_path(znode_name)
+        cached = self.is_cached_path(path)
+        if cached:
+            with self.cache_lock:
+                if path in self.value_cache:
+                    return self.value_cache[path]
+                version = self.cache_version(path)
         try:
-            self.debug (f"Checking if Znode {znode_name} exists")
-            if self.zk.exists (znode_name):
-                value, stat = self.zk.get (znode_name)
-                # ip, pub_reg_port, sub_reg_port
-                znode_value = value.decode("utf-8")
-                self.debug(
-                    f"Details of znode {znode_name}: value = {value}, "
-                    f"stat = {stat}"
-                    )
-                response = znode_value
-            else:
-                self.debug (f"{znode_name} znode does not exist")
-                response = None
+            self.debug (f"Getting value of znode {path}")
+            value, stat = self.zk.get(path, watch=self.cache_watch if cached else None)
+            # ip, pub_reg_port, sub_reg_port
+            znode_value = value.decode("utf-8")
+            self.debug(
+                f"Details of znode {path}: value = {value}, "
+                f"stat = {stat}"
+                )
+            response = znode_value
+            if cached:
+                with self.cache_lock:
+                    if self.cache_version(path) == version:
+                        self.value_cache[path] = znode_value
+        except NoNodeError:
+            self.debug (f"{path} znode does not exist")
+            response = None
         except Exception as e:
             self.error(f"Exception thrown checking for exists/get: {sys.exc_info()[0]}")
             response = f"Error: {str(e)}"
         return response
 
+    def get_retired_zones(self):
+        """ Zones retired, or being drained before retirement, by the backup pool """
+        try:
+            return self.get_znode_children("/retirements")
+        except NoNodeError:
+            return []
+
+    def get_topic_partitions(self, topics, partitions=1, create=False):
+        """ Number of partitions of each partitioned topic (see partitions.py)
+        Args:
+        - topics (list) - topic names
+        - partitions (int) - number of partitions for topics not partitioned yet
+        - create (bool) - record partitions for topics not partitioned yet (publishers); an
+          existing count always wins, so all clients of a topic agree
+        Returns: {topic: number of partitions}, only for topics with more than one """
+        values = self.get_znode_values([f'{PARTITIONS_ZNODE}/{topic}' for topic in topics])
+        topic_partitions = {}
+        for topic in topics:
+            value = values[f'{PARTITIONS_ZNODE}/{topic}']
+            if value is None and create and partitions > 1:
+                self.create_znodes([(PARTITIONS_ZNODE, "container of the partition count of each topic")])
+                self.create_znode(znode_name=f'{PARTITIONS_ZNODE}/{topic}', znode_value=partitions)
+                # Another publisher may have created it first
+                value = self.get_znode_value(znode_name=f'{PARTITIONS_ZNODE}/{topic}')
+            count = int(value) if value else partitions
+            if count > 1:
+                topic_partitions[topic] = count
+        return topic_partitions
+
+    def get_znode_children(self, znode_name=""):
+        """ Get a znode's children in one round trip, or from the local cache if the znode is
+        under CACHED_PATHS and its children have not changed since they were last read. """
+        path = self.normalize_path(znode_name)
+        if not self.is_cached_path(path):
+            return self.zk.get_children(path)
+        with self.cache_lock:
+            if path in self.children_cache:
+                return list(self.children_cache[path])
+            version = self.cache_version(path)
+        children = self.zk.get_children(path, watch=self.cache_watch)
+        with self.cache_lock:
+            if self.cache_version(path) == version:
+                self.children_cache[path] = list(children)
+        return children
+
     def create_znode(self, znode_name=None, znode_value=None, ephemeral=False):
         """ Create a znode with name = znode_name and value = either znode_value or
-        znode_value. Used by the broker specifically.  """
+        znode_value. Used by the broker specifically. Single round trip: an existing
+        znode is left untouched. """
         success = False
         try:
-            if self.zk.exists(znode_name):
-                self.debug(f'znode {znode_name} already exists')
-            else:
-                self.debug(f'Creating znode {znode_name} with value {znode_value}')
-                value = str(znode_value).encode('utf-8')
-                self.zk.create(znode_name, value=value, ephemeral=ephemeral)
+            self.debug(f'Creating znode {znode_name} with value {znode_value}')
+            value = str(znode_value).encode('utf-8')
+            self.zk.create(znode_name, value=value, ephemeral=ephemeral)
+            self.invalidate_written(self.normalize_path(znode_name))
+            success = True
+        except NodeExistsError:
+            self.debug(f'znode {znode_name} already exists')
             success = True
         except Exception as e:
             self.error(str(e))
@@ -131,41 +270,231 @@ class ZookeeperClient:
         return success
 
     def znode_exists(self, znode_name=None):
+        # Always asked to ZooKeeper: a cached entry outlives the znode until its one-shot
+        # watch fires, so the cache cannot tell a deleted znode from an existing one
         return self.zk.exists(znode_name)
 
     def delete_znode(self, znode_name=None, recursive=False):
         success = False
         try:
             self.zk.delete(znode_name, recursive=recursive)
+            self.invalidate_written(self.normalize_path(znode_name))
             success = True
         except Exception as e:
             self.error(str(e))
         return success
 
     def modify_znode_value(self, znode_name=None, znode_value=None):
-        """ Modify a znode value
+        """ Modify a znode value in a single round trip
         Args:
-        new_val (str): new value to set on the /broker znode """
+        znode_name (str): znode to modify
+        znode_value: new value to set on the znode
+        Returns: the new value (str), None if the znode does not exist """
         value = None
         try:
-            # Now let us change the data value on the znode and see if
-            # our watch gets invoked
             self.debug(f"Setting a new value = {znode_value} on znode {znode_name}")
-            if self.zk.exists (znode_name):
-                self.debug(f"{znode_name} znode exists; setting a new value on it")
-                znode_value = str(znode_value).encode('utf-8')
-                self.zk.set(znode_name, znode_value)
-                # Now see if the value was changed
-                value, stat = self.zk.get(znode_name)
-                self.debug(f"New value at znode {znode_name}: value = {value}, stat = {stat}")
-                value = value.decode("utf-8")
-            else:
-                self.debug(f"{znode_name} znode does not exist")
+            value = str(znode_value)
+            stat = self.zk.set(znode_name, value.encode('utf-8'))
+            self.debug(f"New value at znode {znode_name}: value = {value}, stat = {stat}")
+            # Our own write; the cache watch fires too, but don't serve the old value until then
+            self.invalidate_cache(self.normalize_path(znode_name))
+        except NoNodeError:
+            self.debug(f"{znode_name} znode does not exist")
+            value = None
         except Exception as e:
             self.error(f"Exception thrown checking for exists/set: {sys.exc_info()[0]}")
             value = str(e)
         return value
 
+    def invalidate_written(self, path):
+        """ Drop cache entries a create/set/delete of path may have made stale (the znode
+        itself and its parent's children) """
+        self.invalidate_cache(path)
+        self.invalidate_cache(path.rsplit('/', 1)[0] or '/')
+
+    def commit_transaction(self, operations):
+        """ Apply several writes atomically in a single round trip (ZooKeeper multi-op)
+        Args:
+        - operations (list) - tuples of ('create', znode_name, znode_value[, ephemeral]),
+          ('set', znode_name, znode_value) or ('delete', znode_name)
+        Returns: True if the transaction committed; otherwise none of the writes were applied """
+        transaction = self.zk.transaction()
+        paths = []
+        for operation in operations:
+            kind, path = operation[0], self.normalize_path(operation[1])
+            paths.append(path)
+            if kind == 'create':
+                ephemeral = operation[3] if len(operation) > 3 else False
+                transaction.create(path, str(operation[2]).encode('utf-8'), ephemeral=ephemeral)
+            elif kind == 'set':
+                transaction.set_data(path, str(operation[2]).encode('utf-8'))
+            elif kind == 'delete':
+                transaction.delete(path)
+            else:
+                raise ValueError(f'Unknown transaction operation {kind}')
+        success = False
+        try:
+            self.debug(f'Committing transaction: {operations}')
+            results = transaction.commit()
+            failures = [r for r in results if isinstance(r, Exception)]
+            if failures:
+                self.debug(f'Transaction rolled back: {failures}')
+            else:
+                success = True
+        except Exception as e:
+            self.error(f"Exception thrown in transaction commit (): {str(e)}")
+        for path in paths:
+            self.invalidate_written(path)
+        return success
+
+    def create_znodes(self, znodes):
+        """ Create several znodes with pipelined asynchronous requests, so the whole batch
+        costs about one round trip instead of one (or two) per znode. Requests are processed
+        in order, so parents must be listed before their children. Existing znodes are left
+        untouched.
+        Args:
+        - znodes (list) - (znode_name, znode_value) tuples
+        Returns: True if all znodes exist afterwards """
+        pending = []
+        for znode_name, znode_value in znodes:
+            path = self.normalize_path(znode_name)
+            self.debug(f'Creating znode {path} with value {znode_value}')
+            pending.append((path, self.zk.create_async(path, str(znode_value).encode('utf-8'))))
+        success = True
+        for path, async_result in pending:
+            try:
+                async_result.get()
+            except NodeExistsError:
+                self.debug(f'znode {path} already exists')
+            except Exception as e:
+                self.error(f'Exception thrown creating {path}: {str(e)}')
+                success = False
+            self.invalidate_written(path)
+        return success
+
+    def get_znode_values(self, znode_names):
+        """ Get the values of several znodes with pipelined asynchronous requests (about one
+        round trip for the whole batch). Values are not cached.
+        Args:
+        - znode_names (list) - znodes to read
+        Returns: {znode_name: value (str), or None if the znode does not exist}
+        Other errors (e.g. connection loss) are raised: callers read None as "gone". """
+        pending = [(name, self.zk.get_async(self.normalize_path(name))) for name in znode_names]
+        values = {}
+        for name, async_result in pending:
+            try:
+                value, stat = async_result.get()
+                values[name] = value.decode('utf-8')
+            except NoNodeError:
+                self.debug(f'{name} znode does not exist')
+                values[name] = None
+        return values
+
+    def watch_children_coalesced(self, znode_name, reconcile):
+        """ Watch a znode's children, handling bursts of changes in one pass. The watch
+        callback only records the latest child list; a single worker thread (shared by all
+        such watches of this client) calls reconcile(children) with the most recent list,
+        skipping any snapshots that were superseded while it was busy.
+        Args:
+        - znode_name (str) - znode whose children to watch
+        - reconcile (callable) - called with the current list of children
+        Returns: a function that stops the watch """
+        watch = {'stopped': False}
+
+        def stop():
+            watch['stopped'] = True
+
+        with self.reconcile_condition:
+            if self.reconcile_thread is None:
+                self.reconcile_thread = threading.Thread(target=self.reconcile_worker, daemon=True)
+                self.reconcile_thread.start()
+
+        @self.zk.ChildrenWatch(znode_name)
+        def changed_children(children):
+            if watch['stopped']:
+                # Returning False removes the ChildrenWatch
+                return False
+            with self.reconcile_condition:
+                self.pending_changes[znode_name] = (children, reconcile, watch)
+                self.reconcile_condition.notify()
+
+        return stop
+
+    def watch_data_coalesced(self, znode_name, reconcile):
+        """ Like watch_children_coalesced, for a znode's value: reconcile(value) is called
+        from the shared worker thread with the latest value (str, or None if the znode does
+        not exist).
+        Returns: a function that stops the watch """
+        watch = {'stopped': False}
+
+        def stop():
+            watch['stopped'] = True
+
+        with self.reconcile_condition:
+            if self.reconcile_thread is None:
+                self.reconcile_thread = threading.Thread(target=self.reconcile_worker, daemon=True)
+                self.reconcile_thread.start()
+
+        @self.zk.DataWatch(znode_name)
+        def changed_data(data, stat):
+            if watch['stopped']:
+                return False
+            value = data.decode('utf-8') if data is not None else None
+            with self.reconcile_condition:
+                self.pending_changes[znode_name] = (value, reconcile, watch)
+                self.reconcile_condition.notify()
+
+        return stop
+
+    def update_json_znode(self, znode_name, update):
+        """ Read-modify-write a znode holding a JSON object with versioned compare-and-set,
+        retrying if another client wrote it in between. The znode is created if missing.
+        Args:
+        - znode_name (str)
+        - update (callable) - takes the current object (dict) and returns the new one
+        Returns: the object written """
+        path = self.normalize_path(znode_name)
+        while True:
+            try:
+                value, stat = self.zk.get(path)
+            except NoNodeError:
+                updated = update({})
+                try:
+                    self.zk.create(path, json.dumps(updated).encode('utf-8'), makepath=True)
+                    break
+                except NodeExistsError:
+                    continue
+            updated = update(json.loads(value.decode('utf-8')) if value else {})
+            try:
+                self.zk.set(path, json.dumps(updated).encode('utf-8'), version=stat.version)
+                break
+            except (BadVersionError, NoNodeError):
+                self.debug(f'Concurrent update of {path}; retrying')
+        self.invalidate_written(path)
+        return updated
+
+    def reconcile_worker(self):
+        """ Run pending reconciliations from watch_children_coalesced and
+        watch_data_coalesced, oldest path first """
+        while True:
+            with self.reconcile_condition:
+                while not self.pending_changes:
+                    self.reconcile_condition.wait()
+                znode_name = next(iter(self.pending_changes))
+                change, reconcile, watch = self.pending_changes.pop(znode_name)
+            if watch['stopped']:
+                continue
+            try:
+                reconcile(change)
+            except (KazooException, KazooTimeoutError) as e:
+                # ZooKeeper unreachable: retry this snapshot later unless a newer one came in
+                self.error(f'Exception reconciling children of {znode_name}: {str(e)}; retrying')
+                time.sleep(RECONCILE_RETRY_SECONDS)
+                with self.reconcile_condition:
+                    self.pending_changes.setdefault(znode_name, (change, reconcile, watch))
+            except Exception as e:
+                self.error(f'Exception reconciling children of {znode_name}: {str(e)}')
+
     def debug(self, msg):
         self.logger.debug(msg, extra=self.prefix)
 
@@ -16,6 +16,13 @@ class CentralizedPerformanceTest(PerformanceTest):
         self.BACKUP_POOL_INDEX = 1
         self.BROKER_1_INDEX = 2
         self.BROKER_2_INDEX = 3
+        # Whether subscribers register with edge brokers on their switches (see setEdgeBrokers)
+        self.edge_brokers = False
+
+    def setEdgeBrokers(self, enabled):
+        """ Method to run one edge broker per switch above the subscribers, forming a tree
+        that matches the topology; subscribers register with the edge on their own switch """
+        self.edge_brokers = enabled
 
     def set_logger(self):
         self.prefix = {'prefix': f'CENTRALTEST-'}
@@ -63,6 +70,34 @@ class CentralizedPerformanceTest(PerformanceTest):
         self.debug(f'Broker 2 set up (WAITING, WARM PASSIVE BACKUP)! (IP: {broker_ip_2})')
         return broker_ip_1, broker_ip_2
 
+    def edge_name(self, level, host_index):
+        """ Name of the edge broker of the switch at level above host host_index """
+        return f'l{level}s{host_index // self.tree_fanout ** level}'
+
+    def setup_edge_brokers(self, network, num_subscribers, log_folder, zookeeper_host):
+        """ Start an edge broker for each switch with subscribers below it, on the first
+        subscriber host below that switch, from the root switch down """
+        subscriber_indices = range(self.OFFSET, num_subscribers + self.OFFSET)
+        for level in range(self.tree_depth, 0, -1):
+            edges = {}
+            for i in subscriber_indices:
+                edges.setdefault(self.edge_name(level, i), i)
+            for name, host_index in edges.items():
+                parent = ''
+                if level < self.tree_depth:
+                    parent = f'--edge_parent {self.edge_name(level + 1, host_index)} '
+                network.hosts[host_index].cmd(
+                    'python3 driver.py '
+                    '--broker 1 --verbose '
+                    f'--zookeeper_host {zookeeper_host} '
+                    f'--edge {name} {parent}'
+                    '--indefinite '
+                    '--centralized '
+                    f'&> {log_folder}/edge-{name}.log &'
+                )
+                self.debug(f'Edge broker {name} set up on host {host_index}')
+            time.sleep(1)
+
     def setup_subscribers(self, network, num_subscribers,
         broker_ip,data_folder,log_folder, zookeeper_host):
         """ Create subscribers in Mininet topology; one host per subscriber """
@@ -71,9 +106,13 @@ class CentralizedPerformanceTest(PerformanceTest):
         ]
         self.debug(f"Starting {num_subscribers} subscribers...")
         for index,host in enumerate(subscribers):
+            edge = ''
+            if self.edge_brokers:
+                edge = f'--edge {self.edge_name(1, index + self.OFFSET)} '
             host.cmd(
                 'python3 driver.py '
                 '--subscriber 1 '
+                f'{edge}'
                 f'--zookeeper_host {zookeeper_host} '
                 '--topics A --topics B --topics C '
                 f'--max_event_count {self.num_events} '
@@ -178,6 +217,8 @@ class CentralizedPerformanceTest(PerformanceTest):
         self.failures = 0
         self.comments = []
         if network and num_hosts:
+            if self.edge_brokers:
+                network_name = f'{network_name}-edges'
             data_folder, log_folder, test_results_file = self.prepare_folder_structure(network_name)
 
             self.debug("Starting network...")
@@ -193,6 +234,8 @@ class CentralizedPerformanceTest(PerformanceTest):
             zookeeper_host = f'{self.setup_zookeeper_server(network, log_folder, self.WAIT_FOR_ZK_START)}:2181'
             backup_pool_server = self.setup_backup_pool(network, log_folder)
             broker_ip_1, broker_ip_2 = self.setup_brokers(network,log_folder, zookeeper_host)
+            if self.edge_brokers:
+                self.setup_edge_brokers(network, num_subscribers, log_folder, zookeeper_host)
             subscribers = self.setup_subscribers(network,num_subscribers,broker_ip_1,
                 data_folder,log_folder, zookeeper_host
             )
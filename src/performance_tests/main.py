@@ -72,6 +72,11 @@ class TestDriver:
             centralized_perf_test.setWaitFactor(factor=depth*fanout)
             result = centralized_perf_test.test_tree_topology(depth=depth, fanout=fanout)
             results.append(result)
+            # Same tree with an edge broker per switch (written to the *-edges folders)
+            centralized_perf_test.setEdgeBrokers(True)
+            result = centralized_perf_test.test_tree_topology(depth=depth, fanout=fanout)
+            centralized_perf_test.setEdgeBrokers(False)
+            results.append(result)
         return results
 
 
@@ -109,6 +114,9 @@ class TestDriver:
                     num_hosts = int(network_folder.split('-')[-1].split('hosts')[0])
                     network_folder = os.path.join(__location__, f"data/{parent}/{network_folder}")
                     for f in os.listdir(network_folder):
+                        if not f.endswith('.csv'):
+                            # e.g. the subscribers' loss/repair counters (<file>.csv.gaps)
+                            continue
                         fpath = os.path.join(__location__, f"{network_folder}/{f}")
                         data = pd.read_csv(fpath).assign(parent=parent,num_hosts=num_hosts)
                         combined.append(data)
@@ -129,6 +137,8 @@ class TestDriver:
                 except FileExistsError:
                     pass
                 for file in os.listdir(f'{data_parent_folder}/{dir}'):
+                    if not file.endswith('.csv'):
+                        continue
                     # Get the data for this specific pub/sub system from the
                     # received messages file written by the subscriber
                     data = pd.read_csv(f'{data_parent_folder}/{dir}/{file}')
@@ -19,6 +19,10 @@ class PerformanceTest:
         self.failures = 0
         self.comments = []
         self.WAIT_FOR_ZK_START = 15
+        # Shape of the topology under test: host i sits below switch i // fanout**level
+        # at each level 1..depth (level 1 = the host's own switch, level depth = the root)
+        self.tree_depth = 1
+        self.tree_fanout = None
 
     def cleanup(self):
         """ Method to run the shell command mn -c to clean up existing mininet networks/resources
@@ -129,6 +133,8 @@ class PerformanceTest:
         """ Create and test Pub/Sub on a Tree topology with fanout^depth hosts,
         with one broker and an equal number of subscribers and publishers """
         tree = TreeTopo(depth=depth, fanout=fanout)
+        self.tree_depth = depth
+        self.tree_fanout = fanout
         network = self.create_network(topo=tree)
         results = self.test_network(
             network=network,
@@ -145,6 +151,8 @@ class PerformanceTest:
             # Raise exception. You need at least one broker, one subscriber and one publisher.
             raise Exception("Topology must include at least 3 hosts")
         topo = SingleSwitchTopo(n=num_hosts)
+        self.tree_depth = 1
+        self.tree_fanout = num_hosts
         network = self.create_network(topo=topo)
         results = self.test_network(
             network=network,
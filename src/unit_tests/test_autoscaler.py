@@ -0,0 +1,74 @@
+""" Module to perform unit tests against the autoscaling controller used by the BackupPool """
+import unittest
+from src.unit_tests import *
+from src.lib.autoscaler import AutoscalingController
+
+class TestAutoscaler(unittest.TestCase):
+    def setUp(self):
+        self.controller = AutoscalingController(
+            threshold=3, alpha=0.5, beta=0.5, horizon=10, cooldown=30,
+            hysteresis=0.2, max_new_zones=2, interval=120)
+
+    def test_steady_load_below_threshold(self):
+        for t in range(10):
+            self.controller.observe(2, t)
+        assert not self.controller.decide(10)[0]
+
+    def test_rising_trend_scales_out_before_threshold(self):
+        # Load rising by 0.15/s, still below the threshold
+        for t in range(10):
+            self.controller.observe(1 + 0.15 * t, t)
+        assert self.controller.level < 3
+        assert self.controller.decide(10)[0]
+
+    def test_cooldown_and_cap(self):
+        self.controller.observe(5, 0)
+        assert self.controller.decide(0)[0]
+        self.controller.record_scale_out(0)
+        self.controller.observe(5, 10)
+        assert not self.controller.decide(10)[0]
+        self.controller.observe(5, 31)
+        assert self.controller.decide(31)[0]
+        self.controller.record_scale_out(31)
+        # Cooldown is over but max_new_zones (2) were already added in the last 120s
+        self.controller.observe(5, 70)
+        assert not self.controller.decide(70)[0]
+        self.controller.observe(5, 121)
+        assert self.controller.decide(121)[0]
+
+    def test_hysteresis(self):
+        # No trend extrapolation, so only the level matters
+        self.controller.horizon = 0
+        self.controller.observe(4, 0)
+        assert self.controller.overloaded
+        # Between threshold * (1 - hysteresis) and threshold: stays overloaded
+        for t in range(1, 20):
+            self.controller.observe(2.7, t)
+        assert self.controller.overloaded
+        for t in range(20, 40):
+            self.controller.observe(2, t)
+        assert not self.controller.overloaded
+        # ... and does not become overloaded again until over the threshold
+        for t in range(40, 60):
+            self.controller.observe(2.7, t)
+        assert not self.controller.overloaded
+
+    def test_scale_in(self):
+        self.controller.horizon = 0
+        self.controller.observe(1, 0)
+        # Not before the cooldown since the first observation
+        assert not self.controller.decide_scale_in(10, num_zones=3)[0]
+        # 1 * 3 / 2 = 1.5 < 2.4
+        assert self.controller.decide_scale_in(31, num_zones=3)[0]
+        # Never below min_zones
+        assert not self.controller.decide_scale_in(31, num_zones=1)[0]
+        # 1 * 2 / 1 = 2 < 2.4, but still cooling down from the last scale in
+        self.controller.record_scale_in(31)
+        assert not self.controller.decide_scale_in(40, num_zones=2)[0]
+        assert self.controller.decide_scale_in(62, num_zones=2)[0]
+
+    def test_no_scale_in_that_would_overload(self):
+        self.controller.horizon = 0
+        self.controller.observe(2, 0)
+        # 2 * 2 / 1 = 4 would be over the threshold right after retiring a zone
+        assert not self.controller.decide_scale_in(60, num_zones=2)[0]
@@ -0,0 +1,61 @@
+""" Module to perform unit tests against the BackupPool load policy, which can be
+tested independently of ZooKeeper """
+import unittest
+from unittest.mock import patch
+from src.unit_tests import *
+from src.lib.backuppool import BackupPool, weighted_load
+
+class TestBackupPool(unittest.TestCase):
+    def setUp(self):
+        self.zone_loads = {
+            # 5 firehose publishers
+            'zone_1': {'clients': 5, 'msgs_per_sec': 5000, 'bytes_per_sec': 5e6, 'cpu': 0.9, 'backlog': 2},
+            # 10 idle clients
+            'zone_2': {'clients': 10, 'msgs_per_sec': 1, 'bytes_per_sec': 100, 'cpu': 0.01, 'backlog': 0}
+        }
+
+    def test_default_policy_is_clients_per_zone(self):
+        assert weighted_load(self.zone_loads, {'clients': 1}, 2) == 7.5
+
+    def test_weighted_policy(self):
+        load = weighted_load(self.zone_loads, {'msgs_per_sec': 0.001, 'cpu': 10}, 2)
+        assert abs(load - (5.001 + 9.1) / 2) < 1e-9
+
+    def test_no_zones(self):
+        assert weighted_load({}, {'clients': 1}, 0) == 0
+
+    def create_pool(self, **kwargs):
+        """ BackupPool without its ZooKeeper session """
+        with patch.object(BackupPool, 'connect_zk'), patch.object(BackupPool, 'start_session'), \
+            patch.object(BackupPool, 'setup_current_load_znode'):
+            return BackupPool(centralized=True, **kwargs)
+
+    def test_new_broker_keeps_adaptive_settings(self):
+        pool = self.create_pool(adaptive=True, mode_threshold=50, mode_hysteresis=0.2, mode_cooldown=3)
+        broker = pool.create_broker(2)
+        assert broker.adaptive
+        assert broker.mode_selector.threshold == 50
+        assert broker.mode_selector.hysteresis == 0.2
+        assert broker.mode_selector.cooldown == 3
+
+    def test_new_broker_keeps_group_backlog(self):
+        assert self.create_pool(group_backlog=50).create_broker(2).group_backlog == 50
+
+    def test_new_broker_keeps_last_value(self):
+        assert self.create_pool(last_value=True).create_broker(2).last_value
+        assert not self.create_pool().create_broker(2).last_value
+
+    def test_new_broker_keeps_shared_memory(self):
+        broker = self.create_pool(shared_memory=True, shm_slots=64).create_broker(2)
+        assert broker.shared_memory and broker.shm_slots == 64
+
+    def test_new_broker_keeps_log_settings(self):
+        pool = self.create_pool(log_dir='/tmp/logs', log_segment_bytes=4096,
+            log_retention_bytes=1 << 20, log_retention_seconds=60, replay_batch=10)
+        broker = pool.create_broker(3)
+        assert broker.zone == 3 and broker.centralized
+        assert broker.log_dir == '/tmp/logs'
+        assert broker.log_segment_bytes == 4096
+        assert broker.log_retention_bytes == 1 << 20
+        assert broker.log_retention_seconds == 60
+        assert broker.replay_batch == 10
@@ -1,9 +1,52 @@
 """ Module to perform unit tests against Broker class for methods that
 execute and can be tested independently of the publish/subscribe network """
 import unittest
+import time
+import tempfile
+import json
+import threading
+import zmq
+from unittest.mock import patch
+from kazoo.exceptions import ConnectionLoss, NoNodeError, NodeExistsError
 from src.lib.broker import Broker
+from src.lib.subscriber import Subscriber
+from src.lib import message
 from src.unit_tests import *
 
+class PipelinedReads:
+    """ Stands in for KazooClient.get_async: znodes in `lost` fail with a connection loss,
+    the others do not exist """
+    def __init__(self, lost):
+        self.lost = lost
+
+    def get_async(self, path):
+        error = ConnectionLoss() if path in self.lost else NoNodeError()
+        class Result:
+            def get(self):
+                raise error
+        return Result()
+
+class RacedCreate:
+    """ Stands in for KazooClient when another broker creates a znode between our read and
+    our create """
+    def __init__(self, other_value):
+        self.value = None
+        self.other_value = other_value
+        self.writes = []
+
+    def get(self, path):
+        if self.value is None:
+            raise NoNodeError()
+        return self.value, type('Stat', (), {'version': 0})
+
+    def create(self, path, value, makepath=False):
+        self.value = self.other_value
+        raise NodeExistsError()
+
+    def set(self, path, value, version=-1):
+        self.writes.append(value)
+        self.value = value
+
 class TestBroker(unittest.TestCase):
     broker = None
     def __init__(self, *args, **kwargs):
@@ -18,3 +61,321 @@ class TestBroker(unittest.TestCase):
         p = self.broker.get_clear_port()
         assert p >= 10000 and p <= 20000
 
+
+    def test_remove_publishers(self):
+        self.broker.publishers = {
+            'A': [{'id': 'p1'}, {'id': 'p2'}, {'id': 'p3'}],
+            'B': [{'id': 'p2'}]
+        }
+        self.broker.remove_publishers({'p1', 'p2'})
+        assert self.broker.publishers == {'A': [{'id': 'p3'}], 'B': []}
+        assert set(self.broker.get_all_publisher_ids()) == {'p3'}
+
+    def test_connection_loss_is_not_departure(self):
+        parent = '/shared_state/topics/A/subscribers'
+        self.broker.zk = PipelinedReads(lost={f'{parent}/s1'})
+        with self.assertRaises(ConnectionLoss):
+            self.broker.confirm_departed(parent, {'s1', 's2'})
+        self.broker.zk = PipelinedReads(lost=set())
+        assert self.broker.confirm_departed(parent, {'s1', 's2'}) == {'s1', 's2'}
+
+    def test_reconcile_retried_after_connection_loss(self):
+        snapshots = []
+        def reconcile(children):
+            snapshots.append(children)
+            if len(snapshots) == 1:
+                raise ConnectionLoss()
+        watch = {'stopped': False}
+        with patch('src.lib.zookeeper_client.RECONCILE_RETRY_SECONDS', 0):
+            self.broker.pending_changes['/shared_state/topics/A/subscribers'] = (['s1'], reconcile, watch)
+            threading.Thread(target=self.broker.reconcile_worker, daemon=True).start()
+            deadline = time.time() + 2
+            while len(snapshots) < 2 and time.time() < deadline:
+                time.sleep(0.01)
+        watch['stopped'] = True
+        assert snapshots == [['s1'], ['s1']]
+
+    def test_get_zone_interest(self):
+        self.broker.local_clients = {
+            'p1': {'kind': 'publishers', 'topics': ['A', 'B']},
+            's1': {'kind': 'subscribers', 'topics': ['A']},
+            's2': {'kind': 'subscribers', 'topics': ['A']}
+        }
+        interest = self.broker.get_zone_interest()
+        assert interest['publishers'] == 1 and interest['subscribers'] == 2
+        assert interest['topics'] == {
+            'A': {'publishers': 1, 'subscribers': 2},
+            'B': {'publishers': 1, 'subscribers': 0}
+        }
+
+    def test_reconcile_bucket(self):
+        self.broker.registry_buckets = 1
+        self.broker.topic_watches = {'A': []}
+        self.broker.local_clients = {'local': {'kind': 'subscribers', 'topics': ['A']}}
+        self.broker.subscribers = {'A': [{'id': 'local'}, {'id': 'gone'}]}
+        self.broker.update_topic_demand_znodes = lambda: None
+        bucket = '{"new": {"address": "10.0.0.2", "requested": 3, "codecs": ["zlib"]}}'
+        self.broker.reconcile_bucket('subscribers', 'A', 0, bucket)
+        # Local subscriber not yet in the bucket is kept; the departed one is removed
+        assert self.broker.subscribers['A'] == [
+            {'id': 'local'},
+            {'address': '10.0.0.2', 'requested': 3, 'codecs': ['zlib'], 'id': 'new'}
+        ]
+
+    def test_topic_demand_survives_create_race(self):
+        self.broker.zk = RacedCreate(other_value=b'{"requested": 1, "codecs": []}')
+        self.broker.subscribers = {'A': [{'id': 's1', 'requested': 5, 'codecs': ['zlib']}]}
+        self.broker.update_topic_demand_znodes()
+        # Lost the create to the other broker, so our demand is set over its value
+        assert json.loads(self.broker.zk.value) == {'requested': 5, 'codecs': ['zlib']}
+
+    def test_cpu_metric_is_per_broker(self):
+        self.broker.sample_zone_metrics(time.time())
+        # Another broker of the same process keeps a core busy
+        def spin(until):
+            while time.time() < until:
+                pass
+        other = threading.Thread(target=spin, args=(time.time() + 0.3,))
+        other.start()
+        other.join()
+        assert self.broker.sample_zone_metrics(time.time())['cpu'] < 0.5
+
+    def test_flush_zone_summary(self):
+        writes = []
+        self.broker.interest_znode = '/shared_state/interest/zone_1'
+        self.broker.load_znode = '/shared_state/load/zone_1'
+        self.broker.commit_transaction = lambda operations: writes.append(operations) or True
+        self.broker.load_interval = 60000
+        metrics = {'msgs_per_sec': 0, 'bytes_per_sec': 0, 'cpu': 0, 'backlog': 0}
+        self.broker.sample_zone_metrics = lambda now: dict(metrics)
+        self.broker.local_clients = {'p1': {'kind': 'publishers', 'topics': ['A']}}
+        # Nothing changed: nothing written
+        self.broker.flush_zone_summary()
+        assert writes == []
+        self.broker.zone_summary_dirty = True
+        self.broker.zone_summary_written = 0
+        self.broker.flush_zone_summary()
+        assert len(writes) == 1
+        assert writes[0][1] == ('set', '/shared_state/load/zone_1',
+            '{"publishers": 1, "subscribers": 0, "clients": 1, '
+            '"msgs_per_sec": 0, "bytes_per_sec": 0, "cpu": 0, "backlog": 0}')
+        # Changes within load_interval are coalesced into the next write
+        self.broker.zone_summary_dirty = True
+        self.broker.flush_zone_summary()
+        assert len(writes) == 1
+        # Metrics changes are written too
+        metrics['msgs_per_sec'] = 100
+        self.broker.zone_summary_written = 0
+        self.broker.flush_zone_summary()
+        assert len(writes) == 2
+        assert '"msgs_per_sec": 100' in writes[1][1][2]
+        self.broker.flush_zone_summary(force=True)
+        assert len(writes) == 3
+
+    def test_federation(self):
+        origin = Broker(centralized=True, zone=1)
+        origin.configure()
+        remote = Broker(centralized=True, zone=2)
+        remote.configure()
+        try:
+            # remote has a local subscriber of A; origin a local publisher of A
+            remote.subscribers = {'A': [{'id': 's1'}]}
+            remote.local_clients = {'s1': {'kind': 'subscribers', 'topics': ['A']}}
+            remote.update_send_socket()
+            sub = remote.context.socket(zmq.SUB)
+            sub.connect(remote.send_endpoints_dict['A']['inproc'])
+            sub.setsockopt_string(zmq.SUBSCRIBE, 'A')
+            remote.federation_peers = {'zone_1': origin.federation_endpoint}
+            remote.update_federation()
+            assert remote.federation_topics == {'A'}
+            time.sleep(0.5)
+            frames = [b'A', b'{"buffers": []}']
+            # A looped back message of remote itself is dropped
+            origin.federation_socket.send_multipart([b'A', remote.zk_instance_id.encode('utf8')] + frames)
+            origin.federation_socket.send_multipart([b'A', origin.zk_instance_id.encode('utf8')] + frames)
+            for i in range(2):
+                assert remote.federation_sub.poll(2000)
+                remote.receive_federated()
+            assert sub.poll(2000)
+            assert sub.recv_multipart() == frames
+            assert not sub.poll(200)
+            # Subscriptions follow the local subscribers
+            remote.send_socket_dict.pop('A').close()
+            remote.update_federation()
+            assert remote.federation_topics == set()
+        finally:
+            origin.context.destroy(linger=0)
+            remote.context.destroy(linger=0)
+
+    def test_consumer_group(self):
+        broker = Broker(centralized=True, zone=1)
+        broker.configure()
+        try:
+            broker.join_group('s1', 'workers', ['A'])
+            broker.join_group('s2', 'workers', ['A'])
+            members = {}
+            for sub_id in ['s1', 's2']:
+                members[sub_id] = broker.context.socket(zmq.DEALER)
+                members[sub_id].setsockopt(zmq.IDENTITY, sub_id.encode('utf8'))
+                members[sub_id].connect(broker.group_endpoints['inproc'])
+                members[sub_id].send_multipart([b'credit', b'A', b'1'])
+                assert broker.group_socket.poll(2000)
+                broker.receive_group_credit()
+            frames = [b'A', b'{"buffers": []}']
+            for i in range(3):
+                broker.dispatch_to_groups('A', frames)
+            # One message each; the third waits for a credit
+            for member in members.values():
+                assert member.poll(2000)
+                assert member.recv_multipart() == frames
+                assert not member.poll(100)
+            # s1 leaves without acknowledging: its message and the queued one go to s2
+            broker.leave_group('s1', ['A'])
+            members['s2'].send_multipart([b'ack', b'A', b'2'])
+            assert broker.group_socket.poll(2000)
+            broker.receive_group_credit()
+            for i in range(2):
+                assert members['s2'].poll(2000)
+                assert members['s2'].recv_multipart() == frames
+        finally:
+            broker.context.destroy(linger=0)
+
+    def test_last_value_cache(self):
+        broker = Broker(centralized=True, zone=1, last_value=True)
+        broker.configure()
+        try:
+            window = [{'publisher': 'p1', 'topic': 'A', 'publish_time': time.time()}]
+            frames = message.build_message(b'A', [message.serialize_window(window)])
+            broker.cache_last_value('A', frames)
+            compressed = message.build_message(b'B', [message.serialize_window(window)], codec='zlib', threshold=0)
+            broker.cache_last_value('B', compressed)
+            sub = broker.context.socket(zmq.REQ)
+            sub.connect(f'tcp://127.0.0.1:{broker.sub_reg_port}')
+            sub.send_string(json.dumps({'address': '127.0.0.1', 'id': 's1', 'topics': ['A', 'B', 'C'],
+                'requested': 1, 'codecs': []}))
+            assert broker.sub_reg_socket.poll(2000)
+            broker.register_sub()
+            assert sub.poll(2000)
+            reply = sub.recv_multipart()
+            # B is not sent: the subscriber cannot decode zlib
+            assert json.loads(reply[0])['_cached'] == [['A', len(frames)]]
+            assert message.parse_message(reply[1:])[1] == [window]
+        finally:
+            broker.context.destroy(linger=0)
+
+    def test_unconfirmed_switch_does_not_block(self):
+        broker = Broker(centralized=True, adaptive=True, zone=1)
+        broker.configure()
+        try:
+            broker.local_clients = {'s1': {'kind': 'subscribers', 'topics': ['A']}}
+            broker.send_port_dict = {'A': 6000}
+            broker.send_endpoints_dict = {'A': {}}
+            notify_port = broker.open_notify_socket('s1')
+            # Nobody connected: the switch is skipped
+            broker.switch_topic_mode('A', 'centralized')
+            # Connected but never answers: the switch gives up, leaving the socket usable
+            stuck = broker.context.socket(zmq.REP)
+            stuck.connect(f'tcp://127.0.0.1:{notify_port}')
+            time.sleep(0.2)
+            with patch('src.lib.broker.SWITCH_CONFIRM_TIMEOUT_MS', 100):
+                broker.switch_topic_mode('A', 'centralized')
+            stuck.close(linger=0)
+            sub = broker.context.socket(zmq.REP)
+            sub.connect(f'tcp://127.0.0.1:{notify_port}')
+            time.sleep(0.2)
+            received = []
+            def answer():
+                if sub.poll(2000):
+                    received.append(json.loads(sub.recv_string()))
+                    sub.send_string('ok')
+            answering = threading.Thread(target=answer)
+            answering.start()
+            broker.switch_topic_mode('A', 'centralized')
+            answering.join()
+            assert received[0][0]['switch_mode']['topic'] == 'A'
+        finally:
+            broker.context.destroy(linger=0)
+
+    def test_send_sockets_for_local_subscribers(self):
+        broker = Broker(centralized=True, zone=1)
+        broker.configure()
+        try:
+            # s2 registered in another zone; its topic B needs no send socket here
+            broker.subscribers = {'A': [{'id': 's1'}], 'B': [{'id': 's2'}]}
+            broker.local_clients = {'s1': {'kind': 'subscribers', 'topics': ['A']},
+                'p1': {'kind': 'publishers', 'topics': ['C']}}
+            broker.update_send_socket()
+            assert set(broker.send_socket_dict) == {'A'}
+            # A subscriber registering is not a local client yet
+            broker.update_send_socket(['D'])
+            assert set(broker.send_socket_dict) == {'A', 'D'}
+            broker.close_send_socket('A')
+            broker.close_send_socket('A')
+            assert set(broker.send_socket_dict) == {'D'} and 'A' not in broker.send_port_dict
+        finally:
+            broker.context.destroy(linger=0)
+
+    def test_shared_memory_send(self):
+        broker = Broker(centralized=True, zone=1, shared_memory=True, shm_slots=8)
+        broker.configure()
+        subscriber = Subscriber(topics=['A'], centralized=True)
+        subscriber.context = zmq.Context()
+        subscriber.poller = zmq.Poller()
+        try:
+            broker.subscribers = {'A': [{'id': 's1'}]}
+            broker.local_clients = {'s1': {'kind': 'subscribers', 'topics': ['A']}}
+            broker.update_send_socket()
+            endpoints = broker.send_endpoints_dict['A']
+            assert 'A' in endpoints['shm']
+            # A subscriber on the broker's host reads the ring instead of connecting a socket
+            subscriber.setup_broker_topic_port_connections(
+                {'A': broker.send_port_dict['A'], '_endpoints': {'A': endpoints}})
+            assert 'A' not in subscriber.sub_socket_dict
+            assert len(subscriber.shm_readers) == 1
+            # Give the doorbell subscription time to reach the broker
+            time.sleep(0.2)
+            window = [{'publisher': 'p1', 'topic': 'A', 'publish_time': time.time()}]
+            broker.forward_message('A', message.build_message(b'A', [message.serialize_window(window)]))
+            events = dict(subscriber.poller.poll(2000))
+            assert subscriber.parse_shm_events(events) == 1
+            assert len(subscriber.received_message_list) == 1
+            subscriber.close_shm_readers()
+            broker.close_send_socket('A')
+            assert broker.shm_rings == {}
+        finally:
+            subscriber.context.destroy(linger=0)
+            broker.shm_context.destroy(linger=0)
+            broker.context.destroy(linger=0)
+
+    def test_replay(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            broker = Broker(centralized=True, zone=1, log_dir=log_dir)
+            broker.configure()
+            broker.replay_batch = 2
+            try:
+                for i in range(3):
+                    window = [{'publisher': 'p1', 'topic': 'A', 'publish_time': i}]
+                    broker.log_message('A', message.build_message(b'A', [message.serialize_window(window)]))
+                sub = broker.context.socket(zmq.REQ)
+                sub.connect(f'tcp://127.0.0.1:{broker.sub_reg_port}')
+                replayed = []
+                from_seq = 1
+                while True:
+                    sub.send_string(json.dumps({'replay': {'topic': 'A', 'from_seq': from_seq}}))
+                    assert broker.sub_reg_socket.poll(2000)
+                    broker.register_sub()
+                    assert sub.poll(2000)
+                    frames = sub.recv_multipart()
+                    reply = json.loads(frames[0])['replay']
+                    if len(frames) == 1:
+                        break
+                    replayed += [message.parse_message(message.unpack_frames(f))[1][0][0]['publish_time']
+                        for f in frames[1:]]
+                    from_seq = reply['next_seq']
+                # Batches of replay_batch messages, from the requested sequence number on
+                assert replayed == [1, 2]
+                assert reply['next_seq'] == 3 and reply['first_seq'] == 0
+            finally:
+                broker.context.destroy(linger=0)
+                for log in broker.topic_logs.values():
+                    log.close()
@@ -0,0 +1,51 @@
+""" Module to perform unit tests against the consumer group scheduler used by centralized
+brokers to share a topic's messages among a group of subscribers """
+import unittest
+from src.unit_tests import *
+from src.lib.consumer_groups import ConsumerGroup
+
+class TestConsumerGroups(unittest.TestCase):
+    def setUp(self):
+        self.group = ConsumerGroup('workers', backlog=5)
+        self.group.join('s1')
+        self.group.join('s2')
+
+    def offer(self, *msgs):
+        for msg in msgs:
+            self.group.offer(msg)
+        return self.group.drain()
+
+    def test_waits_for_credits(self):
+        assert self.offer('m1') == []
+        self.group.grant('s1', 1)
+        assert self.group.drain() == [('s1', 'm1')]
+        assert self.offer('m2') == []
+
+    def test_round_robin(self):
+        self.group.grant('s1', 2)
+        self.group.grant('s2', 2)
+        assert self.offer('m1', 'm2', 'm3', 'm4', 'm5') == [
+            ('s1', 'm1'), ('s2', 'm2'), ('s1', 'm3'), ('s2', 'm4')]
+        # Faster member acknowledges and gets the next message
+        self.group.grant('s2', 1, acked=1)
+        assert self.group.drain() == [('s2', 'm5')]
+
+    def test_leave_redistributes(self):
+        self.group.grant('s1', 2)
+        assert self.offer('m1', 'm2', 'm3') == [('s1', 'm1'), ('s1', 'm2')]
+        self.group.grant('s1', 1, acked=1)
+        assert self.group.drain() == [('s1', 'm3')]
+        # m1 was acknowledged; m2 and m3 go to the remaining member, in order
+        assert self.group.leave('s1') == 2
+        self.group.grant('s2', 5)
+        assert self.group.drain() == [('s2', 'm2'), ('s2', 'm3')]
+        assert self.group.leave('s3') == 0
+
+    def test_backlog(self):
+        self.offer('m1', 'm2', 'm3', 'm4', 'm5', 'm6', 'm7')
+        assert self.group.dropped == 2
+        assert list(self.group.pending) == ['m3', 'm4', 'm5', 'm6', 'm7']
+
+    def test_credit_from_unknown_member(self):
+        self.group.grant('s3', 1)
+        assert 's3' not in self.group.credits
@@ -0,0 +1,58 @@
+""" Module to perform unit tests against the per-topic dissemination mode selector used by
+adaptive brokers """
+import unittest
+from src.unit_tests import *
+from src.lib.dissemination import TopicModeSelector, CENTRALIZED, DIRECT, direct_cost
+
+class TestDissemination(unittest.TestCase):
+    def setUp(self):
+        self.selector = TopicModeSelector(threshold=100, hysteresis=0.5, alpha=1, cooldown=10)
+
+    def observe(self, topic, rate, now):
+        """ Count rate messages per second of topic since the last sample """
+        self.selector.count(topic, rate * (now - self.selector.sampled))
+        self.selector.sample(now)
+
+    def test_direct_cost(self):
+        assert direct_cost(rate=10, fanout=20, publishers=2) == 100
+        assert direct_cost(rate=10, fanout=20, publishers=0) == 200
+
+    def test_new_topic_is_centralized(self):
+        assert self.selector.mode('A') == CENTRALIZED
+        assert self.selector.decide('A', fanout=1, publishers=1, now=0) == CENTRALIZED
+
+    def test_low_fanout_goes_direct(self):
+        self.selector.sample(0)
+        self.observe('A', 10, 1)
+        assert self.selector.decide('A', fanout=2, publishers=1, now=1) == DIRECT
+
+    def test_high_fanout_few_publishers_stays_centralized(self):
+        self.selector.sample(0)
+        self.observe('A', 10, 1)
+        assert self.selector.decide('A', fanout=50, publishers=1, now=1) == CENTRALIZED
+        # A similar fanout spread over many publishers is cheap enough to send directly
+        assert self.selector.decide('B', fanout=50, publishers=1, now=1) == CENTRALIZED
+        self.observe('B', 10, 2)
+        assert self.selector.decide('B', fanout=40, publishers=10, now=2) == DIRECT
+
+    def test_hysteresis_and_cooldown(self):
+        self.selector.sample(0)
+        self.observe('A', 10, 1)
+        assert self.selector.decide('A', fanout=2, publishers=1, now=1) == DIRECT
+        # Fanout grows: cost 200 > 100, but the topic just switched
+        self.observe('A', 10, 2)
+        assert self.selector.decide('A', fanout=20, publishers=1, now=2) == DIRECT
+        self.observe('A', 10, 12)
+        assert self.selector.decide('A', fanout=20, publishers=1, now=12) == CENTRALIZED
+        # Cost 70 is under the threshold but within the hysteresis band (50-100)
+        self.observe('A', 10, 30)
+        assert self.selector.decide('A', fanout=7, publishers=1, now=30) == CENTRALIZED
+        self.observe('A', 10, 31)
+        assert self.selector.decide('A', fanout=4, publishers=1, now=31) == DIRECT
+
+    def test_forget(self):
+        self.selector.sample(0)
+        self.observe('A', 10, 1)
+        self.selector.decide('A', fanout=2, publishers=1, now=1)
+        self.selector.forget('A')
+        assert self.selector.mode('A') == CENTRALIZED
@@ -0,0 +1,77 @@
+""" Module to perform unit tests against the EdgeBroker class for methods that
+execute and can be tested independently of the publish/subscribe network """
+import unittest
+import zmq
+from src.lib.edge_broker import EdgeBroker
+from src.unit_tests import *
+
+class TestEdgeBroker(unittest.TestCase):
+
+    def poll_edge(self, edge, rounds=5):
+        for i in range(rounds):
+            edge.parse_events(i)
+
+    def test_relay(self):
+        edge = EdgeBroker(name='s1')
+        edge.configure()
+        # Stands in for a zone broker's federation socket; XPUB to observe subscriptions
+        zone = edge.context.socket(zmq.XPUB)
+        port = zone.bind_to_random_port('tcp://127.0.0.1')
+        try:
+            edge.federation_peers = {'zone_1': f'tcp://127.0.0.1:{port}'}
+            edge.update_federation()
+            subs = []
+            for i in range(2):
+                sub = edge.context.socket(zmq.SUB)
+                sub.connect(edge.edge_endpoints['inproc'])
+                sub.setsockopt_string(zmq.SUBSCRIBE, 'A')
+                subs.append(sub)
+            self.poll_edge(edge)
+            # Both subscribers of A are aggregated into one upstream subscription
+            assert zone.poll(2000)
+            assert zone.recv() == b'\x01A'
+            assert not zone.poll(200)
+            frames = [b'A', b'{"buffers": []}']
+            zone.send_multipart([b'A', b'origin'] + frames)
+            self.poll_edge(edge)
+            for sub in subs:
+                assert sub.poll(2000)
+                assert sub.recv_multipart() == frames
+        finally:
+            edge.context.destroy(linger=0)
+
+    def test_send_ports_for_registering_subscriber(self):
+        edge = EdgeBroker(name='s1')
+        edge.configure()
+        try:
+            edge.subscribers = {'A': [{'id': 's1'}]}
+            edge.update_send_socket(topics=['B'])
+            assert edge.send_port_dict == {'A': edge.edge_port, 'B': edge.edge_port}
+            assert edge.send_endpoints_dict['B'] == edge.edge_endpoints
+        finally:
+            edge.context.destroy(linger=0)
+
+    def test_child_edge(self):
+        parent = EdgeBroker(name='s1')
+        parent.configure()
+        child = EdgeBroker(name='s2', parent='s1')
+        child.configure()
+        try:
+            child.update_parent(f'127.0.0.1,{parent.edge_port},{parent.sub_reg_port}')
+            child.update_federation()
+            sub = child.context.socket(zmq.SUB)
+            sub.connect(child.edge_endpoints['inproc'])
+            sub.setsockopt_string(zmq.SUBSCRIBE, 'A')
+            for i in range(5):
+                child.parse_events(i)
+                parent.parse_events(i)
+            # Messages from a parent edge are passed on as they are
+            frames = [b'A', b'{"buffers": []}']
+            parent.edge_socket.send_multipart(frames)
+            for i in range(3):
+                child.parse_events(i)
+            assert sub.poll(2000)
+            assert sub.recv_multipart() == frames
+        finally:
+            parent.context.destroy(linger=0)
+            child.context.destroy(linger=0)
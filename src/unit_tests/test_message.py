@@ -0,0 +1,61 @@
+""" Module to perform unit tests against the publish event wire format (message.py) """
+import unittest
+import time
+from src.unit_tests import *
+from src.lib import message
+
+class TestMessage(unittest.TestCase):
+    def make_window(self, payload=None):
+        event = {'publisher': '127.0.0.1:5556', 'topic': 'A', 'publish_time': time.time()}
+        if payload is not None:
+            event['payload'] = message.wrap_payload(payload)
+        return [event]
+
+    def test_round_trip(self):
+        window = self.make_window()
+        frames = message.build_message(b'A', [message.serialize_window(window)])
+        topic, windows = message.parse_message(frames)
+        assert topic == b'A'
+        assert windows == [window]
+
+    def test_payload_sent_out_of_band(self):
+        payload = b'x' * 100000
+        data, buffers = message.serialize_window(self.make_window(payload))
+        # Payload is not pickled into the window; it travels as its own frame
+        assert len(data) < 1000
+        assert len(buffers) == 1
+        frames = message.build_message(b'A', [(data, buffers)])
+        topic, windows = message.parse_message(frames)
+        received = windows[0][0]['payload']
+        assert isinstance(received, memoryview)
+        assert received.tobytes() == payload
+
+    def test_batch_with_mixed_payloads(self):
+        serialized = [
+            message.serialize_window(self.make_window(b'first')),
+            message.serialize_window(self.make_window()),
+            message.serialize_window(self.make_window(bytearray(b'third'))),
+        ]
+        frames = message.build_message(b'A', serialized)
+        # topic + header + 3 windows + 2 payload buffers
+        assert len(frames) == 7
+        topic, windows = message.parse_message(frames)
+        assert len(windows) == 3
+        assert bytes(windows[0][0]['payload']) == b'first'
+        assert 'payload' not in windows[1][0]
+        assert bytes(windows[2][0]['payload']) == b'third'
+
+    def test_compression(self):
+        window = [self.make_window()[0] for i in range(50)]
+        for codec in message.CODECS:
+            frames = message.build_message(b'A', [message.serialize_window(window)], codec=codec)
+            assert codec in frames[1].decode('utf8')
+            assert len(frames[2]) < len(message.serialize_window(window)[0])
+            assert message.parse_message(frames)[1] == [window]
+
+    def test_compression_threshold(self):
+        window = self.make_window()
+        frames = message.build_message(
+            b'A', [message.serialize_window(window)], codec='zlib', threshold=100000)
+        assert 'codec' not in frames[1].decode('utf8')
+        assert message.parse_message(frames)[1] == [window]
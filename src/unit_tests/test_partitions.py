@@ -0,0 +1,46 @@
+""" Module to perform unit tests against the partitioned topic helpers shared by publishers
+and subscribers """
+import unittest
+from src.unit_tests import *
+from src.lib import partitions
+
+class TestPartitions(unittest.TestCase):
+    def test_partition_names(self):
+        assert partitions.partition_topic('A', 2) == 'A#2'
+        assert partitions.split_partition('A#2') == ('A', 2)
+        assert partitions.split_partition('A') == ('A', None)
+        assert partitions.split_partition('A#B') == ('A#B', None)
+
+    def test_expand_topics(self):
+        assert partitions.expand_topics(['A', 'B'], {'B': 3}) == ['A', 'B#0', 'B#1', 'B#2']
+        assert partitions.expand_topics(['A'], {}) == ['A']
+
+    def test_partition_share(self):
+        assert partitions.partition_share(8, 3) == 3
+        assert partitions.partition_share(8, 0) == 8
+        # Shares of all publishers together always cover every partition
+        for publishers in range(1, 10):
+            assert partitions.partition_share(8, publishers) * publishers >= 8
+
+    def test_preferred_partitions(self):
+        order = partitions.preferred_partitions(8, 'pub-1')
+        assert sorted(order) == list(range(8))
+        assert order == partitions.preferred_partitions(8, 'pub-1')
+        # Publishers start claiming from different partitions
+        firsts = {partitions.preferred_partitions(8, f'pub-{i}')[0] for i in range(20)}
+        assert len(firsts) > 1
+
+    def test_route_round_robin(self):
+        assert partitions.route([]) is None
+        assert [partitions.route([3, 1], counter=i) for i in range(4)] == [3, 1, 3, 1]
+
+    def test_route_keyed(self):
+        owned = [0, 1, 2, 3]
+        routed = {key: partitions.route(owned, key=key) for key in map(str, range(50))}
+        # The same key always gets the same partition, and keys spread over partitions
+        assert all(partitions.route(owned, key=key, counter=7) == p for key, p in routed.items())
+        assert set(routed.values()) == set(owned)
+        # Losing a partition only moves the keys that were routed to it
+        for key, p in routed.items():
+            if p != 3:
+                assert partitions.route([0, 1, 2], key=key) == p
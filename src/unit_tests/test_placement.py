@@ -0,0 +1,112 @@
+""" Module to perform unit tests against the zone placement strategies of clients and the
+placement plans used by the BackupPool to rebalance and drain zones """
+import unittest
+from src.unit_tests import *
+import json
+import random
+import socket
+from src.lib.placement import (
+    plan_rebalance, plan_drain, select_idle_zone, two_choices, least_rtt, rendezvous, placement_key, probe_rtt,
+    ConsistentHashRing, add_ring_zone, remove_ring_zone, plan_affinity)
+
+class TestPlacement(unittest.TestCase):
+    def setUp(self):
+        # zone_3 was just added by the backup pool
+        self.zone_clients = {
+            'zone_1': ['a', 'b', 'c', 'd', 'e', 'f'],
+            'zone_2': ['g', 'h', 'i'],
+            'zone_3': []
+        }
+
+    def apply(self, moves):
+        clients = {zone: list(ids) for zone, ids in self.zone_clients.items()}
+        for client, source, target in moves:
+            clients[source].remove(client)
+            clients[target].append(client)
+        return {zone: len(ids) for zone, ids in clients.items()}
+
+    def test_plan_rebalance_evens_out_zones(self):
+        moves = plan_rebalance(self.zone_clients, tolerance=1)
+        assert self.apply(moves) == {'zone_1': 3, 'zone_2': 3, 'zone_3': 3}
+        # Only the clients that have to move are moved
+        assert len(moves) == 3
+
+    def test_plan_rebalance_within_tolerance(self):
+        assert plan_rebalance({'zone_1': ['a', 'b', 'c'], 'zone_2': ['d']}, tolerance=2) == []
+        assert plan_rebalance({'zone_1': ['a', 'b']}, tolerance=1) == []
+
+    def test_plan_drain(self):
+        moves = plan_drain(self.zone_clients, 'zone_1')
+        assert self.apply(moves) == {'zone_1': 0, 'zone_2': 5, 'zone_3': 4}
+        assert plan_drain({'zone_1': ['a']}, 'zone_1') == []
+
+    def test_select_idle_zone(self):
+        assert select_idle_zone({'zone_1': 4, 'zone_2': 1, 'zone_3': 2}) == 'zone_2'
+        # Newest zone on ties
+        assert select_idle_zone({'zone_1': 0, 'zone_2': 0}) == 'zone_2'
+        assert select_idle_zone({}) is None
+
+    def test_two_choices(self):
+        rng = random.Random(7)
+        loads = {'zone_1': 10, 'zone_2': 0, 'zone_3': 5}
+        choices = [two_choices(loads, rng) for i in range(300)]
+        # The most loaded zone is never chosen, the least loaded one most often
+        assert 'zone_1' not in choices
+        assert choices.count('zone_2') > choices.count('zone_3')
+        assert two_choices({'zone_1': 3}) == 'zone_1'
+
+    def test_least_rtt(self):
+        assert least_rtt({'zone_1': 0.004, 'zone_2': 0.0005, 'zone_3': float('inf')}) == 'zone_2'
+        assert least_rtt({}) is None
+
+    def test_probe_rtt(self):
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen()
+        try:
+            assert probe_rtt('127.0.0.1', server.getsockname()[1]) < 1
+        finally:
+            server.close()
+
+    def test_rendezvous_is_sticky(self):
+        zones = ['zone_1', 'zone_2', 'zone_3']
+        chosen = {key: rendezvous(zones, key) for key in map(str, range(300))}
+        assert len(set(chosen.values())) == 3
+        # Removing a zone only moves the clients of that zone
+        for key, zone in chosen.items():
+            if zone != 'zone_2':
+                assert rendezvous(['zone_1', 'zone_3'], key) == zone
+
+    def test_placement_key(self):
+        # Same client restarted: same key, whatever the order of its topics
+        assert placement_key('10.0.0.1:5556', ['B', 'A']) == placement_key('10.0.0.1:5556', ['A', 'B'])
+        assert placement_key('10.0.0.1:5556', ['A']) != placement_key('10.0.0.2:5556', ['A'])
+        assert placement_key('10.0.0.1:5556', ['A'], name='sensor-7') == 'sensor-7'
+
+    def test_ring_moves_few_topics_when_a_zone_is_added(self):
+        topics = [f'topic{i}' for i in range(1000)]
+        ring = ConsistentHashRing(['zone_1', 'zone_2', 'zone_3'])
+        owners = {topic: ring.owner(topic) for topic in topics}
+        grown = ConsistentHashRing(['zone_1', 'zone_2', 'zone_3', 'zone_4'])
+        moved = [topic for topic in topics if grown.owner(topic) != owners[topic]]
+        # Only topics taken over by the new zone move (about a quarter of them)
+        assert all(grown.owner(topic) == 'zone_4' for topic in moved)
+        assert 150 < len(moved) < 350
+        assert ConsistentHashRing([]).owner('A') is None
+
+    def test_ring_znode_updates(self):
+        ring = add_ring_zone(add_ring_zone({}, 'zone_2'), 'zone_1')
+        assert ring['zones'] == ['zone_1', 'zone_2']
+        assert remove_ring_zone(ring, 'zone_2')['zones'] == ['zone_1']
+        assert ConsistentHashRing.from_znode(json.dumps(ring)).owner('A') in ['zone_1', 'zone_2']
+        assert ConsistentHashRing.from_znode(None).owner('A') is None
+
+    def test_plan_affinity(self):
+        ring = ConsistentHashRing(['zone_1', 'zone_2'])
+        topic = next(t for t in map(str, range(100)) if ring.owner(t) == 'zone_2')
+        other = next(t for t in map(str, range(100)) if ring.owner(t) == 'zone_1')
+        assert ring.preferred_zone([topic, other, topic]) == 'zone_2'
+        # Ties go to the owner of the first topic
+        assert ring.preferred_zone([other, topic]) == 'zone_1'
+        moves = plan_affinity({'zone_1': {'a': [topic], 'b': [other]}, 'zone_2': {'c': [topic]}}, ring)
+        assert moves == [('a', 'zone_1', 'zone_2')]
@@ -52,6 +52,27 @@ class TestPublisher(unittest.TestCase):
         # Default port is 5556
         assert self.publisher.bind_port == 5556
 
+    def test_get_window_size(self):
+        publisher = Publisher(topics=self.topics, offered=5)
+        # No known demand: send the whole offered window
+        assert publisher.get_window_size('A') == 5
+        publisher.topic_demand['A'] = 2
+        assert publisher.get_window_size('A') == 2
+        # Never more than offered, never less than the newest event
+        publisher.topic_demand['A'] = 20
+        assert publisher.get_window_size('A') == 5
+        publisher.topic_demand['A'] = 0
+        assert publisher.get_window_size('A') == 1
+
+    def test_get_codec(self):
+        publisher = Publisher(topics=self.topics, compression='zlib')
+        # Only compress once every subscriber of the topic accepts the codec
+        assert publisher.get_codec('A') is None
+        publisher.topic_codecs['A'] = {'lzma'}
+        assert publisher.get_codec('A') is None
+        publisher.topic_codecs['A'] = {'lzma', 'zlib'}
+        assert publisher.get_codec('A') == 'zlib'
+
 
 
 
@@ -0,0 +1,35 @@
+""" Module to perform unit tests against the shared memory ring transport (shm_ring.py) """
+import unittest
+import zmq
+from src.unit_tests import *
+from src.lib.shm_ring import ShmRingWriter, ShmRingReader
+
+class TestShmRing(unittest.TestCase):
+    def setUp(self):
+        self.context = zmq.Context()
+        self.writer = ShmRingWriter(self.context, slot_count=4, slot_size=64)
+        ring = self.writer.describe()
+        self.reader = ShmRingReader(self.context, ring['segment'], ring['doorbell'])
+
+    def tearDown(self):
+        self.reader.close()
+        self.writer.close()
+        self.context.destroy()
+
+    def test_read_in_order(self):
+        for i in range(3):
+            self.writer.write(b'message-%d' % i)
+        assert self.reader.read() == [b'message-0', b'message-1', b'message-2']
+        assert self.reader.read() == []
+        assert self.reader.lost == 0
+
+    def test_lapped_reader_detects_loss(self):
+        for i in range(10):
+            self.writer.write(b'message-%d' % i)
+        # Only the last slot_count messages are still in the ring
+        assert self.reader.read() == [b'message-%d' % i for i in range(6, 10)]
+        assert self.reader.lost == 6
+
+    def test_message_too_large(self):
+        with self.assertRaises(ValueError):
+            self.writer.write(b'x' * 64)
@@ -2,8 +2,25 @@
 execute and can be tested independently of the publish/subscribe network """
 import unittest
 import os
+import time
+import threading
+import zmq
+from kazoo.protocol.states import WatchedEvent
 from src.unit_tests import *
+from src.lib import message, transport
 from src.lib.subscriber import Subscriber
+from src.lib.publisher import Publisher
+
+class DataWatchRecorder:
+    """ Stands in for KazooClient.DataWatch: keeps the callbacks so tests fire them """
+    def __init__(self):
+        self.callbacks = {}
+
+    def DataWatch(self, path):
+        def register(callback):
+            self.callbacks[path] = callback
+            return callback
+        return register
 
 class TestSubscriber(unittest.TestCase):
     def __init__(self, *args, **kwargs):
@@ -53,6 +70,127 @@ class TestSubscriber(unittest.TestCase):
                 assert header.strip() == 'publisher,topic,total_time_seconds'
                 for i,line in enumerate(f.readlines()):
                     assert line.strip() == f"publisher-{i},{['A','B','C','D','E'][i]},{i}"
+            with open(f'{self.filename}.gaps','r') as f:
+                assert f.readline().strip() == 'publisher,topic,lost,repaired'
             os.remove(self.filename)
+            os.remove(f'{self.filename}.gaps')
         except:
             assert False
+
+    def test_parse_batched_publish_event(self):
+        # A batch of sliding-history windows arrives as one [topic, window, window, ...] message
+        context = zmq.Context()
+        sender = context.socket(zmq.PAIR)
+        sender.bind('inproc://test_parse_batched_publish_event')
+        self.subscriber.sub_socket_dict['A'] = context.socket(zmq.PAIR)
+        self.subscriber.sub_socket_dict['A'].connect('inproc://test_parse_batched_publish_event')
+        windows = [
+            [{'publisher': 'publisher-0', 'topic': 'A', 'publish_time': time.time()}]
+            for i in range(3)
+        ]
+        sender.send_multipart(message.build_message(b'A', [message.serialize_window(w) for w in windows]))
+        assert self.subscriber.parse_publish_event(topic='A') == 3
+        assert len(self.subscriber.received_message_list) == 3
+        context.destroy()
+
+    def test_switch_topic_mode(self):
+        # Messages already received on the old path are read before switching to the broker
+        context = zmq.Context()
+        self.subscriber.context = context
+        self.subscriber.poller = zmq.Poller()
+        publisher = context.socket(zmq.PUB)
+        publisher.bind('inproc://test_switch_topic_mode_publisher')
+        broker = context.socket(zmq.PUB)
+        broker.bind('inproc://test_switch_topic_mode_broker')
+        direct = context.socket(zmq.SUB)
+        direct.connect('inproc://test_switch_topic_mode_publisher')
+        direct.setsockopt_string(zmq.SUBSCRIBE, 'A')
+        self.subscriber.sub_socket_dict['A'] = direct
+        self.subscriber.poller.register(direct, zmq.POLLIN)
+        window = [{'publisher': 'publisher-0', 'topic': 'A', 'publish_time': time.time()}]
+        time.sleep(0.1)
+        publisher.send_multipart(message.build_message(b'A', [message.serialize_window(window)]))
+        assert direct.poll(2000)
+        self.subscriber.switch_topic_mode(
+            'A', 'centralized', port=1, endpoints={'inproc': 'inproc://test_switch_topic_mode_broker',
+                'context': transport.context_id(context), 'tcp': 'tcp://127.0.0.1:1'})
+        assert len(self.subscriber.received_message_list) == 1
+        assert self.subscriber.topic_modes == {'A': 'centralized'}
+        assert self.subscriber.sub_socket_dict['A'] is not direct
+        time.sleep(0.1)
+        broker.send_multipart(message.build_message(b'A', [message.serialize_window(window)]))
+        assert self.subscriber.parse_publish_event(topic='A') == 1
+        context.destroy(linger=0)
+
+    def run_repairs(self, seconds):
+        """ Run the subscriber's receive loop for repair replies and retries only """
+        deadline = time.time() + seconds
+        while self.subscriber.repair_poll_timeout() is not None and time.time() < deadline:
+            self.subscriber.handle_repairs(dict(self.subscriber.poller.poll(self.subscriber.repair_poll_timeout())))
+
+    def test_gap_repair(self):
+        context = zmq.Context()
+        self.subscriber.context = context
+        self.subscriber.poller = zmq.Poller()
+        self.subscriber.repair_timeout = 100
+        self.subscriber.repair_retries = 2
+        publisher = Publisher(topics=['A'], repair_buffer=8)
+        publisher.setup_repair_socket()
+        repair_socket = publisher.repair_socket
+        # Bound once: a broker change does not move it
+        publisher.setup_repair_socket()
+        assert publisher.repair_socket is repair_socket
+        events = []
+        for i in range(9):
+            event = {'publisher': '127.0.0.1:5556', 'topic': 'A', 'publish_time': time.time()}
+            publisher.stamp_event('A', event)
+            events.append(event)
+        assert [event['seq'] for event in events] == list(range(9))
+        self.subscriber.parse_history_window(events[:1])
+        # Events 1-3 are missing before this window: the request does not hold up receiving
+        self.subscriber.parse_history_window(events[4:5])
+        assert len(self.subscriber.received_message_list) == 2
+        # The publisher resends them
+        server = threading.Thread(target=publisher.serve_repairs, args=(1,))
+        server.start()
+        self.run_repairs(1)
+        server.join()
+        assert len(self.subscriber.received_message_list) == 5
+        assert self.subscriber.repair_stats == {('127.0.0.1:5556', 'A'): {'lost': 3, 'repaired': 3}}
+        # A history window covering the missed events is not a gap
+        self.subscriber.parse_history_window(events[4:6])
+        assert self.subscriber.repair_stats[('127.0.0.1:5556', 'A')]['lost'] == 3
+        # Publisher not answering: counted as lost, given up after repair_retries attempts
+        self.subscriber.parse_history_window(events[8:9])
+        self.run_repairs(1)
+        assert self.subscriber.repair_poll_timeout() is None
+        assert self.subscriber.repair_stats == {('127.0.0.1:5556', 'A'): {'lost': 5, 'repaired': 3}}
+        # A restarted publisher at the same address starts over from 0: not a gap
+        restarted = Publisher(topics=['A'], repair_buffer=0)
+        event = {'publisher': '127.0.0.1:5556', 'topic': 'A', 'publish_time': time.time()}
+        restarted.stamp_event('A', event)
+        self.subscriber.parse_history_window([event])
+        assert self.subscriber.last_seqs[('127.0.0.1:5556', 'A')] == (event['epoch'], 0)
+        assert self.subscriber.repair_stats[('127.0.0.1:5556', 'A')]['lost'] == 5
+        context.destroy(linger=0)
+        # A closed repair socket does not break the publishing loop
+        publisher.repair_socket.close()
+        publisher.serve_repairs(0.01)
+        publisher.repair_context.destroy(linger=0)
+
+    def test_broker_change_before_cache_watch(self):
+        znode = '/primaries/zone_1'
+        self.subscriber.zk = DataWatchRecorder()
+        self.subscriber.configure = lambda: None
+        self.subscriber.context = zmq.Context()
+        self.subscriber.broker_leader_znode = znode
+        self.subscriber.value_cache[znode] = '10.0.0.1,5555,5556'
+        self.subscriber.watch_znode_data_change()
+        # The primary failed over; the client's watch fires before the cache's one-shot watch
+        event = WatchedEvent(type='CHANGED', state='CONNECTED', path=znode)
+        self.subscriber.zk.callbacks[znode](b'10.0.0.2,5555,5557', None, event)
+        assert self.subscriber.broker_address == '10.0.0.2'
+        assert self.subscriber.sub_reg_port == '5557'
+        assert self.subscriber.get_znode_value(znode_name=znode) == '10.0.0.2,5555,5557'
+        self.subscriber.cache_watch(event)
+        assert znode not in self.subscriber.value_cache
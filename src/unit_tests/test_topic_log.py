@@ -0,0 +1,70 @@
+""" Module to perform unit tests against the memory-mapped topic log kept by centralized
+brokers for replay """
+import unittest
+import os
+import tempfile
+from src.unit_tests import *
+from src.lib.topic_log import TopicLog, RECORD_HEADER, topic_directory
+
+class TestTopicLog(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.directory = os.path.join(self.tmp.name, 'A')
+        # Room for 4 records of 10 bytes per segment; index entry every 2 records
+        self.record = RECORD_HEADER.size + 10
+        self.log = TopicLog(self.directory, segment_bytes=4 * self.record, index_interval=2 * self.record)
+
+    def tearDown(self):
+        self.log.close()
+        self.tmp.cleanup()
+
+    def append(self, count, start_time=0):
+        for i in range(count):
+            self.log.append(f'record{i:04d}'.encode('utf8'), timestamp=start_time + i)
+
+    def test_append_and_read(self):
+        self.append(10)
+        assert self.log.next_seq == 10
+        assert len(self.log.segments) == 3
+        assert [len(segment.index) for segment in self.log.segments] == [2, 2, 1]
+        records = self.log.read()
+        assert [seq for seq, timestamp, data in records] == list(range(10))
+        assert records[3] == (3, 3, b'record0003')
+
+    def test_read_from(self):
+        self.append(10)
+        assert [seq for seq, t, d in self.log.read(from_seq=5)] == [5, 6, 7, 8, 9]
+        assert [seq for seq, t, d in self.log.read(from_seq=3, max_records=3)] == [3, 4, 5]
+        assert [seq for seq, t, d in self.log.read(from_time=6.5)] == [7, 8, 9]
+        assert self.log.read(from_seq=10) == []
+
+    def test_recover(self):
+        self.append(6)
+        self.log.close()
+        self.log = TopicLog(self.directory, segment_bytes=4 * self.record, index_interval=2 * self.record)
+        assert self.log.next_seq == 6
+        self.append(1, start_time=6)
+        assert [seq for seq, t, d in self.log.read(from_seq=4)] == [4, 5, 6]
+
+    def test_large_record(self):
+        self.append(1)
+        seq = self.log.append(b'x' * 1000, timestamp=1)
+        assert self.log.read(from_seq=seq) == [(1, 1, b'x' * 1000)]
+        with self.assertRaises(ValueError):
+            self.log.append(b'')
+
+    def test_retention(self):
+        self.append(10)
+        self.log.retention_bytes = 2 * 4 * self.record
+        assert self.log.enforce_retention(now=10) == 1
+        assert self.log.first_seq == 4
+        self.log.retention_seconds = 2
+        assert self.log.enforce_retention(now=10) == 1
+        # The active segment is kept however old
+        assert self.log.enforce_retention(now=100) == 0
+        assert [seq for seq, t, d in self.log.read()] == [8, 9]
+        assert len(os.listdir(self.directory)) == 1
+
+    def test_topic_directory(self):
+        assert topic_directory('/logs', 'A#1') == '/logs/A%231'
+        assert topic_directory('/logs', 'a/b') == '/logs/a%2Fb'
@@ -0,0 +1,52 @@
+""" Module to perform unit tests against endpoint advertisement/selection (transport.py) """
+import unittest
+import zmq
+from src.unit_tests import *
+from src.lib import transport
+
+class TestTransport(unittest.TestCase):
+    def setUp(self):
+        self.context = zmq.Context()
+        self.endpoints = transport.advertise(
+            name='test-transport',
+            tcp_endpoint='tcp://127.0.0.1:5599',
+            address='127.0.0.1',
+            context=self.context
+        )
+
+    def tearDown(self):
+        self.context.destroy()
+
+    def test_same_context_uses_inproc(self):
+        assert transport.select_endpoint(
+            self.endpoints, '127.0.0.1', self.context) == self.endpoints['inproc']
+
+    def test_same_host_uses_ipc(self):
+        if not zmq.has('ipc'):
+            self.skipTest('ipc transport not available')
+        other_context = zmq.Context()
+        assert transport.select_endpoint(
+            self.endpoints, '127.0.0.1', other_context) == self.endpoints['ipc']
+        other_context.destroy()
+
+    def test_other_host_uses_tcp(self):
+        other_context = zmq.Context()
+        assert transport.select_endpoint(
+            self.endpoints, '10.0.0.2', other_context) == 'tcp://127.0.0.1:5599'
+        other_context.destroy()
+
+    def test_context_id_not_reused(self):
+        assert transport.context_id(self.context) == self.endpoints['context']
+        # Contexts created after others were destroyed may get the same address, never the same id
+        ids = set()
+        for i in range(20):
+            other_context = zmq.Context()
+            ids.add(transport.context_id(other_context))
+            other_context.destroy()
+            del other_context
+        assert len(ids) == 20
+
+    def test_bind_local(self):
+        sock = self.context.socket(zmq.PUB)
+        transport.bind_local(sock, self.endpoints)
+        sock.close()
@@ -2,6 +2,7 @@
 execute and can be tested independently of the publish/subscribe network """
 import unittest
 import sys
+import time
 from src.unit_tests import *
 from src.lib.zookeeper_client import ZookeeperClient
 connected = False
@@ -23,7 +24,8 @@ class TestZookeeperClient(unittest.TestCase):
 
     def tearDown(self):
         try:
-            self.zookeeper_client.delete_znode(znode_name='/test_znode')
+            self.zookeeper_client.delete_znode(znode_name='/test_znode', recursive=True)
+            self.zookeeper_client.delete_znode(znode_name='/topics/test_cache_znode')
         except:
             pass
 
@@ -56,3 +58,78 @@ class TestZookeeperClient(unittest.TestCase):
         assert(self.zookeeper_client.modify_znode_value(
             znode_name='/test_znode',
             znode_value="this is a new value") == "this is a new value")
+
+    def test_cached_znode_value_invalidated(self):
+        global connected
+        if not connected:
+            self.skipTest(not connected, "Not connected to ZooKeeper. You need to start ZK service.")
+        self.zookeeper_client.zk.ensure_path('/topics')
+        self.zookeeper_client.create_znode(znode_name='/topics/test_cache_znode', znode_value="first")
+        assert(self.zookeeper_client.get_znode_value(znode_name='/topics/test_cache_znode') == "first")
+        assert('/topics/test_cache_znode' in self.zookeeper_client.value_cache)
+        # A change made by another client must drop the cached value
+        other = ZookeeperClient(zookeeper_hosts=['127.0.0.1:2181'], use_logger=True)
+        other.connect_zk()
+        other.start_session()
+        other.modify_znode_value(znode_name='/topics/test_cache_znode', znode_value="second")
+        for _ in range(50):
+            if '/topics/test_cache_znode' not in self.zookeeper_client.value_cache:
+                break
+            time.sleep(0.1)
+        assert(self.zookeeper_client.get_znode_value(znode_name='/topics/test_cache_znode') == "second")
+        other.stop_session()
+        other.close_connection()
+
+    def test_cached_znode_children(self):
+        global connected
+        if not connected:
+            self.skipTest(not connected, "Not connected to ZooKeeper. You need to start ZK service.")
+        self.zookeeper_client.zk.ensure_path('/topics')
+        before = self.zookeeper_client.get_znode_children(znode_name='/topics/')
+        self.zookeeper_client.create_znode(znode_name='/topics/test_cache_znode')
+        for _ in range(50):
+            if '/topics' not in self.zookeeper_client.children_cache:
+                break
+            time.sleep(0.1)
+        after = self.zookeeper_client.get_znode_children(znode_name='/topics')
+        assert('test_cache_znode' in after)
+        assert(len(after) == len(before) + 1)
+
+    def test_commit_transaction(self):
+        global connected
+        if not connected:
+            self.skipTest(not connected, "Not connected to ZooKeeper. You need to start ZK service.")
+        assert(self.zookeeper_client.commit_transaction([
+            ('create', '/test_znode', 'parent'),
+            ('create', '/test_znode/child', 'child'),
+            ('set', '/test_znode', 'updated')
+        ]))
+        assert(self.zookeeper_client.get_znode_value(znode_name='/test_znode') == 'updated')
+        # Creating an existing znode fails the whole transaction; nothing else is applied
+        assert(not self.zookeeper_client.commit_transaction([
+            ('set', '/test_znode', 'not applied'),
+            ('create', '/test_znode/child', 'child')
+        ]))
+        assert(self.zookeeper_client.get_znode_value(znode_name='/test_znode') == 'updated')
+
+    def test_create_znodes(self):
+        global connected
+        if not connected:
+            self.skipTest(not connected, "Not connected to ZooKeeper. You need to start ZK service.")
+        self.zookeeper_client.create_znode(znode_name='/test_znode', znode_value='existing')
+        assert(self.zookeeper_client.create_znodes([
+            ('/test_znode', 'ignored'),
+            ('/test_znode/a/', 'a'),
+            ('/test_znode/a/b', 'b')
+        ]))
+        assert(self.zookeeper_client.get_znode_value(znode_name='/test_znode') == 'existing')
+        assert(self.zookeeper_client.get_znode_value(znode_name='/test_znode/a/b') == 'b')
+
+    def test_update_json_znode(self):
+        global connected
+        if not connected:
+            self.skipTest(not connected, "Not connected to ZooKeeper. You need to start ZK service.")
+        # Created (with parents) on first update, then read-modify-written
+        self.zookeeper_client.update_json_znode('/test_znode/bucket_0', lambda d: dict(d, a=1))
+        self.zookeeper_client.update_json_znode('/test_znode/bucket_0', lambda d: dict(d, b=2))
+        assert(self.zookeeper_client.get_znode_value(znode_name='/test_znode/bucket_0') == '{"a": 1, "b": 2}')